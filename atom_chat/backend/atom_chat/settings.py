@@ -36,6 +36,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -143,9 +144,141 @@ ASGI_APPLICATION = 'atom_chat.asgi.application'
 
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        # Подключения процесса получают сообщения групп из памяти процесса,
+        # в Redis сообщение группы публикуется один раз на процесс, а не на каждое подключение
+        "BACKEND": "chat.layers.HybridChannelLayer",
         "CONFIG": {
-            "hosts": [("redis", 6379)],
+            "remote": {
+                "BACKEND": "channels_redis.core.RedisChannelLayer",
+                "CONFIG": {
+                    "hosts": [("redis", 6379)],
+                    # Очередь процесса (hybrid.*) принимает сообщения всех групп процесса, поэтому ее емкость
+                    # намного больше емкости канала по умолчанию (100)
+                    "channel_capacity": {"hybrid.*": 100000},
+                },
+            },
         },
     },
 }
+
+# Пул потоков для запросов к базе данных из WebSocket-подключений (аутентификация, запись и загрузка сообщений)
+CHAT_DB_EXECUTOR = {
+    # Число потоков (и соединений с базой данных); 0 — запросы выполняются через database_sync_to_async
+    'MAX_WORKERS': 8,
+    # Максимальное число запросов, ожидающих потока; сверх него запросы сразу отклоняются
+    'MAX_QUEUE': 200,
+    # Время жизни соединения потока, в секундах (None — без ограничения)
+    'CONNECTION_MAX_AGE': 600,
+}
+
+# Пакетная запись сообщений, полученных через WebSocket
+CHAT_WRITE_BUFFER = {
+    # 'ack' — отправитель ждет записи пакета, в который попало его сообщение;
+    # 'async' — соединение не ждет записи, рассылка выполняется после фиксации пакета;
+    # 'direct' — каждое сообщение записывается отдельным запросом
+    'MODE': 'ack',
+    # Максимальное число сообщений в одном bulk_create
+    'MAX_BATCH_SIZE': 200,
+    # Максимальное время ожидания пакета, в секундах
+    'FLUSH_INTERVAL': 0.01,
+    # Максимальное число сообщений, ожидающих записи в памяти процесса
+    'MAX_PENDING': 10000,
+}
+
+# Кэш пользователей, аутентифицированных по JWT при подключении к WebSocket
+CHAT_USER_CACHE = {
+    # Максимальное число пользователей в кэше процесса
+    'MAX_SIZE': 10000,
+    # Время жизни записи, в секундах
+    'TTL': 60,
+}
+
+# Буфер последних сообщений каналов в памяти процесса
+CHAT_RECENT_MESSAGES = {
+    # Число последних сообщений канала, которые отправляются клиенту при подключении
+    'SIZE': 50,
+}
+
+# Догрузка пропущенных сообщений при переподключении к WebSocket (?last_seen_id=<id>)
+CHAT_REPLAY = {
+    # Число сообщений в одном кадре догрузки
+    'BATCH_SIZE': 200,
+    # Максимальное число догружаемых сообщений, остаток клиент загружает через REST
+    'MAX_MESSAGES': 5000,
+}
+
+# Ограничения входящих WebSocket-сообщений (корзины токенов). Частота 0 отключает ограничение
+CHAT_RATE_LIMIT = {
+    # Сообщений в секунду и допустимый всплеск для одного подключения (в памяти процесса)
+    'CONNECTION_RATE': 5,
+    'CONNECTION_BURST': 10,
+    # То же для всех подключений пользователя (общее для всех процессов через Redis channel layer)
+    'USER_RATE': 10,
+    'USER_BURST': 20,
+    # Максимальный размер входящего кадра, в байтах
+    'MAX_MESSAGE_SIZE': 4096,
+    # Сообщение сверх лимита: 'drop' — отбрасывается молча; 'warn' — отбрасывается, клиенту отправляется ошибка;
+    # 'close' — соединение закрывается (код 4429 для частоты, 4413 для размера)
+    'POLICY': 'warn',
+}
+
+# Заблокированные пользователи в WebSocket
+CHAT_BLOCKED_USERS = {
+    # 'close' — при блокировке все соединения пользователя закрываются (код 4403), новые не принимаются;
+    # 'mute' — соединения остаются открытыми, но отправка сообщений и уведомлений запрещена
+    'ACTION': 'close',
+}
+
+# Присутствие пользователей в каналах (кто в сети)
+CHAT_PRESENCE = {
+    # Как часто открытое подключение продлевает присутствие, в секундах
+    'HEARTBEAT_INTERVAL': 30,
+    # Через сколько секунд без продления подключение считается закрытым (процесс завершился без disconnect)
+    'TTL': 90,
+    # Задержка рассылки изменений списка пользователей в сети, в секундах (изменения за это время объединяются)
+    'DEBOUNCE': 1.0,
+}
+
+# Уведомления «печатает» (кадры {"type": "typing"} от клиентов, в базу данных не записываются)
+CHAT_TYPING = {
+    # Группа канала получает не больше одного уведомления за это число секунд
+    'INTERVAL': 2.0,
+}
+
+# Кэш сериализованных ответов списка каналов и истории (по ETag), хранится в кэше Django
+CHAT_RESPONSE_CACHE = {
+    # Время жизни ответа в кэше, в секундах
+    'TIMEOUT': 300,
+}
+
+# Потоковая выгрузка истории каналов
+CHAT_EXPORT = {
+    # Число сообщений, читаемых из базы данных одним запросом
+    'BATCH_SIZE': 2000,
+    # При перегрузке пула запросов (под ASGI) пакет ждет с нарастающей паузой, но не дольше BUSY_TIMEOUT секунд
+    'BUSY_RETRY_DELAY': 0.05,
+    'BUSY_RETRY_MAX_DELAY': 2,
+    'BUSY_TIMEOUT': 120,
+}
+
+# Массовый импорт сообщений из NDJSON (API и команда import_messages)
+CHAT_IMPORT = {
+    # Число сообщений в одном bulk_create и одной транзакции
+    'BATCH_SIZE': 5000,
+    # Сколько отклоненных строк перечислять в отчете (с номерами строк)
+    'MAX_ERRORS': 100,
+}
+
+# Фоновое удаление сообщений удаленных каналов
+CHAT_CHANNEL_PURGE = {
+    # False — удаление выполняется сразу после фиксации запроса на удаление канала или сообщений (в том же потоке)
+    'BACKGROUND': True,
+    # Число сообщений, удаляемых одной транзакцией
+    'BATCH_SIZE': 1000,
+    # Пауза между пакетами, в секундах (дает другим запросам записать данные)
+    'PAUSE': 0.05,
+}
+
+# Сбор метрик (доступны по адресу /api/metrics/ в формате Prometheus).
+# При выключенном сборе инструментирование сводится к одной проверке флага
+CHAT_METRICS_ENABLED = False
@@ -0,0 +1,83 @@
+from collections import defaultdict
+
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest, Left
+
+from .models import Channel, Message
+
+
+# Длина фрагмента последнего сообщения в списке каналов
+PREVIEW_LENGTH = 100
+
+
+def preview(content):
+    return content[:PREVIEW_LENGTH]
+
+
+def messages_created(messages):
+    """
+    Обновляет число сообщений и последнее сообщение каналов после записи сообщений
+    (вызывается в транзакции записи, один UPDATE на канал)
+    """
+    channels = defaultdict(list)
+    for message in messages:
+        channels[message.channel_id].append(message)
+
+    for channel_id, created in channels.items():
+        # Последнее сообщение — самое новое по времени (импорт истории пишет и старые сообщения)
+        last = max(created, key=lambda message: (message.timestamp, message.id))
+        # Последнее сообщение канала заменяется, только если записанное новее него
+        newer = (Q(last_message_at__isnull=True) | Q(last_message_at__lt=last.timestamp)
+                 | Q(last_message_at=last.timestamp, last_message_id__lt=last.id))
+        Channel.objects.filter(id=channel_id).touch(
+            message_count=F('message_count') + len(created),
+            last_message_id=_if_newer(newer, 'last_message_id', last.id),
+            last_message_at=_if_newer(newer, 'last_message_at', last.timestamp),
+            last_message_preview=_if_newer(newer, 'last_message_preview', preview(last.content)),
+        )
+
+
+def _if_newer(newer, field, value):
+    return Case(When(newer, then=Value(value)), default=F(field), output_field=Channel._meta.get_field(field))
+
+
+def messages_deleted(message_ids):
+    """
+    Обновляет число сообщений и последнее сообщение каналов перед удалением сообщений
+    (вызывается в транзакции удаления)
+    """
+    message_ids = list(message_ids)
+    counts = (Message.objects.filter(id__in=message_ids).order_by()
+              .values_list('channel_id').annotate(count=Count('id')))
+    for channel_id, count in counts:
+        channel = Channel.objects.filter(id=channel_id)
+        if not channel.filter(last_message_id__in=message_ids).exists():
+            channel.touch(message_count=Greatest(F('message_count') - count, 0))
+            continue
+        # Удаляется последнее сообщение канала: последним становится самое новое из оставшихся
+        last = (Message.objects.filter(channel_id=channel_id).exclude(id__in=message_ids)
+                .order_by('-timestamp', '-id').values('id', 'timestamp', 'content').first())
+        channel.touch(
+            message_count=Greatest(F('message_count') - count, 0),
+            last_message_id=last['id'] if last else None,
+            last_message_at=last['timestamp'] if last else None,
+            last_message_preview=preview(last['content']) if last else '',
+        )
+
+
+def rebuild_channel_activity(channels=None):
+    """
+    Пересчитывает денормализованные данные каналов одним запросом (после массовой загрузки сообщений).
+    Версия каналов увеличивается, иначе условные GET-запросы продолжат отдавать ответы, построенные до загрузки
+    """
+    if channels is None:
+        channels = Channel.objects.all()
+    messages = Message.objects.filter(channel_id=OuterRef('id')).order_by()
+    last = messages.order_by('-timestamp', '-id')
+    return channels.touch(
+        message_count=Coalesce(Subquery(messages.values('channel_id').annotate(count=Count('id')).values('count')), 0),
+        last_message_id=Subquery(last.values('id')[:1]),
+        last_message_at=Subquery(last.values('timestamp')[:1]),
+        last_message_preview=Coalesce(
+            Subquery(last.annotate(preview=Left('content', PREVIEW_LENGTH)).values('preview')[:1]), Value('')),
+    )
@@ -2,6 +2,7 @@ from django.contrib import admin
 
 
 from .models import CustomUser
+from .signals import user_flags_changed
 
 
 @admin.register(CustomUser)
@@ -34,7 +35,9 @@ class CustomUserAdmin(admin.ModelAdmin):
         """
         Назначить модераторами выбранных пользователей
         """
+        user_ids = list(queryset.values_list('id', flat=True))
         updated = queryset.update(is_moderator=True)
+        user_flags_changed.send(sender=self.__class__, user_ids=user_ids, changes={'is_moderator': True})
         self.message_user(request, f"Назначено модераторами: {updated} пользователь(-я).")
 
     make_moderator.short_description = "Назначить модераторами"
@@ -43,7 +46,9 @@ class CustomUserAdmin(admin.ModelAdmin):
         """
         Убрать роль модератора у выбранных пользователей
         """
+        user_ids = list(queryset.values_list('id', flat=True))
         updated = queryset.update(is_moderator=False)
+        user_flags_changed.send(sender=self.__class__, user_ids=user_ids, changes={'is_moderator': False})
         self.message_user(request, f"Роль модератора убрана у: {updated} пользователя(-ей).")
 
     remove_moderator.short_description = "Убрать роль модератора"
@@ -52,7 +57,9 @@ class CustomUserAdmin(admin.ModelAdmin):
         """
         Заблокировать выбранных пользователей
         """
+        user_ids = list(queryset.values_list('id', flat=True))
         updated = queryset.update(is_blocked=True)
+        user_flags_changed.send(sender=self.__class__, user_ids=user_ids, changes={'is_blocked': True})
         self.message_user(request, f"Заблокировано пользователей: {updated}.")
 
     block_users.short_description = "Заблокировать пользователей"
@@ -61,11 +68,23 @@ class CustomUserAdmin(admin.ModelAdmin):
         """
         Разблокировать выбранных пользователей
         """
+        user_ids = list(queryset.values_list('id', flat=True))
         updated = queryset.update(is_blocked=False)
+        user_flags_changed.send(sender=self.__class__, user_ids=user_ids, changes={'is_blocked': False})
         self.message_user(request, f"Разблокировано пользователей: {updated}.")
 
     unblock_users.short_description = "Разблокировать пользователей"
 
+    def save_model(self, request, obj, form, change):
+        """
+        Сохранить пользователя и сообщить об изменении его флагов
+        """
+        super().save_model(request, obj, form, change)
+        changes = {field: form.cleaned_data[field] for field in ('is_moderator', 'is_blocked')
+                   if field in form.changed_data}
+        if change and changes:
+            user_flags_changed.send(sender=self.__class__, user_ids=[obj.id], changes=changes)
+
     def get_queryset(self, request):
         """
         Ограничить доступ к пользователям для администраторов
@@ -0,0 +1,202 @@
+import asyncio
+import atexit
+import logging
+from collections import deque
+
+from django.conf import settings
+from django.db import transaction
+
+from .executor import DatabaseBusy, get_db_executor
+from .models import Message
+from . import activity, metrics, unread
+
+
+logger = logging.getLogger(__name__)
+
+# Каждое сообщение записывается отдельным INSERT
+MODE_DIRECT = 'direct'
+# Сообщения пишутся пакетами, отправитель ждет фиксации своего пакета
+MODE_ACK = 'ack'
+# Сообщения пишутся пакетами, обработка соединения не ждет записи
+MODE_ASYNC = 'async'
+
+DEFAULTS = {
+    'MODE': MODE_ACK,
+    'MAX_BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 0.01,
+    'MAX_PENDING': 10000,
+}
+
+
+class MessageWriteBuffer:
+    """
+    Буфер отложенной записи сообщений (write-behind).
+
+    Сообщения копятся в памяти процесса и записываются одним bulk_create, когда набирается
+    MAX_BATCH_SIZE сообщений или проходит FLUSH_INTERVAL секунд. Если в очереди уже MAX_PENDING
+    сообщений, новое сообщение ждет записи текущих (ограничение памяти).
+    """
+
+    def __init__(self, mode=MODE_ACK, max_batch_size=200, flush_interval=0.01, max_pending=10000):
+        if mode not in (MODE_DIRECT, MODE_ACK, MODE_ASYNC):
+            raise ValueError(f"Неизвестный режим записи сообщений: {mode}")
+        self.mode = mode
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # Пары (сообщение, future), ожидающие записи
+        self.pending = deque()
+        self._loop = None
+        self._timer = None
+        self._flush_task = None
+
+    @classmethod
+    def from_settings(cls):
+        config = {**DEFAULTS, **getattr(settings, 'CHAT_WRITE_BUFFER', {})}
+        return cls(
+            mode=config['MODE'],
+            max_batch_size=config['MAX_BATCH_SIZE'],
+            flush_interval=config['FLUSH_INTERVAL'],
+            max_pending=config['MAX_PENDING'],
+        )
+
+    @property
+    def acknowledge(self):
+        """
+        Должен ли отправитель дожидаться записи сообщения
+        """
+        return self.mode != MODE_ASYNC
+
+    async def enqueue(self, message):
+        """
+        Ставит сообщение в очередь на запись.
+        Возвращает future, который завершится сохраненным сообщением (с id) после фиксации пакета.
+        """
+        self._bind_loop()
+        future = self._loop.create_future()
+
+        if self.mode == MODE_DIRECT:
+            try:
+                saved = await get_db_executor().run(self._write, [message])
+                future.set_result(saved[0])
+            except Exception as exc:
+                future.set_exception(exc)
+            return future
+
+        # Ограничиваем объем памяти: ждем, пока буфер освободится
+        while len(self.pending) >= self.max_pending:
+            await asyncio.shield(self._start_flush())
+
+        self.pending.append((message, future))
+        if len(self.pending) >= self.max_batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self.flush_interval, self._start_flush)
+        return future
+
+    async def save(self, message):
+        """
+        Ставит сообщение в очередь и ждет его записи
+        """
+        return await (await self.enqueue(message))
+
+    async def flush(self):
+        """
+        Записывает все накопленные сообщения
+        """
+        while self.pending:
+            count = min(len(self.pending), self.max_batch_size)
+            batch = [self.pending.popleft() for _ in range(count)]
+            metrics.WRITE_BATCH_SIZE.observe(count)
+            try:
+                saved = await get_db_executor().run(self._write, [message for message, _ in batch])
+            except DatabaseBusy as exc:
+                logger.warning("Пакет из %s сообщений отклонен: %s", len(batch), exc)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            except Exception:
+                logger.exception("Не удалось записать пакет из %s сообщений, сообщения записываются по одному",
+                                 len(batch))
+                await self._write_each(batch)
+                continue
+            for message, (_, future) in zip(saved, batch):
+                if not future.done():
+                    future.set_result(message)
+
+    async def _write_each(self, batch):
+        """
+        Записывает сообщения пакета по одному: ошибка одного сообщения не отменяет запись остальных
+        """
+        for message, future in batch:
+            try:
+                saved = await get_db_executor().run(self._write, [message])
+            except Exception as exc:
+                if not future.done():
+                    future.set_exception(exc)
+                continue
+            if not future.done():
+                future.set_result(saved[0])
+
+    async def close(self):
+        """
+        Записывает оставшиеся сообщения при остановке процесса
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self.flush()
+
+    def drain(self):
+        """
+        Синхронная запись оставшихся сообщений (вызывается при завершении интерпретатора)
+        """
+        if not self.pending:
+            return
+        messages = [message for message, _ in self.pending]
+        self.pending.clear()
+        try:
+            self._write(messages)
+        except Exception:
+            logger.exception("Не удалось записать %s сообщений при остановке", len(messages))
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Таймер и задача записи привязаны к циклу событий, в котором были созданы
+            self._loop = loop
+            self._timer = None
+            self._flush_task = None
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = self._loop.create_task(self.flush())
+        return self._flush_task
+
+    @staticmethod
+    def _write(messages):
+        with transaction.atomic():
+            saved = Message.objects.bulk_create(messages)
+            unread.messages_created(saved)
+            activity.messages_created(saved)
+            return saved
+
+
+_write_buffer = None
+
+
+def get_write_buffer():
+    """
+    Возвращает буфер записи сообщений текущего процесса
+    """
+    global _write_buffer
+    if _write_buffer is None:
+        _write_buffer = MessageWriteBuffer.from_settings()
+        atexit.register(_write_buffer.drain)
+    return _write_buffer
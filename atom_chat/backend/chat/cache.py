@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+DEFAULTS = {
+    'MAX_SIZE': 10000,
+    'TTL': 60,
+}
+
+
+class UserCache:
+    """
+    Ограниченный по размеру кэш аутентифицированных пользователей с временем жизни записей.
+
+    Записи хранятся в порядке последнего обращения: при переполнении вытесняется
+    давно не использованный пользователь (LRU). Кэш общий для потоков процесса.
+    Ключом служит id пользователя в виде строки (так он хранится в JWT-токене).
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        # user_id -> (время устаревания, пользователь)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        config = {**DEFAULTS, **getattr(settings, 'CHAT_USER_CACHE', {})}
+        return cls(max_size=config['MAX_SIZE'], ttl=config['TTL'])
+
+    def get(self, user_id):
+        """
+        Возвращает пользователя из кэша или None, если записи нет или она устарела
+        """
+        key = str(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return user
+
+    def set(self, user_id, user):
+        key = str(user_id)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *user_ids):
+        """
+        Удаляет пользователей из кэша (например, после изменения флагов блокировки)
+        """
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(str(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_user_cache = None
+
+
+def get_user_cache():
+    """
+    Возвращает кэш пользователей текущего процесса
+    """
+    global _user_cache
+    if _user_cache is None:
+        _user_cache = UserCache.from_settings()
+    return _user_cache
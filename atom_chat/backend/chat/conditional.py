@@ -0,0 +1,54 @@
+import hashlib
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+
+DEFAULTS = {
+    'TIMEOUT': 300,
+}
+
+
+class ConditionalGetMixin:
+    """
+    Условные GET-запросы для представлений со списками.
+
+    ETag и Last-Modified вычисляются по версии данных (денормализованные поля каналов), а не по содержимому ответа.
+    Если клиент передал совпадающие If-None-Match или If-Modified-Since, возвращается 304 без обращения
+    к таблице сообщений. Иначе сериализованный ответ берется из кэша по ETag или строится и кэшируется.
+    """
+    cache_key_prefix = 'chat:response'
+
+    def conditional_response(self, request, version, last_modified, build):
+        """
+        version — строка, меняющаяся при любом изменении данных; last_modified — время последнего изменения;
+        build — функция, возвращающая данные ответа
+        """
+        # Страницы и сортировки различаются по строке запроса
+        etag = '"%s"' % hashlib.md5(f'{version}|{request.get_full_path()}'.encode()).hexdigest()
+        # Last-Modified с точностью до секунды округляется вверх, иначе изменения в ту же секунду были бы не видны
+        timestamp = math.ceil(last_modified.timestamp()) if last_modified is not None else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            key = f'{self.cache_key_prefix}:{etag}'
+            data = cache.get(key)
+            if data is None:
+                data = build()
+                config = {**DEFAULTS, **getattr(settings, 'CHAT_RESPONSE_CACHE', {})}
+                cache.set(key, data, config['TIMEOUT'])
+            response = Response(data)
+
+        response['ETag'] = etag
+        # Пока секунда последнего изменения не закончилась, следующие изменения в нее же не изменят Last-Modified,
+        # поэтому он не отправляется (клиент проверяет актуальность по ETag)
+        if timestamp is not None and timestamp <= time.time():
+            response['Last-Modified'] = http_date(timestamp)
+        # Клиент может хранить ответ, но обязан проверять его актуальность
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
@@ -1,79 +1,539 @@
-import json
+import asyncio
+import logging
+import time
+from urllib.parse import parse_qs
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
 from .models import Message, Channel
+from .buffer import get_write_buffer
+from .executor import DatabaseBusy, database_async
+from .cache import get_user_cache
+from .events import get_group_name, get_user_group_name
+from .history import entry_key, get_recent_messages, message_entry
+from .pagination import filter_after
+from .presence import get_presence
+from .typing_indicators import get_typing_indicators
+from .unread import create_marker
+from .limits import MessageLimiter, POLICY_CLOSE, POLICY_WARN
+from . import metrics
+from .protocol import (encode_frame, decode_frame, encode_binary_frame, decode_binary_frame, encode_frames,
+                       message_payload, select_subprotocol, SUBPROTOCOL_MSGPACK, CLIENT_MESSAGE, CLIENT_TYPING)
+from .serializers import MessageSerializer
+
 
+logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
+# Фоновые задачи рассылки сохраненных сообщений (режим записи async)
+_background_tasks = set()
+
+REPLAY_DEFAULTS = {
+    'BATCH_SIZE': 200,
+    'MAX_MESSAGES': 5000,
+}
+
+# Заблокированный пользователь: 'close' — соединения закрываются; 'mute' — остаются открытыми только для чтения
+BLOCK_CLOSE = 'close'
+BLOCK_MUTE = 'mute'
+
+BLOCKED_USERS_DEFAULTS = {
+    'ACTION': BLOCK_CLOSE,
+}
+
+# Код закрытия WebSocket-соединения при удалении канала
+CHANNEL_DELETED_CLOSE_CODE = 4404
+# Код закрытия соединения заблокированного пользователя
+USER_BLOCKED_CLOSE_CODE = 4403
+# Код закрытия при перегрузке базы данных (Try Again Later)
+DATABASE_BUSY_CLOSE_CODE = 1013
+# Коды закрытия при превышении ограничений частоты и размера сообщений
+RATE_LIMITED_CLOSE_CODE = 4429
+MESSAGE_TOO_LARGE_CLOSE_CODE = 4413
+
+LIMIT_ERRORS = {
+    'size': 'Сообщение слишком большое',
+    'connection_rate': 'Слишком много сообщений',
+    'user_rate': 'Слишком много сообщений',
+}
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    room_group_name = None
+    # Клиент выбрал бинарный подпротокол MessagePack
+    binary = False
+    # id сообщений, уже отправленных клиенту при подключении (для исключения дублей)
+    sent_on_connect = frozenset()
+    sent_on_connect_max_id = 0
+    limiter = None
+    heartbeat_task = None
+    # Пользователь заблокирован (читается при подключении, затем обновляется событием user_blocked)
+    blocked = False
 
     async def connect(self):
         """
         Устанавливаем WebSocket-соединение
         """
         # Извлекаем название канала из URL
-        self.channel_name = self.scope['url_route']['kwargs']['channel_name']
+        self.room_name = self.scope['url_route']['kwargs']['channel_name']
+        user = self.scope['user']
+
+        # Анонимные пользователи не могут отправлять сообщения
+        if not user.is_authenticated:
+            metrics.WS_CONNECTIONS.inc(result='rejected')
+            await self.close()
+            return
+
+        # Канал проверяем один раз при подключении, а не при каждом сообщении
+        try:
+            channel_id, message_count = await self.get_channel(self.room_name) or (None, 0)
+            # Пользователь из кэша может быть устаревшим (блокировка в другом процессе), признак читается заново
+            blocked = await self.get_is_blocked(user.id)
+        except DatabaseBusy:
+            metrics.WS_CONNECTIONS.inc(result='busy')
+            await self.close(code=DATABASE_BUSY_CLOSE_CODE)
+            return
+        if channel_id is None or blocked is None:
+            # Канал не найден или пользователь удален
+            metrics.WS_CONNECTIONS.inc(result='rejected')
+            await self.close()
+            return
+
+        self.blocked = blocked
+        if self.blocked and self.block_action == BLOCK_CLOSE:
+            metrics.WS_CONNECTIONS.inc(result='rejected')
+            await self.close(code=USER_BLOCKED_CLOSE_CODE)
+            return
+
+        # Отметка о прочтении создается при первом подключении, до первого сообщения пользователя в канале:
+        # дальше ее счетчик обновляется при записи сообщений, а не подсчетом
+        try:
+            await self.create_read_marker(user.id, channel_id, message_count)
+        except DatabaseBusy:
+            metrics.WS_CONNECTIONS.inc(result='busy')
+            await self.close(code=DATABASE_BUSY_CLOSE_CODE)
+            return
+
+        self.user_id = user.id
+        self.username = user.username
+        self.channel_id = channel_id
         # Название группы для канала
-        self.room_group_name = f'chat_{self.channel_name}'
+        self.room_group_name = get_group_name(channel_id)
+        # Группа всех подключений пользователя (для блокировки)
+        await self.channel_layer.group_add(get_user_group_name(self.user_id), self.channel_name)
+        self.limiter = MessageLimiter(self.channel_layer, self.user_id)
 
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
+        # Пока процесс подписан на группу канала, буфер последних сообщений остается актуальным
+        get_recent_messages().acquire(channel_id)
+
+        subprotocol = select_subprotocol(self.scope.get('subprotocols', []))
+        self.binary = subprotocol == SUBPROTOCOL_MSGPACK
+        await self.accept(subprotocol=subprotocol)
+        metrics.WS_CONNECTIONS.inc(result='accepted')
+        metrics.WS_ACTIVE_CONNECTIONS.inc()
+
+        presence = get_presence()
+        await presence.join(self.channel_layer, channel_id, self.channel_name, self.user_id, self.username)
+        self.heartbeat_task = asyncio.ensure_future(self.send_heartbeats())
 
-        await self.accept()
+        # Живые сообщения копятся в очереди channel layer, пока выполняется connect,
+        # поэтому между догрузкой пропущенного и живой доставкой нет разрыва
+        last_seen_id = self.get_last_seen_id()
+        try:
+            if last_seen_id is None:
+                await self.send_backlog()
+            else:
+                await self.replay(last_seen_id)
+        except DatabaseBusy:
+            # Клиент переподключится позже и догрузит пропущенное
+            await self.close(code=DATABASE_BUSY_CLOSE_CODE)
 
     async def disconnect(self, close_code):
         """
         Закрытие WebSocket-соединения
         """
+        if self.room_group_name is None:
+            return
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        await self.channel_layer.group_discard(get_user_group_name(self.user_id), self.channel_name)
+        get_recent_messages().release(self.channel_id)
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        await get_presence().leave(self.channel_layer, self.channel_id, self.channel_name)
+        metrics.WS_DISCONNECTIONS.inc()
+        metrics.WS_ACTIVE_CONNECTIONS.dec()
+
+    async def send_heartbeats(self):
+        """
+        Продлевает присутствие подключения, пока оно открыто
+        """
+        presence = get_presence()
+        while True:
+            await asyncio.sleep(presence.heartbeat_interval)
+            try:
+                await presence.heartbeat(self.channel_layer, self.channel_id, self.channel_name)
+            except Exception:
+                logger.exception("Не удалось продлить присутствие в канале %s", self.channel_id)
+
+    async def send_backlog(self):
+        """
+        Отправляем клиенту последние сообщения канала сразу после подключения
+        """
+        recent_messages = get_recent_messages()
+        entries = recent_messages.get(self.channel_id)
+        if entries is None:
+            generation = recent_messages.generation(self.channel_id)
+            entries = await self.get_newest_entries(recent_messages.size)
+            recent_messages.seed(self.channel_id, entries, generation)
+        self.remember_sent(entries)
+        await self.send_frame({
+            'type': 'backlog',
+            'messages': [message_payload(entry) for entry in entries]
+        })
+
+    async def replay(self, last_seen_id):
+        """
+        Отправляем клиенту сообщения, пропущенные после last_seen_id, упорядоченными пакетами
+        (в порядке истории канала (timestamp, id))
+        """
+        config = {**REPLAY_DEFAULTS, **getattr(settings, 'CHAT_REPLAY', {})}
+        batch_size = config['BATCH_SIZE']
+        max_messages = config['MAX_MESSAGES']
+
+        sent = []
+        truncated = False
+        # Если последнее полученное сообщение есть в буфере, буфер покрывает пропуск и база данных не нужна
+        missed = get_recent_messages().after(self.channel_id, last_seen_id)
+        if missed is not None:
+            for start in range(0, len(missed), batch_size):
+                await self.send_replay_batch(missed[start:start + batch_size], sent)
+        else:
+            cursor = await self.get_message_key(last_seen_id)
+            if cursor is None:
+                # Сообщение удалено: его место в истории неизвестно, клиент получает последние сообщения заново
+                await self.send_backlog()
+                return
+            while True:
+                batch = await self.get_entries_after(cursor, batch_size)
+                if not batch:
+                    break
+                remaining = max_messages - len(sent)
+                if len(batch) > remaining:
+                    batch = batch[:remaining]
+                    truncated = True
+                if batch:
+                    await self.send_replay_batch(batch, sent)
+                    cursor = entry_key(batch[-1])
+                if truncated or len(batch) < batch_size:
+                    break
+
+        last_id = sent[-1] if sent else last_seen_id
+        self.sent_on_connect = frozenset(sent)
+        self.sent_on_connect_max_id = max(sent, default=last_seen_id)
+        # truncated означает, что пропуск слишком велик и остаток нужно загрузить через REST (after=last_id)
+        await self.send_frame({
+            'type': 'replay_done',
+            'last_id': last_id,
+            'truncated': truncated
+        })
+
+    async def send_replay_batch(self, batch, sent):
+        sent.extend(entry['id'] for entry in batch)
+        await self.send_frame({
+            'type': 'replay',
+            'messages': [message_payload(entry) for entry in batch]
+        })
+
+    def get_last_seen_id(self):
+        """
+        Извлекаем id последнего полученного клиентом сообщения из строки запроса
+        """
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        values = query.get('last_seen_id')
+        if not values or not values[0].isdigit():
+            return None
+        return int(values[0])
+
+    def remember_sent(self, entries):
+        self.sent_on_connect = frozenset(entry['id'] for entry in entries)
+        # Новые сообщения получают id больше всех отправленных: после первого такого сообщения набор не нужен
+        self.sent_on_connect_max_id = max(self.sent_on_connect, default=0)
+
+    async def send_frame(self, payload):
+        """
+        Отправляет кадр в формате, выбранном клиентом при подключении
+        """
+        if self.binary:
+            await self.send(bytes_data=encode_binary_frame(payload))
+        else:
+            await self.send(text_data=encode_frame(payload))
 
-    async def receive(self, text_data):
+    async def send_event_frame(self, event):
+        """
+        Пересылает клиенту кадр события группы, закодированный отправителем в формате клиента
         """
-       Получение сообщения
+        if not self.binary:
+            await self.send(text_data=event['frame'])
+        elif 'binary_frame' in event:
+            await self.send(bytes_data=event['binary_frame'])
+        else:
+            # Событие от процесса без msgpack
+            await self.send(bytes_data=encode_binary_frame(decode_frame(event['frame'])))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+       Получение кадра от клиента
        """
-        # Преобразуем текстовые данные в JSON
-        data = json.loads(text_data)
-        message = data['message']
-        # Получаем имя пользователя
-        username = self.scope['user'].username
-        channel_name = self.channel_name
-        # Сохраняем сообщение в базе данных
-        await self.save_message(username, channel_name, message)
-
-        # Отправляем сообщение всем пользователям, подключенным к каналу
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'username': username
-            }
-        )
+        if self.blocked:
+            await self.send_frame({'type': 'error', 'reason': 'blocked', 'error': 'Пользователь заблокирован'})
+            return
+
+        # Размер проверяется до разбора кадра, в байтах (текстовый кадр — в UTF-8)
+        size = len(bytes_data) if bytes_data is not None else len(text_data.encode())
+        reason = self.limiter.check_size(size)
+        if reason is not None:
+            await self.reject(reason)
+            return
+
+        # Бинарные кадры — MessagePack, текстовые — JSON
+        try:
+            data = decode_binary_frame(bytes_data) if bytes_data is not None else decode_frame(text_data)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            await self.send_invalid_frame()
+            return
+        frame_type = data.get('type', CLIENT_MESSAGE)
+        if frame_type == CLIENT_TYPING:
+            # Не сохраняется и рассылается объединенным кадром, поэтому не расходует лимит сообщений
+            get_typing_indicators().typing(self.channel_layer, self.channel_id, self.user_id, self.username)
+            return
+        if frame_type != CLIENT_MESSAGE:
+            await self.send_frame({'type': 'error', 'reason': 'unknown_type', 'error': 'Неизвестный тип кадра'})
+            return
+        # Текст сообщения проверяется до записи: некорректное значение не должно попасть в пакет записи
+        message = data.get('message')
+        if (not isinstance(message, str) or not message.strip()
+                or self.limiter.check_size(len(message.encode())) is not None):
+            await self.send_invalid_frame()
+            return
+
+        # Частота проверяется до записи в базу данных
+        reason = await self.limiter.check_rate()
+        if reason is not None:
+            await self.reject(reason)
+            return
+        await self.receive_message(message)
+
+    async def send_invalid_frame(self):
+        await self.send_frame({'type': 'error', 'reason': 'invalid_frame', 'error': 'Не удалось разобрать кадр'})
+
+    async def receive_message(self, message):
+        """
+        Запись и рассылка сообщения
+        """
+        username = self.username
+        metrics.WS_MESSAGES_RECEIVED.inc()
+        # Ставим сообщение в очередь на пакетную запись в базу данных
+        write_buffer = get_write_buffer()
+        started = time.perf_counter()
+        saved = await self.save_message(message)
+
+        if write_buffer.acknowledge:
+            # Рассылаем сообщение только после подтверждения записи
+            try:
+                saved_message = await saved
+            except DatabaseBusy:
+                await self.send_frame({'type': 'error', 'reason': 'busy',
+                                       'error': 'Сервер перегружен, повторите отправку позже'})
+                return
+            except Exception:
+                logger.exception("Сообщение пользователя %s не сохранено", username)
+                await self.send_frame({'error': 'Не удалось сохранить сообщение'})
+                return
+            metrics.MESSAGE_SAVE_SECONDS.observe(time.perf_counter() - started)
+            await self.broadcast_message(saved_message)
+        else:
+            # Соединение продолжает принимать сообщения, рассылка произойдет после записи пакета
+            task = asyncio.ensure_future(self.broadcast_when_saved(saved, started))
+            # Цикл событий хранит только слабые ссылки на задачи: без ссылки задача может быть удалена до завершения
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+
+    async def reject(self, reason):
+        """
+        Отклоняет сообщение сверх ограничений согласно политике CHAT_RATE_LIMIT['POLICY']
+        """
+        metrics.WS_MESSAGES_LIMITED.inc(reason=reason)
+        policy = self.limiter.policy
+        if policy == POLICY_CLOSE:
+            await self.close(code=MESSAGE_TOO_LARGE_CLOSE_CODE if reason == 'size' else RATE_LIMITED_CLOSE_CODE)
+        elif policy == POLICY_WARN:
+            await self.send_frame({'type': 'error', 'reason': reason, 'error': LIMIT_ERRORS[reason]})
+
+    async def broadcast_when_saved(self, saved, started):
+        """
+        Рассылка сообщения после его записи в базу данных
+        """
+        try:
+            saved_message = await saved
+        except Exception:
+            logger.exception("Сообщение пользователя %s не сохранено", self.username)
+            return
+        metrics.MESSAGE_SAVE_SECONDS.observe(time.perf_counter() - started)
+        await self.broadcast_message(saved_message)
+
+    async def broadcast_message(self, saved_message):
+        """
+        Отправляем сообщение всем пользователям, подключенным к каналу.
+        Кадр кодируется отправителем один раз в каждом формате (JSON и MessagePack),
+        получатели пересылают кадр своего формата без изменений
+        """
+        entry = message_entry(saved_message, self.username)
+        with metrics.GROUP_SEND_SECONDS.time():
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    'type': 'chat_message',
+                    # Для буфера последних сообщений в процессах получателей
+                    'entry': entry,
+                    **encode_frames({'type': 'message', **message_payload(entry)})
+                }
+            )
+        metrics.WS_MESSAGES_BROADCAST.inc()
 
     async def chat_message(self, event):
         """
         Обработка отправки сообщения
         """
-        await self.send(text_data=json.dumps({
-            'username': event['username'],
-            'message': event['message']
-        }))
+        entry = event.get('entry')
+        if entry is not None:
+            get_recent_messages().add(self.channel_id, entry)
+            if self.sent_on_connect:
+                if entry['id'] in self.sent_on_connect:
+                    # Сообщение уже отправлено клиенту при подключении
+                    return
+                if entry['id'] > self.sent_on_connect_max_id:
+                    self.sent_on_connect = frozenset()
+
+        if 'frame' in event:
+            await self.send_event_frame(event)
+        else:
+            # Событие в старом формате (например, от процесса предыдущей версии)
+            await self.send_frame({
+                'username': event['username'],
+                'message': event['message']
+            })
+        metrics.WS_FRAMES_SENT.inc()
+
+    async def messages_deleted(self, event):
+        """
+        Обработка удаления сообщений модератором
+        """
+        get_recent_messages().evict(self.channel_id, event['ids'])
+        await self.send_event_frame(event)
+
+    async def messages_imported(self, event):
+        """
+        Обработка импорта сообщений: буфер последних сообщений процесса больше не полон
+        """
+        get_recent_messages().invalidate(self.channel_id)
+
+    async def typing(self, event):
+        """
+        Обработка уведомления о наборе текста (отправителю, печатающему в одиночку, не пересылается)
+        """
+        if event.get('user_ids') != [self.user_id]:
+            await self.send_event_frame(event)
+
+    @property
+    def block_action(self):
+        return {**BLOCKED_USERS_DEFAULTS, **getattr(settings, 'CHAT_BLOCKED_USERS', {})}['ACTION']
+
+    async def user_blocked(self, event):
+        """
+        Обработка блокировки или разблокировки пользователя: закрываем соединение или запрещаем отправку
+        """
+        self.blocked = event['blocked']
+        # Кэш пользователей процесса мог сохранить прежнее значение флага
+        get_user_cache().invalidate(self.user_id)
+        await self.send_event_frame(event)
+        if self.blocked and self.block_action == BLOCK_CLOSE:
+            await self.close(code=USER_BLOCKED_CLOSE_CODE)
+
+    async def presence(self, event):
+        """
+        Обработка изменений списка пользователей в сети
+        """
+        await self.send_event_frame(event)
+
+    async def channel_deleted(self, event):
+        """
+        Обработка удаления канала: сообщаем клиенту и закрываем соединение
+        """
+        await self.send_event_frame(event)
+        await self.close(code=CHANNEL_DELETED_CLOSE_CODE)
+
+    async def save_message(self, message):
+        """
+        Ставим сообщение в очередь на запись в базу данных.
+        Возвращает future, который завершится после фиксации сообщения
+        """
+        return await get_write_buffer().enqueue(
+            Message(user_id=self.user_id, channel_id=self.channel_id, content=message)
+        )
 
-    @database_sync_to_async
-    def save_message(self, username, channel_name, message):
+    @database_async
+    def get_channel(self, channel_name):
         """
-        Сохраняем сообщение в базе данных
+        Получаем id и число сообщений канала по его названию
         """
-        user = User.objects.get(username=username)
-        channel = Channel.objects.get(name=channel_name)
+        return Channel.objects.active().filter(name=channel_name).values_list('id', 'message_count').first()
+
+    @database_async
+    def create_read_marker(self, user_id, channel_id, message_count):
+        create_marker(user_id, channel_id, message_count)
 
-        return Message.objects.create(user=user, channel=channel, content=message)
+    @database_async
+    def get_is_blocked(self, user_id):
+        """
+        Получаем признак блокировки пользователя
+        """
+        return User.objects.filter(id=user_id).values_list('is_blocked', flat=True).first()
+
+    @database_async
+    def get_newest_entries(self, count):
+        """
+        Получаем последние сообщения канала из базы данных (в порядке возрастания (timestamp, id))
+        """
+        messages = (Message.objects.filter(channel_id=self.channel_id).select_related('user')
+                    .order_by('-timestamp', '-id')[:count])
+        return [dict(entry) for entry in MessageSerializer(reversed(messages), many=True).data]
+
+    @database_async
+    def get_message_key(self, message_id):
+        """
+        Получаем ключ (timestamp, id) сообщения канала или None, если сообщения нет
+        """
+        timestamp = (Message.objects.filter(channel_id=self.channel_id, id=message_id)
+                     .values_list('timestamp', flat=True).first())
+        return None if timestamp is None else (timestamp, message_id)
+
+    @database_async
+    def get_entries_after(self, key, count):
+        """
+        Получаем сообщения канала после ключа (timestamp, id) (в порядке возрастания (timestamp, id))
+        """
+        messages = (filter_after(Message.objects.filter(channel_id=self.channel_id), *key)
+                    .select_related('user').order_by('timestamp', 'id')[:count])
+        return [dict(entry) for entry in MessageSerializer(messages, many=True).data]
@@ -0,0 +1,91 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from .history import get_recent_messages
+from .protocol import encode_frames
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_group_name(channel_id):
+    """
+    Название группы channel layer для канала чата
+    """
+    return f'chat_{channel_id}'
+
+
+def get_user_group_name(user_id):
+    """
+    Название группы channel layer для всех WebSocket-подключений пользователя
+    """
+    return f'user_{user_id}'
+
+
+def send_to_channel_group(channel_id, event):
+    """
+    Отправляет событие всем WebSocket-подключениям канала из синхронного кода (представлений).
+    Ошибка channel layer не отменяет уже выполненное изменение в базе данных
+    """
+    try:
+        async_to_sync(get_channel_layer().group_send)(get_group_name(channel_id), event)
+    except Exception:
+        logger.exception("Не удалось отправить событие %s в канал %s", event.get('type'), channel_id)
+
+
+def notify_messages_deleted(channel_id, message_ids):
+    """
+    Удаляет сообщения из буфера последних сообщений и сообщает об удалении подключенным клиентам
+    """
+    message_ids = list(message_ids)
+    get_recent_messages().evict(channel_id, message_ids)
+    send_to_channel_group(channel_id, {
+        'type': 'messages_deleted',
+        'ids': message_ids,
+        **encode_frames({'type': 'messages_deleted', 'ids': message_ids}),
+    })
+
+
+def notify_messages_imported(channel_ids):
+    """
+    Сбрасывает буферы последних сообщений каналов во всех процессах после импорта:
+    импортированные сообщения не рассылаются событиями группы, поэтому буферы их не содержат
+    """
+    recent_messages = get_recent_messages()
+    for channel_id in channel_ids:
+        recent_messages.invalidate(channel_id)
+        send_to_channel_group(channel_id, {'type': 'messages_imported'})
+
+
+def notify_channel_deleted(channel_id):
+    """
+    Сообщает подключенным клиентам об удалении канала, после чего их соединения закрываются
+    """
+    get_recent_messages().discard(channel_id)
+    send_to_channel_group(channel_id, {
+        'type': 'channel_deleted',
+        **encode_frames({'type': 'channel_deleted'}),
+    })
+
+
+def notify_users_blocked(user_ids, blocked):
+    """
+    Сообщает всем WebSocket-подключениям пользователей о блокировке или разблокировке
+    """
+    event = {
+        'type': 'user_blocked',
+        'blocked': blocked,
+        **encode_frames({'type': 'blocked' if blocked else 'unblocked'}),
+    }
+    layer = get_channel_layer()
+
+    async def send():
+        for user_id in user_ids:
+            await layer.group_send(get_user_group_name(user_id), event)
+
+    try:
+        async_to_sync(send)()
+    except Exception:
+        logger.exception("Не удалось сообщить подключениям пользователей %s о блокировке", list(user_ids))
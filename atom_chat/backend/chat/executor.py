@@ -0,0 +1,151 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+from channels.db import database_sync_to_async
+
+from . import metrics
+
+
+DEFAULTS = {
+    'MAX_WORKERS': 8,
+    'MAX_QUEUE': 200,
+    'CONNECTION_MAX_AGE': 600,
+}
+
+
+class DatabaseBusy(Exception):
+    """
+    Очередь запросов к базе данных заполнена, запрос отклонен без ожидания
+    """
+
+
+class DatabaseExecutor:
+    """
+    Ограниченный пул потоков для запросов к базе данных из асинхронного кода (WebSocket).
+
+    Запросы не конкурируют с остальным кодом за пул потоков по умолчанию. Если ожидающих запросов
+    уже MAX_QUEUE, новый запрос сразу отклоняется (DatabaseBusy), а не увеличивает задержку всех остальных.
+    Потоки пула держат соединения с базой данных открытыми между запросами (не дольше CONNECTION_MAX_AGE
+    секунд) и закрывают их только после ошибки соединения. При MAX_WORKERS = 0 запросы выполняются
+    через database_sync_to_async.
+    """
+
+    def __init__(self, max_workers=8, max_queue=200, connection_max_age=600):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.connection_max_age = connection_max_age
+        self._executor = None
+        self._lock = threading.Lock()
+        # Запросы, ожидающие свободного потока
+        self.queued = 0
+        self._local = threading.local()
+
+    @classmethod
+    def from_settings(cls):
+        config = {**DEFAULTS, **getattr(settings, 'CHAT_DB_EXECUTOR', {})}
+        return cls(
+            max_workers=config['MAX_WORKERS'],
+            max_queue=config['MAX_QUEUE'],
+            connection_max_age=config['CONNECTION_MAX_AGE'],
+        )
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Выполняет func в потоке пула и возвращает результат
+        """
+        if not self.max_workers:
+            return await database_sync_to_async(func)(*args, **kwargs)
+
+        with self._lock:
+            if self.queued >= self.max_queue:
+                metrics.DB_EXECUTOR_REJECTED.inc()
+                raise DatabaseBusy(f"В очереди к базе данных уже {self.queued} запросов")
+            self.queued += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='chat-db')
+        metrics.DB_EXECUTOR_QUEUE_DEPTH.inc()
+        future = self._executor.submit(self._call, time.perf_counter(), func, args, kwargs)
+        # Ожидающий запрос отменяется вместе с задачей (клиент отключился), и _call для него не выполнится
+        future.add_done_callback(lambda future: future.cancelled() and self._dequeue())
+        return await asyncio.wrap_future(future)
+
+    def _dequeue(self):
+        with self._lock:
+            self.queued -= 1
+        metrics.DB_EXECUTOR_QUEUE_DEPTH.dec()
+
+    def _call(self, submitted, func, args, kwargs):
+        self._dequeue()
+        metrics.DB_EXECUTOR_WAIT_SECONDS.observe(time.perf_counter() - submitted)
+        self._recycle_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._close_broken_connections()
+
+    def _recycle_connections(self):
+        """
+        Закрывает соединения потока старше CONNECTION_MAX_AGE (соединение откроется заново при запросе)
+        """
+        opened = getattr(self._local, 'opened', None)
+        now = time.monotonic()
+        if opened is None:
+            self._local.opened = now
+        elif self.connection_max_age is not None and now - opened > self.connection_max_age:
+            for connection in connections.all(initialized_only=True):
+                connection.close()
+            self._local.opened = now
+
+    @staticmethod
+    def _close_broken_connections():
+        for connection in connections.all(initialized_only=True):
+            if connection.in_atomic_block:
+                continue
+            if connection.errors_occurred:
+                if not connection.is_usable():
+                    connection.close()
+                connection.errors_occurred = False
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+_db_executor = None
+
+
+def get_db_executor():
+    """
+    Возвращает пул запросов к базе данных текущего процесса
+    """
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = DatabaseExecutor.from_settings()
+    return _db_executor
+
+
+@receiver(setting_changed)
+def reset_db_executor(setting, **kwargs):
+    global _db_executor
+    if setting == 'CHAT_DB_EXECUTOR' and _db_executor is not None:
+        _db_executor.shutdown()
+        _db_executor = None
+
+
+def database_async(func):
+    """
+    Декоратор: как database_sync_to_async, но через пул запросов к базе данных (get_db_executor)
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await get_db_executor().run(func, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,239 @@
+import asyncio
+import csv
+import logging
+import time
+import zlib
+
+from django.conf import settings
+from rest_framework import serializers
+
+from .executor import DatabaseBusy, get_db_executor
+from .models import Message
+from .protocol import encode_frame
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BATCH_SIZE': 2000,
+    # Пакет не отклоняется при перегрузке пула запросов (DatabaseBusy), а ждет с нарастающей паузой
+    # от BUSY_RETRY_DELAY до BUSY_RETRY_MAX_DELAY секунд, но не дольше BUSY_TIMEOUT секунд
+    'BUSY_RETRY_DELAY': 0.05,
+    'BUSY_RETRY_MAX_DELAY': 2,
+    'BUSY_TIMEOUT': 120,
+}
+
+FORMAT_NDJSON = 'ndjson'
+FORMAT_CSV = 'csv'
+
+CONTENT_TYPES = {
+    FORMAT_NDJSON: 'application/x-ndjson',
+    FORMAT_CSV: 'text/csv; charset=utf-8',
+}
+
+CSV_HEADER = ['id', 'username', 'timestamp', 'message']
+
+_timestamp_field = serializers.DateTimeField()
+
+
+def _get_queryset(channel_id, since, until):
+    messages = Message.objects.filter(channel_id=channel_id)
+    if since is not None:
+        messages = messages.filter(timestamp__gte=since)
+    if until is not None:
+        messages = messages.filter(timestamp__lt=until)
+    return messages.order_by('id').values_list('id', 'user__username', 'content', 'timestamp')
+
+
+def _fetch_batch(messages, cursor, batch_size):
+    return list(messages.filter(id__gt=cursor)[:batch_size])
+
+
+def _get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_EXPORT', {})}
+
+
+def _get_batch_size(batch_size):
+    if batch_size is None:
+        batch_size = _get_config()['BATCH_SIZE']
+    return batch_size
+
+
+async def _afetch_batch(messages, cursor, batch_size, config):
+    """
+    Читает пакет через пул запросов к базе данных. Выгрузку нельзя повторить позже, как сообщение WebSocket,
+    поэтому при перегрузке пакет ждет, и DatabaseBusy передается дальше только после BUSY_TIMEOUT
+    """
+    delay = config['BUSY_RETRY_DELAY']
+    deadline = time.monotonic() + config['BUSY_TIMEOUT']
+    while True:
+        try:
+            return await get_db_executor().run(_fetch_batch, messages, cursor, batch_size)
+        except DatabaseBusy:
+            if time.monotonic() + delay > deadline:
+                raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, config['BUSY_RETRY_MAX_DELAY'])
+
+
+def iter_message_batches(channel_id, after=0, since=None, until=None, batch_size=None):
+    """
+    Пакеты сообщений канала с id больше after в порядке возрастания id: списки кортежей (id, имя автора, текст, время).
+
+    Сообщения читаются пакетами по id (keyset), каждый пакет — отдельный короткий запрос: в памяти
+    не больше одного пакета, и выгрузка большого канала не держит чтение открытым, мешая записи
+    """
+    messages, batch_size = _get_queryset(channel_id, since, until), _get_batch_size(batch_size)
+    cursor = after
+    while True:
+        batch = _fetch_batch(messages, cursor, batch_size)
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            return
+        cursor = batch[-1][0]
+
+
+async def aiter_message_batches(channel_id, after=0, since=None, until=None, batch_size=None):
+    """
+    Как iter_message_batches, но для ASGI: каждый пакет читается в пуле запросов к базе данных
+    """
+    messages, batch_size, config = _get_queryset(channel_id, since, until), _get_batch_size(batch_size), _get_config()
+    cursor = after
+    while True:
+        batch = await _afetch_batch(messages, cursor, batch_size, config)
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            return
+        cursor = batch[-1][0]
+
+
+class NDJSONEncoder:
+    """
+    Строки NDJSON: один объект сообщения на строку (поля как в кадрах WebSocket)
+    """
+
+    def header(self):
+        return b''
+
+    def encode(self, batch):
+        return ''.join(encode_frame({
+            'id': message_id,
+            'username': username,
+            'message': content,
+            'timestamp': _timestamp_field.to_representation(timestamp),
+        }) + '\n' for message_id, username, content, timestamp in batch).encode()
+
+    def error(self, message, last_id):
+        return (encode_frame({'error': message, 'last_id': last_id}) + '\n').encode()
+
+
+class _Echo:
+    """
+    Файловый объект для csv.writer, возвращающий записанную строку
+    """
+
+    def write(self, value):
+        return value
+
+
+class CSVEncoder:
+    """
+    Строки CSV с заголовком
+    """
+
+    def __init__(self):
+        self.writer = csv.writer(_Echo())
+
+    def header(self):
+        return self.writer.writerow(CSV_HEADER).encode()
+
+    def encode(self, batch):
+        return ''.join(self.writer.writerow([message_id, username, _timestamp_field.to_representation(timestamp),
+                                             content])
+                       for message_id, username, content, timestamp in batch).encode()
+
+    def error(self, message, last_id):
+        # Строка ошибки отличается от строк сообщений нечисловым id
+        return self.writer.writerow(['error', '', '', f'{message} (last_id={last_id})']).encode()
+
+
+ENCODERS = {
+    FORMAT_NDJSON: NDJSONEncoder,
+    FORMAT_CSV: CSVEncoder,
+}
+
+
+class _Identity:
+    """
+    Поток без сжатия
+    """
+
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+def _get_compressor(compress, level=6):
+    # Формат gzip (wbits = 31), поток сжимается по мере чтения
+    return zlib.compressobj(level, zlib.DEFLATED, 31) if compress else _Identity()
+
+
+def _render_error(encoder, compressor, error, last_id):
+    """
+    Завершающая запись об ошибке: ответ уже начат, поэтому код ответа изменить нельзя, а выгрузка
+    не должна выглядеть полной. После записи исключение передается дальше, и сервер обрывает ответ
+    """
+    logger.error("Выгрузка сообщений прервана после сообщения %s", last_id, exc_info=error)
+    if isinstance(error, DatabaseBusy):
+        message = 'Выгрузка прервана: база данных перегружена, продолжите выгрузку с after=last_id'
+    else:
+        message = 'Выгрузка прервана из-за ошибки сервера, продолжите выгрузку с after=last_id'
+    return compressor.compress(encoder.error(message, last_id)) + compressor.flush()
+
+
+def render(batches, output=FORMAT_NDJSON, compress=False, after=0):
+    """
+    Байты выгрузки по пакетам сообщений (в формате output, при compress — сжатые gzip)
+    """
+    encoder, compressor = ENCODERS[output](), _get_compressor(compress)
+    data = compressor.compress(encoder.header())
+    last_id = after
+    try:
+        for batch in batches:
+            data += compressor.compress(encoder.encode(batch))
+            last_id = batch[-1][0]
+            if data:
+                yield data
+                data = b''
+    except Exception as error:
+        yield data + _render_error(encoder, compressor, error, last_id)
+        raise
+    data += compressor.flush()
+    if data:
+        yield data
+
+
+async def arender(batches, output=FORMAT_NDJSON, compress=False, after=0):
+    """
+    Как render, но для асинхронного потока пакетов
+    """
+    encoder, compressor = ENCODERS[output](), _get_compressor(compress)
+    data = compressor.compress(encoder.header())
+    last_id = after
+    try:
+        async for batch in batches:
+            data += compressor.compress(encoder.encode(batch))
+            last_id = batch[-1][0]
+            if data:
+                yield data
+                data = b''
+    except Exception as error:
+        yield data + _render_error(encoder, compressor, error, last_id)
+        raise
+    data += compressor.flush()
+    if data:
+        yield data
@@ -0,0 +1,244 @@
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from rest_framework import serializers
+
+
+DEFAULTS = {
+    'SIZE': 50,
+}
+
+_timestamp_field = serializers.DateTimeField()
+
+
+def message_entry(message, username):
+    """
+    Представление сообщения в том же виде, что и в MessageSerializer
+    """
+    return {
+        'id': message.id,
+        'user': username,
+        'content': message.content,
+        'timestamp': _timestamp_field.to_representation(message.timestamp),
+    }
+
+
+def entry_key(entry):
+    """
+    Ключ порядка сообщения: (timestamp, id), как в истории канала. Порядок id не совпадает с порядком времени
+    для импортированных и сгенерированных сообщений
+    """
+    return parse_datetime(entry['timestamp']), entry['id']
+
+
+class ChannelBacklog:
+    """
+    Последние сообщения одного канала, упорядоченные по (timestamp, id)
+    """
+
+    def __init__(self, size):
+        # Пары (ключ порядка, сообщение): ключ разбирается один раз при добавлении
+        self.items = deque(maxlen=size)
+        # Число подключений процесса к каналу
+        self.subscribers = 0
+        # Буфер заполнен из базы данных
+        self.seeded = False
+        # В буфере все сообщения канала (их меньше, чем размер буфера)
+        self.complete = False
+        # Увеличивается при сбросе буфера: заполнение данными, прочитанными до сброса, пропускается
+        self.generation = 0
+
+    @property
+    def entries(self):
+        return [entry for _, entry in self.items]
+
+    def add(self, entry):
+        items = self.items
+        key = entry_key(entry)
+        full = len(items) == items.maxlen
+        if not items or key > items[-1][0]:
+            if full:
+                # Самое старое сообщение вытесняется из буфера
+                self.complete = False
+            items.append((key, entry))
+            return
+        # Чаще всего повторяется последнее сообщение (событие группы о только что добавленном сообщении)
+        if key == items[-1][0]:
+            return
+        # Сообщения из разных процессов могут прийти не по порядку
+        if full and key < items[0][0]:
+            return
+        for index, (existing, _) in enumerate(items):
+            if existing == key:
+                return
+            if existing > key:
+                if full:
+                    # Вставка в полный deque недопустима, освобождаем место за счет самого старого
+                    items.popleft()
+                    self.complete = False
+                    index -= 1
+                items.insert(index, (key, entry))
+                return
+
+    def after(self, message_id):
+        """
+        Сообщения после message_id или None, если его нет в буфере
+        """
+        entries = self.entries
+        for index, entry in enumerate(entries):
+            if entry['id'] == message_id:
+                return entries[index + 1:]
+        return None
+
+
+class RecentMessages:
+    """
+    Кольцевой буфер последних сообщений по каналам.
+
+    Буфер канала существует, пока у процесса есть хотя бы одно WebSocket-подключение к каналу:
+    в это время процесс получает все сообщения группы канала и буфер остается актуальным.
+    После отключения последнего клиента буфер удаляется.
+    """
+
+    def __init__(self, size=50):
+        self.size = size
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        config = {**DEFAULTS, **getattr(settings, 'CHAT_RECENT_MESSAGES', {})}
+        return cls(size=config['SIZE'])
+
+    def acquire(self, channel_id):
+        """
+        Регистрирует подключение к каналу
+        """
+        with self._lock:
+            backlog = self._channels.get(channel_id)
+            if backlog is None:
+                backlog = self._channels[channel_id] = ChannelBacklog(self.size)
+            backlog.subscribers += 1
+
+    def release(self, channel_id):
+        """
+        Снимает регистрацию подключения, буфер удаляется вместе с последним подключением
+        """
+        with self._lock:
+            backlog = self._channels.get(channel_id)
+            if backlog is None:
+                return
+            backlog.subscribers -= 1
+            if backlog.subscribers <= 0:
+                del self._channels[channel_id]
+
+    def generation(self, channel_id):
+        """
+        Поколение буфера канала: запоминается перед чтением сообщений из базы данных для seed
+        """
+        with self._lock:
+            backlog = self._channels.get(channel_id)
+            return None if backlog is None else backlog.generation
+
+    def seed(self, channel_id, entries, generation=None):
+        """
+        Заполняет буфер последними сообщениями из базы данных (в порядке возрастания (timestamp, id)).
+        Если после чтения сообщений буфер был сброшен (generation изменилось), они могут быть неполными
+        """
+        with self._lock:
+            backlog = self._channels.get(channel_id)
+            if backlog is None or (generation is not None and backlog.generation != generation):
+                return
+            for entry in entries:
+                backlog.add(entry)
+            backlog.seeded = True
+            backlog.complete = len(entries) < self.size
+
+    def add(self, channel_id, entry):
+        with self._lock:
+            backlog = self._channels.get(channel_id)
+            if backlog is not None:
+                backlog.add(entry)
+
+    def evict(self, channel_id, message_ids):
+        """
+        Удаляет сообщения из буфера
+        """
+        message_ids = set(message_ids)
+        with self._lock:
+            backlog = self._channels.get(channel_id)
+            if backlog is None:
+                return
+            kept = [item for item in backlog.items if item[1]['id'] not in message_ids]
+            if len(kept) != len(backlog.items):
+                backlog.items = deque(kept, maxlen=self.size)
+
+    def invalidate(self, channel_id):
+        """
+        Сбрасывает буфер канала, сохраняя регистрацию подключений: сообщения записаны в обход
+        событий группы (импорт), буфер будет заново заполнен из базы данных
+        """
+        with self._lock:
+            backlog = self._channels.get(channel_id)
+            if backlog is None:
+                return
+            backlog.items.clear()
+            backlog.seeded = False
+            backlog.complete = False
+            backlog.generation += 1
+
+    def discard(self, channel_id):
+        """
+        Удаляет буфер канала целиком (например, при удалении канала)
+        """
+        with self._lock:
+            self._channels.pop(channel_id, None)
+
+    def get(self, channel_id):
+        """
+        Возвращает копию буфера канала или None, если буфер еще не заполнен
+        """
+        with self._lock:
+            backlog = self._channels.get(channel_id)
+            if backlog is None or not backlog.seeded:
+                return None
+            return backlog.entries
+
+    def after(self, channel_id, message_id):
+        """
+        Возвращает сообщения канала после message_id или None, если буфер не заполнен или сообщения в нем нет
+        (тогда нельзя гарантировать, что буфер содержит все более новые сообщения)
+        """
+        with self._lock:
+            backlog = self._channels.get(channel_id)
+            if backlog is None or not backlog.seeded:
+                return None
+            return backlog.after(message_id)
+
+    def newest(self, channel_id, count):
+        """
+        Возвращает count последних сообщений канала или None,
+        если буфер не может гарантировать полноту такой выборки
+        """
+        with self._lock:
+            backlog = self._channels.get(channel_id)
+            if backlog is None or not backlog.seeded:
+                return None
+            if len(backlog.items) < count and not backlog.complete:
+                return None
+            return backlog.entries[-count:]
+
+
+_recent_messages = None
+
+
+def get_recent_messages():
+    """
+    Возвращает буфер последних сообщений текущего процесса
+    """
+    global _recent_messages
+    if _recent_messages is None:
+        _recent_messages = RecentMessages.from_settings()
+    return _recent_messages
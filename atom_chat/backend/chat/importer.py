@@ -0,0 +1,171 @@
+import time
+from collections import Counter
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.parsers import BaseParser
+
+from .models import Channel, Message
+from .events import notify_messages_imported
+from .protocol import decode_frame
+from . import activity, unread
+
+
+User = get_user_model()
+
+DEFAULTS = {
+    'BATCH_SIZE': 5000,
+    'MAX_ERRORS': 100,
+}
+
+
+class NDJSONParser(BaseParser):
+    """
+    Тело запроса в формате NDJSON не читается в память: представление получает поток и читает его построчно
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return stream
+
+
+class ImportReport:
+    """
+    Итог импорта: число записанных и отклоненных строк, причины отказов и первые ошибки с номерами строк
+    """
+
+    def __init__(self, max_errors=100):
+        self.max_errors = max_errors
+        self.imported = 0
+        self.rejected = 0
+        self.reasons = Counter()
+        self.errors = []
+        self.started = time.perf_counter()
+        self.seconds = 0
+
+    def reject(self, line_number, reason):
+        self.rejected += 1
+        self.reasons[reason] += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line_number, 'reason': reason})
+
+    @property
+    def rate(self):
+        return self.imported / self.seconds if self.seconds else 0
+
+    def as_dict(self):
+        return {
+            'imported': self.imported,
+            'rejected': self.rejected,
+            'reasons': dict(self.reasons),
+            'errors': self.errors,
+            'seconds': round(self.seconds, 3),
+            'rate': round(self.rate),
+        }
+
+
+class MessageImporter:
+    """
+    Массовый импорт сообщений из NDJSON (одно сообщение на строку):
+    {"channel": "general", "username": "user", "message": "текст", "timestamp": "2024-12-01T10:00:00Z"}
+
+    Пользователи и каналы сопоставляются по именам через словари, загруженные один раз. Сообщения
+    записываются bulk_create пакетами по BATCH_SIZE, каждый пакет в своей транзакции вместе
+    с обновлением счетчиков непрочитанных и данных каналов. Строки с ошибками пропускаются
+    и попадают в отчет.
+    """
+
+    def __init__(self, batch_size=5000, channel=None, create_channels=False, max_errors=100):
+        self.batch_size = batch_size
+        # Канал для строк без поля channel
+        self.channel = channel
+        self.create_channels = create_channels
+        self.max_errors = max_errors
+        self.progress = None
+
+    @classmethod
+    def from_settings(cls, **kwargs):
+        config = {**DEFAULTS, **getattr(settings, 'CHAT_IMPORT', {})}
+        return cls(batch_size=config['BATCH_SIZE'], max_errors=config['MAX_ERRORS'], **kwargs)
+
+    def run(self, lines):
+        """
+        Импортирует строки NDJSON (str или bytes) и возвращает ImportReport
+        """
+        report = ImportReport(self.max_errors)
+        users = dict(User.objects.values_list('username', 'id'))
+        channels = dict(Channel.objects.active().values_list('name', 'id'))
+
+        batch = []
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            message, reason = self.parse(line, users, channels)
+            if message is None:
+                report.reject(line_number, reason)
+                continue
+            batch.append(message)
+            if len(batch) >= self.batch_size:
+                self.write(batch, report)
+                batch = []
+        if batch:
+            self.write(batch, report)
+        report.seconds = time.perf_counter() - report.started
+        return report
+
+    def parse(self, line, users, channels):
+        """
+        Сообщение из строки или (None, причина отказа)
+        """
+        try:
+            data = decode_frame(line)
+        except ValueError:
+            return None, 'invalid_json'
+        if not isinstance(data, dict):
+            return None, 'invalid_json'
+
+        user_id = users.get(data.get('username'))
+        if user_id is None:
+            return None, 'unknown_user'
+        channel_id = self.get_channel_id(data.get('channel', self.channel), channels)
+        if channel_id is None:
+            return None, 'unknown_channel'
+        content = data.get('message', data.get('content'))
+        if not isinstance(content, str) or not content:
+            return None, 'empty_message'
+        try:
+            timestamp = datetime.fromisoformat(data['timestamp'])
+        except (KeyError, TypeError, ValueError):
+            return None, 'invalid_timestamp'
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp)
+        return Message(channel_id=channel_id, user_id=user_id, content=content, timestamp=timestamp), None
+
+    def get_channel_id(self, name, channels):
+        if not isinstance(name, str) or not name:
+            return None
+        channel_id = channels.get(name)
+        if channel_id is None and self.create_channels:
+            try:
+                channel_id = Channel.objects.create(name=name).id
+            except IntegrityError:
+                # Канал с таким названием создан другим запросом после загрузки словаря каналов
+                channel_id = Channel.objects.active().filter(name=name).values_list('id', flat=True).first()
+                if channel_id is None:
+                    return None
+            channels[name] = channel_id
+        return channel_id
+
+    def write(self, batch, report):
+        with transaction.atomic():
+            saved = Message.objects.bulk_create(batch)
+            unread.messages_created(saved)
+            activity.messages_created(saved)
+            channel_ids = {message.channel_id for message in saved}
+            transaction.on_commit(lambda: notify_messages_imported(channel_ids))
+        report.imported += len(saved)
+        if self.progress is not None:
+            self.progress(report)
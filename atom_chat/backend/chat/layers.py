@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import random
+import string
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer, InMemoryChannelLayer
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+# Пауза перед повторным чтением очереди процесса после ошибки, в секундах
+INBOX_RETRY_DELAY = 1
+# Емкость очереди процесса во внешнем channel layer: через нее идут сообщения всех групп и подключений процесса,
+# поэтому емкости канала по умолчанию (100) не хватает при всплеске сообщений
+INBOX_CAPACITY = 100000
+
+
+def _random_suffix():
+    return ''.join(random.choice(string.ascii_letters) for _ in range(12))
+
+
+class HybridChannelLayer(BaseChannelLayer):
+    """
+    Channel layer с доставкой внутри процесса в памяти.
+
+    Подключения процесса (каналы new_channel) и их группы хранятся в памяти процесса (InMemoryChannelLayer).
+    Во внешний channel layer (remote, обычно Redis) в группу добавляется не каждое подключение, а одна
+    очередь процесса. group_send доставляет сообщение подключениям своего процесса без внешнего
+    channel layer и публикует его один раз на каждый процесс с подписчиками группы; процесс-получатель
+    раздает сообщение своим подключениям сам. Каналы без имени процесса (например, воркеров) целиком
+    обслуживает внешний channel layer.
+    """
+    extensions = ['groups', 'flush']
+
+    def __init__(self, remote=None, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None,
+                 inbox_capacity=INBOX_CAPACITY, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        if remote is None:
+            remote = {'BACKEND': 'channels_redis.core.RedisChannelLayer'}
+        config = dict(remote.get('CONFIG', {}))
+        # Емкость очередей процессов, если она не задана в настройках внешнего channel layer явно
+        config['channel_capacity'] = {'hybrid.*': inbox_capacity, **config.get('channel_capacity', {})}
+        self.remote = import_string(remote['BACKEND'])(**config)
+        self.local = InMemoryChannelLayer(expiry=expiry, group_expiry=group_expiry, capacity=capacity,
+                                          channel_capacity=channel_capacity)
+        self.process_name = f'hybrid-{_random_suffix()}'
+        # Очередь процесса во внешнем channel layer
+        self.inbox = f'hybrid.{self.process_name}'
+        # Членство очереди процесса в группах внешнего channel layer продлевается чаще, чем истекает
+        self.group_refresh_interval = getattr(self.remote, 'group_expiry', group_expiry) / 2
+        # группа -> подключения процесса в группе
+        self._members = {}
+        self._reader = None
+        self._refresher = None
+
+    @staticmethod
+    def get_process_name(channel):
+        """
+        Имя процесса, которому принадлежит канал, или None для каналов внешнего channel layer
+        """
+        if '!' not in channel:
+            return None
+        owner = channel.split('!', 1)[0].rsplit('.', 1)[-1]
+        return owner if owner.startswith('hybrid-') else None
+
+    def is_local(self, channel):
+        return self.get_process_name(channel) == self.process_name
+
+    async def new_channel(self, prefix='specific.'):
+        return f"{prefix.rstrip('.')}.{self.process_name}!{_random_suffix()}"
+
+    async def send(self, channel, message):
+        owner = self.get_process_name(channel)
+        if owner == self.process_name:
+            await self.local.send(channel, message)
+        elif owner is not None:
+            # Подключение другого процесса: сообщение передается через очередь этого процесса
+            await self.remote.send(f'hybrid.{owner}', {'type': 'hybrid.send', 'channel': channel, 'message': message})
+        else:
+            await self.remote.send(channel, message)
+
+    async def receive(self, channel):
+        if not self.is_local(channel):
+            return await self.remote.receive(channel)
+        self._start_reader()
+        return await self.local.receive(channel)
+
+    async def group_add(self, group, channel):
+        if not self.is_local(channel):
+            await self.remote.group_add(group, channel)
+            return
+        self._start_reader()
+        await self.local.group_add(group, channel)
+        self._members.setdefault(group, set()).add(channel)
+        # Повторное добавление очереди процесса продлевает ее членство в группе (group_expiry)
+        await self.remote.group_add(group, self.inbox)
+
+    async def group_discard(self, group, channel):
+        if not self.is_local(channel):
+            await self.remote.group_discard(group, channel)
+            return
+        await self.local.group_discard(group, channel)
+        members = self._members.get(group)
+        if members is None:
+            return
+        members.discard(channel)
+        if members:
+            return
+        del self._members[group]
+        await self.remote.group_discard(group, self.inbox)
+        if self._members.get(group):
+            # Пока очередь удалялась из группы, в группу добавилось новое подключение процесса
+            await self.remote.group_add(group, self.inbox)
+
+    async def group_send(self, group, message):
+        await self.local.group_send(group, message)
+        await self.remote.group_send(group, {
+            'type': 'hybrid.group_send',
+            'group': group,
+            'origin': self.process_name,
+            'message': message,
+        })
+
+    async def flush(self):
+        await self.local.flush()
+        self._members.clear()
+        if hasattr(self.remote, 'flush'):
+            await self.remote.flush()
+
+    async def close(self):
+        for task in (self._reader, self._refresher):
+            if task is not None:
+                task.cancel()
+        self._reader = self._refresher = None
+        await self.remote.close()
+
+    def _start_reader(self):
+        loop = asyncio.get_running_loop()
+        # Задачи привязаны к циклу событий, в котором были созданы
+        if self._reader is None or self._reader.done() or self._reader.get_loop() is not loop:
+            self._reader = loop.create_task(self._read_inbox())
+        if self._refresher is None or self._refresher.done() or self._refresher.get_loop() is not loop:
+            self._refresher = loop.create_task(self._refresh_groups())
+
+    async def _refresh_groups(self):
+        """
+        Продлевает членство очереди процесса в группах, где у процесса есть подключения. Долгие подключения
+        (например, в группе пользователя) не вызывают group_add повторно, и без продления группа во внешнем
+        channel layer истекла бы через group_expiry, а сообщения других процессов перестали бы доставляться
+        """
+        while True:
+            await asyncio.sleep(self.group_refresh_interval)
+            for group, members in list(self._members.items()):
+                try:
+                    await self.remote.group_add(group, self.inbox)
+                    for channel in list(members):
+                        await self.local.group_add(group, channel)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Не удалось продлить членство очереди процесса %s в группе %s", self.inbox, group)
+
+    async def _read_inbox(self):
+        """
+        Раздает подключениям процесса сообщения из очереди процесса во внешнем channel layer
+        """
+        while True:
+            try:
+                envelope = await self.remote.receive(self.inbox)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Не удалось получить сообщения очереди процесса %s", self.inbox)
+                await asyncio.sleep(INBOX_RETRY_DELAY)
+                continue
+
+            try:
+                if envelope['type'] == 'hybrid.send':
+                    await self.local.send(envelope['channel'], envelope['message'])
+                elif envelope['origin'] != self.process_name:
+                    # Своим подключениям сообщение уже доставлено при отправке
+                    await self.local.group_send(envelope['group'], envelope['message'])
+            except ChannelFull:
+                logger.warning("Очередь подключения переполнена, сообщение отброшено")
+
+
+class SharedMemoryChannelLayer(InMemoryChannelLayer):
+    """
+    Channel layer в памяти, общий для всех экземпляров с одинаковым name.
+    Заменяет Redis в тестах HybridChannelLayer: несколько экземпляров HybridChannelLayer
+    с общим SharedMemoryChannelLayer ведут себя как процессы с общим Redis
+    """
+    _stores = {}
+
+    def __init__(self, name='default', **kwargs):
+        super().__init__(**kwargs)
+        # InMemoryChannelLayer ищет емкость по скомпилированным шаблонам, но сам их не компилирует
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.channels, self.groups = self._stores.setdefault(name, ({}, {}))
+
+    async def flush(self):
+        self.channels.clear()
+        self.groups.clear()
@@ -0,0 +1,160 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .shared import get_redis, make_key
+
+
+# Что делать с сообщением сверх лимита
+POLICY_DROP = 'drop'
+POLICY_WARN = 'warn'
+POLICY_CLOSE = 'close'
+
+DEFAULTS = {
+    'CONNECTION_RATE': 5,
+    'CONNECTION_BURST': 10,
+    'USER_RATE': 10,
+    'USER_BURST': 20,
+    'MAX_MESSAGE_SIZE': 4096,
+    'POLICY': POLICY_WARN,
+}
+
+# Корзина токенов в Redis: пополнение и списание одной атомарной операцией, время берется у Redis
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return allowed
+"""
+
+
+def get_limits_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_RATE_LIMIT', {})}
+
+
+class TokenBucket:
+    """
+    Корзина токенов: rate токенов в секунду, не более capacity
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, cost=1):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def is_full(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class LocalBucketStore:
+    """
+    Корзины токенов в памяти процесса (channel layer без Redis)
+    """
+    # Как часто удалять заполненные (неактивные) корзины
+    cleanup_every = 1000
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._operations = 0
+
+    async def take(self, key, rate, capacity, cost=1):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or (bucket.rate, bucket.capacity) != (rate, capacity):
+                bucket = self._buckets[key] = TokenBucket(rate, capacity)
+            allowed = bucket.take(cost)
+            self._operations += 1
+            if self._operations % self.cleanup_every == 0:
+                self._buckets = {key: bucket for key, bucket in self._buckets.items() if not bucket.is_full()}
+            return allowed
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+_local_store = LocalBucketStore()
+
+
+@receiver(setting_changed)
+def reset_buckets(setting, **kwargs):
+    if setting == 'CHAT_RATE_LIMIT':
+        _local_store.clear()
+
+
+async def take_shared(layer, key, rate, capacity, cost=1):
+    """
+    Списывает токены из общей для всех процессов корзины (в Redis channel layer или в памяти процесса)
+    """
+    redis = get_redis(layer, key)
+    if redis is None:
+        return await _local_store.take(key, rate, capacity, cost)
+    return bool(await redis.eval(TOKEN_BUCKET_SCRIPT, 1, make_key(layer, 'ratelimit', key), rate, capacity, cost))
+
+
+class MessageLimiter:
+    """
+    Ограничения входящих кадров одного WebSocket-подключения: размер кадра,
+    корзина подключения (в памяти) и корзина пользователя (общая для всех процессов)
+    """
+
+    def __init__(self, layer, user_id, config=None):
+        self.config = config or get_limits_config()
+        self.layer = layer
+        self.user_id = user_id
+        self.connection_bucket = None
+        if self.config['CONNECTION_RATE']:
+            self.connection_bucket = TokenBucket(self.config['CONNECTION_RATE'], self.config['CONNECTION_BURST'])
+
+    @property
+    def policy(self):
+        return self.config['POLICY']
+
+    def check_size(self, size):
+        """
+        Возвращает причину отказа или None
+        """
+        max_size = self.config['MAX_MESSAGE_SIZE']
+        if max_size and size > max_size:
+            return 'size'
+        return None
+
+    async def check_rate(self):
+        """
+        Списывает токен из корзин подключения и пользователя. Возвращает причину отказа или None
+        """
+        if self.connection_bucket is not None and not self.connection_bucket.take():
+            return 'connection_rate'
+        if self.config['USER_RATE']:
+            allowed = await take_shared(self.layer, f'user:{self.user_id}', self.config['USER_RATE'],
+                                        self.config['USER_BURST'])
+            if not allowed:
+                return 'user_rate'
+        return None
@@ -0,0 +1,82 @@
+import asyncio
+import json
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from chat.consumers import ChatConsumer
+from chat.protocol import encode_frame
+
+
+class Command(BaseCommand):
+    help = "Замер затрат CPU на рассылку одного сообщения в зависимости от размера группы"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1,10,100,1000,5000',
+                            help="Размеры группы через запятую")
+        parser.add_argument('--messages', type=int, default=20, help="Число сообщений на каждый размер группы")
+        parser.add_argument('--message-length', type=int, default=200, help="Длина текста сообщения")
+        parser.add_argument('--json', action='store_true', help="Вывести результат в формате JSON")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        results = asyncio.run(self.run(sizes, options['messages'], options['message_length']))
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(f"{'Группа':>8} {'Кодирование у получателя, мс':>30} {'Кодирование один раз, мс':>26}")
+        for row in results:
+            self.stdout.write(f"{row['group_size']:>8} {row['per_recipient_ms']:>30.3f} {row['once_ms']:>26.3f}")
+
+    async def run(self, sizes, messages, message_length):
+        results = []
+        for size in sizes:
+            results.append({
+                'group_size': size,
+                'per_recipient_ms': await self.measure(size, messages, message_length, encode_once=False),
+                'once_ms': await self.measure(size, messages, message_length, encode_once=True),
+            })
+        return results
+
+    async def measure(self, size, messages, message_length, encode_once):
+        """
+        Возвращает среднее процессорное время на одно сообщение, в миллисекундах
+        """
+        layer = InMemoryChannelLayer(capacity=messages + 1)
+        channels = [await layer.new_channel() for _ in range(size)]
+        for channel in channels:
+            await layer.group_add('bench', channel)
+
+        # Получатель, который отбрасывает отправленные кадры
+        consumer = ChatConsumer()
+        consumer.send = self.discard
+
+        text = 'x' * message_length
+        elapsed = 0
+        for _ in range(messages):
+            # Учитываем кодирование у отправителя и обработку у получателей,
+            # доставка через channel layer одинакова для обоих вариантов и не замеряется
+            started = time.process_time()
+            if encode_once:
+                event = {'type': 'chat_message', 'frame': encode_frame({'username': 'bench', 'message': text})}
+            else:
+                event = {'type': 'chat_message', 'username': 'bench', 'message': text}
+            elapsed += time.process_time() - started
+
+            await layer.group_send('bench', event)
+            events = [await layer.receive(channel) for channel in channels]
+
+            started = time.process_time()
+            for delivered in events:
+                await consumer.chat_message(delivered)
+            elapsed += time.process_time() - started
+
+        await layer.flush()
+        return elapsed * 1000 / messages
+
+    @staticmethod
+    async def discard(text_data=None, bytes_data=None, close=False):
+        pass
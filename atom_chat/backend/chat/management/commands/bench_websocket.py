@@ -0,0 +1,180 @@
+import asyncio
+import json
+import platform
+import statistics
+import time
+from collections import Counter
+
+import channels
+import django
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat import routing
+from chat.buffer import get_write_buffer
+from chat.middleware import JWTAuthMiddleware
+from chat.models import Channel
+from chat.protocol import decode_frame, encode_frame
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = ("Нагрузочный тест рассылки сообщений через WebSocket. "
+            "Использует временную тестовую базу данных и channel layer в памяти, Redis не нужен")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--channels', type=int, default=2, help="Число каналов")
+        parser.add_argument('--subscribers', type=int, default=50, help="Число слушателей в каждом канале")
+        parser.add_argument('--senders', type=int, default=2, help="Число отправителей в каждом канале")
+        parser.add_argument('--messages', type=int, default=50, help="Число сообщений от каждого отправителя")
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Пауза между сообщениями одного отправителя, в секундах")
+        parser.add_argument('--timeout', type=float, default=60,
+                            help="Максимальное время ожидания доставки, в секундах")
+        parser.add_argument('--output', help="Файл для результата в формате JSON (по умолчанию stdout)")
+
+    def handle(self, *args, **options):
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer',
+                                  'CONFIG': {'capacity': 1000000}}}
+            # Ограничения частоты отключены: отправители тестируют рассылку, а не CHAT_RATE_LIMIT
+            rate_limit = {'CONNECTION_RATE': 0, 'USER_RATE': 0}
+            with override_settings(CHANNEL_LAYERS=layers, CHAT_RATE_LIMIT=rate_limit):
+                result = asyncio.run(self.run(options))
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        report = json.dumps(result, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report + '\n')
+        else:
+            self.stdout.write(report)
+        if result['deliveries_lost']:
+            self.stderr.write(f"Не доставлено {result['deliveries_lost']} из {result['deliveries_expected']} кадров "
+                              f"(ошибки сервера: {result['errors'] or 'нет'})")
+
+    async def run(self, options):
+        channel_names, senders, subscribers = await self.create_data(
+            options['channels'], options['senders'], options['subscribers'])
+        application = JWTAuthMiddleware(URLRouter(routing.websocket_urlpatterns))
+
+        # Подключаем всех клиентов и пропускаем кадр с последними сообщениями
+        connections = []
+        for channel_name in channel_names:
+            for user, role in [(user, 'sender') for user in senders] + [(user, 'subscriber') for user in subscribers]:
+                communicator = WebsocketCommunicator(
+                    application, f"/ws/chat/{channel_name}/",
+                    headers=[(b'authorization', f'Bearer {AccessToken.for_user(user)}'.encode())])
+                connected, _ = await communicator.connect()
+                if not connected:
+                    raise RuntimeError(f"Не удалось подключиться к каналу {channel_name}")
+                await communicator.receive_from()
+                connections.append((channel_name, role, communicator))
+
+        # Каждое подключение канала получает все сообщения всех отправителей канала
+        expected = options['senders'] * options['messages']
+        latencies = []
+        errors = Counter()
+        started = time.perf_counter()
+        receivers = [asyncio.create_task(self.receive(communicator, expected, latencies, errors))
+                     for _, _, communicator in connections]
+        sends = [asyncio.create_task(self.send(communicator, options['messages'], options['interval']))
+                 for _, role, communicator in connections if role == 'sender']
+        await asyncio.gather(*sends)
+        done, pending = await asyncio.wait(receivers, timeout=options['timeout'])
+        elapsed = time.perf_counter() - started
+        for task in pending:
+            task.cancel()
+
+        await get_write_buffer().close()
+        for _, _, communicator in connections:
+            await communicator.disconnect()
+
+        sent = len(channel_names) * options['senders'] * options['messages']
+        deliveries_expected = len(connections) * expected
+        # Пропускная способность считается по доставленным кадрам: сообщение канала доставляется
+        # каждому подключению канала, потерянные и не дождавшиеся доставки кадры не учитываются
+        delivered = len(latencies) / (options['senders'] + options['subscribers'])
+        return {
+            'config': {name: options[name] for name in
+                       ('channels', 'subscribers', 'senders', 'messages', 'interval')},
+            'versions': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'channels': channels.__version__,
+            },
+            'messages_sent': sent,
+            'messages_delivered': round(delivered, 2),
+            'deliveries_expected': deliveries_expected,
+            'deliveries': len(latencies),
+            'deliveries_lost': deliveries_expected - len(latencies),
+            # Подключения, не получившие все сообщения до --timeout
+            'incomplete_connections': len(pending),
+            'errors': dict(errors),
+            'duration_s': round(elapsed, 4),
+            'messages_per_s': round(delivered / elapsed, 2),
+            'deliveries_per_s': round(len(latencies) / elapsed, 2),
+            'latency_ms': self.summarize(latencies),
+        }
+
+    @database_sync_to_async
+    def create_data(self, channel_count, sender_count, subscriber_count):
+        """
+        Создает каналы и пользователей (пароль хэшируется один раз на всех)
+        """
+        password = make_password(None)
+        users = User.objects.bulk_create([
+            User(username=f"bench_{role}_{index}", password=password)
+            for role, count in (('sender', sender_count), ('subscriber', subscriber_count))
+            for index in range(count)
+        ])
+        channels_ = Channel.objects.bulk_create([Channel(name=f"bench_{index}") for index in range(channel_count)])
+        return [channel.name for channel in channels_], users[:sender_count], users[sender_count:]
+
+    async def send(self, communicator, count, interval):
+        for sequence in range(count):
+            # Время отправки передается в тексте сообщения для расчета задержки доставки
+            await communicator.send_to(text_data=encode_frame({'message': f"{time.perf_counter()!r}:{sequence}"}))
+            if interval:
+                await asyncio.sleep(interval)
+            else:
+                await asyncio.sleep(0)
+
+    async def receive(self, communicator, expected, latencies, errors):
+        received = 0
+        while received < expected:
+            frame = decode_frame(await communicator.receive_from(timeout=3600))
+            if frame.get('type') == 'error':
+                errors[frame.get('reason')] += 1
+            if frame.get('type') != 'message':
+                continue
+            sent_at = float(frame['message'].split(':')[0])
+            latencies.append((time.perf_counter() - sent_at) * 1000)
+            received += 1
+
+    @staticmethod
+    def summarize(latencies):
+        if not latencies:
+            return None
+        ordered = sorted(latencies)
+
+        def percentile(value):
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * value / 100))], 3)
+
+        return {
+            'p50': percentile(50),
+            'p95': percentile(95),
+            'p99': percentile(99),
+            'max': round(ordered[-1], 3),
+            'mean': round(statistics.fmean(ordered), 3),
+        }
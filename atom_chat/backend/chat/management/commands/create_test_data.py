@@ -1,21 +1,59 @@
+import math
 import random
+import string
+import time
+from datetime import timedelta
+
 from django.contrib.auth import get_user_model
-from django.core.management.base import BaseCommand
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
 from chat import models
+from chat.activity import rebuild_channel_activity
+from chat.unread import rebuild_unread_counts
 
 User = get_user_model()
 
+# Пароль всех сгенерированных пользователей (хэшируется один раз)
+GENERATED_PASSWORD = "loadpassword"
+
+
 class Command(BaseCommand):
-    help = "Создание тестовых данных для приложения Chat"
+    help = ("Создание тестовых данных для приложения Chat. "
+            "Объем задается параметрами, строки вставляются пакетами через bulk_create")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=0,
+                            help="Число дополнительных сгенерированных пользователей (load_user_N)")
+        parser.add_argument('--channels', type=int, default=0,
+                            help="Число дополнительных сгенерированных каналов (load_channel_N)")
+        parser.add_argument('--messages', type=int, default=30, help="Общее число сообщений")
+        parser.add_argument('--min-length', type=int, default=10, help="Минимальная длина сообщения")
+        parser.add_argument('--max-length', type=int, default=200, help="Максимальная длина сообщения")
+        parser.add_argument('--size-distribution', choices=('uniform', 'lognormal'), default='lognormal',
+                            help="Распределение длин сообщений")
+        parser.add_argument('--days', type=float, default=30,
+                            help="За сколько последних дней распределить время сообщений")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Размер пакета bulk_create")
+        parser.add_argument('--seed', type=int, help="Начальное значение генератора случайных чисел")
 
-    def handle(self, *args, **kwargs):
-        self.create_users()
-        self.create_channels()
-        self.create_messages()
+    def handle(self, *args, **options):
+        if options['min_length'] < 1 or options['max_length'] < options['min_length']:
+            raise CommandError("Должно выполняться 1 <= --min-length <= --max-length")
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size должен быть положительным")
+
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+
+        self.create_users(options['users'])
+        self.create_channels(options['channels'])
+        self.create_messages(options)
         self.stdout.write(self.style.SUCCESS("Тестовые данные успешно созданы."))
 
     # Создание пользователей
-    def create_users(self):
+    def create_users(self, count):
         self.stdout.write("Создаём тестовых пользователей...")
         user_data = [
             {"username": "user11", "email": "user11@example.com", "password": "password11", "is_moderator": False},
@@ -28,42 +66,104 @@ class Command(BaseCommand):
             {"username": "moderator12", "email": "moderator12@example.com", "password": "moderatorpassword12",
              "is_moderator": True, "is_staff": True},
         ]
-        for data in user_data:
-            user, created = User.objects.get_or_create(username=data['username'], defaults=data)
-            if created:
-                user.set_password(data['password'])
-                user.save()
-                self.stdout.write(f"Пользователь {data['username']} создан.")
-            else:
-                self.stdout.write(f"Пользователь {data['username']} уже существует.")
+        # Хэширование пароля медленное: хэшируем только для еще не созданных пользователей
+        existing = set(User.objects.filter(username__in=[data['username'] for data in user_data])
+                       .values_list('username', flat=True))
+        rows = [User(**dict(data, password=make_password(data['password'])))
+                for data in user_data if data['username'] not in existing]
+
+        password = make_password(GENERATED_PASSWORD)
+        rows.extend(User(username=f"load_user_{index}", email=f"load_user_{index}@example.com", password=password)
+                    for index in range(count))
+        self.bulk_insert(User, rows, "Пользователи")
 
     # Создание каналов
-    def create_channels(self):
+    def create_channels(self, count):
         self.stdout.write("Создаём тестовые каналы...")
         channel_data = [
             {"name": "general", "description": "Общий канал для общения."},
             {"name": "random", "description": "Случайные обсуждения."},
             {"name": "tech", "description": "Технический канал."},
         ]
-        for data in channel_data:
-            channel, created = models.Channel.objects.get_or_create(name=data['name'], defaults=data)
-            if created:
-                self.stdout.write(f"Канал {data['name']} создан.")
-            else:
-                self.stdout.write(f"Канал {data['name']} уже существует.")
+        rows = [models.Channel(**data) for data in channel_data]
+        rows.extend(models.Channel(name=f"load_channel_{index}", description="Сгенерированный канал.")
+                    for index in range(count))
+        self.bulk_insert(models.Channel, rows, "Каналы")
 
     # Создание сообщений
-    def create_messages(self):
+    def create_messages(self, options):
+        count = options['messages']
         self.stdout.write("Создаём тестовые сообщения...")
-        users = User.objects.all()
-        channels = models.Channel.objects.all()
-        if not users.exists() or not channels.exists():
+        user_ids = list(User.objects.values_list('id', flat=True))
+        channel_ids = list(models.Channel.objects.active().values_list('id', flat=True))
+        if not user_ids or not channel_ids or count < 1:
             self.stdout.write("Недостаточно данных для создания сообщений.")
             return
 
-        for channel in channels:
-            for _ in range(10):  # Создаём 10 сообщений на канал
-                user = random.choice(users)
-                message_content = f"Сообщение от {user.username} в {channel.name}"
-                models.Message.objects.create(user=user, channel=channel, content=message_content)
-                self.stdout.write(f"Сообщение создано: {message_content}")
+        # Текст сообщения — срез заранее сгенерированной строки, длина выбирается по распределению
+        alphabet = string.ascii_letters + string.digits + "      "
+        text = ''.join(self.random.choices(alphabet, k=options['max_length'] * 2))
+        next_length = self.length_generator(options['min_length'], options['max_length'],
+                                            options['size_distribution'])
+
+        # Время растет вместе с id, как при обычной отправке сообщений
+        step = timedelta(days=options['days']) / count
+        started_at = timezone.now() - timedelta(days=options['days'])
+
+        def generate():
+            for index in range(count):
+                length = next_length()
+                offset = self.random.randrange(len(text) - length + 1)
+                yield models.Message(
+                    user_id=self.random.choice(user_ids),
+                    channel_id=self.random.choice(channel_ids),
+                    content=text[offset:offset + length],
+                    timestamp=started_at + step * index,
+                )
+
+        self.bulk_insert(models.Message, generate(), "Сообщения", total=count)
+        # Счетчики непрочитанных и данные о последних сообщениях каналов пересчитываются
+        # один раз после загрузки, а не для каждого пакета
+        rebuild_unread_counts()
+        rebuild_channel_activity()
+
+    def length_generator(self, min_length, max_length, distribution):
+        if distribution == 'uniform':
+            return lambda: self.random.randint(min_length, max_length)
+
+        # Логнормальное: большинство сообщений короткие, редкие — длинные
+        mu = math.log(max(min_length, (min_length + max_length) / 4))
+        return lambda: min(max_length, max(min_length, int(self.random.lognormvariate(mu, 0.8))))
+
+    def bulk_insert(self, model, rows, label, total=None):
+        """
+        Вставляет строки пакетами по batch_size, каждый пакет в своей транзакции.
+        Уже существующие пользователи и каналы (по уникальному имени) пропускаются
+        """
+        ignore_conflicts = model is not models.Message
+        # С ignore_conflicts bulk_create не сообщает, сколько строк пропущено: записанные считаются по COUNT(*)
+        before = model.objects.count() if ignore_conflicts else None
+        started = time.perf_counter()
+        processed = 0
+        batch = []
+
+        def flush():
+            with transaction.atomic():
+                model.objects.bulk_create(batch, ignore_conflicts=ignore_conflicts)
+
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                flush()
+                processed += len(batch)
+                batch = []
+                if total and processed % (self.batch_size * 10) == 0:
+                    self.stdout.write(f"  {label}: {processed} из {total}")
+        if batch:
+            flush()
+            processed += len(batch)
+
+        elapsed = time.perf_counter() - started
+        inserted = model.objects.count() - before if ignore_conflicts else processed
+        self.stdout.write(f"{label}: обработано {processed} строк, записано {inserted}, за {elapsed:.2f} с "
+                          f"({processed / elapsed if elapsed else 0:.0f} строк/с)")
@@ -0,0 +1,49 @@
+import gzip
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.importer import MessageImporter
+
+
+class Command(BaseCommand):
+    help = ("Массовый импорт сообщений из файла NDJSON (одно сообщение на строку: channel, username, message, "
+            "timestamp). Сообщения записываются пакетами через bulk_create")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Файл NDJSON (.gz — сжатый) или - для чтения из stdin")
+        parser.add_argument('--channel', help="Канал для строк без поля channel")
+        parser.add_argument('--create-channels', action='store_true', help="Создавать отсутствующие каналы")
+        parser.add_argument('--batch-size', type=int, help="Размер пакета bulk_create (по умолчанию из CHAT_IMPORT)")
+
+    def handle(self, *args, **options):
+        importer = MessageImporter.from_settings(channel=options['channel'],
+                                                 create_channels=options['create_channels'])
+        if options['batch_size'] is not None:
+            if options['batch_size'] < 1:
+                raise CommandError("--batch-size должен быть положительным")
+            importer.batch_size = options['batch_size']
+
+        def progress(report):
+            if report.imported % (importer.batch_size * 10) == 0:
+                self.stdout.write(f"  Импортировано {report.imported}, отклонено {report.rejected}")
+        importer.progress = progress
+
+        path = options['path']
+        if path == '-':
+            report = importer.run(sys.stdin.buffer)
+        else:
+            opener = gzip.open if path.endswith('.gz') else open
+            try:
+                with opener(path, 'rb') as lines:
+                    report = importer.run(lines)
+            except FileNotFoundError:
+                raise CommandError(f"Файл не найден: {path}")
+
+        for reason, count in sorted(report.reasons.items()):
+            self.stdout.write(f"Отклонено ({reason}): {count}")
+        for error in report.errors[:10]:
+            self.stdout.write(f"  строка {error['line']}: {error['reason']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Импортировано {report.imported} сообщений, отклонено {report.rejected} строк за {report.seconds:.2f} с "
+            f"({report.rate:.0f} сообщений/с)"))
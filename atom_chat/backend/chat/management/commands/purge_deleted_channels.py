@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import ChannelPurge, MessagePurge
+from chat.purge import get_channel_purger
+
+
+class Command(BaseCommand):
+    help = ("Завершает незавершенные очистки удаленных каналов и массовые удаления сообщений "
+            "(например, прерванные перезапуском процесса)")
+
+    def handle(self, *args, **options):
+        purge_ids, message_purge_ids = get_channel_purger().resume()
+        for purge in ChannelPurge.objects.filter(id__in=purge_ids).order_by('id'):
+            self.stdout.write(f"{purge.channel_name}: {purge.status}, удалено сообщений {purge.deleted}")
+        for purge in MessagePurge.objects.filter(id__in=message_purge_ids).order_by('id'):
+            self.stdout.write(f"Массовое удаление {purge.id}: {purge.status}, удалено сообщений {purge.deleted}")
+        self.stdout.write(self.style.SUCCESS(f"Обработано очисток: {len(purge_ids) + len(message_purge_ids)}"))
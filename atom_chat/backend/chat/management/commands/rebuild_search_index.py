@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.models import Message
+from chat.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = "Перестроение полнотекстового индекса сообщений"
+
+    def handle(self, *args, **kwargs):
+        self.stdout.write("Перестраиваем полнотекстовый индекс...")
+        started = time.monotonic()
+        if not rebuild_search_index():
+            self.stdout.write("Полнотекстовый индекс поддерживается только для SQLite.")
+            return
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Индекс перестроен: {Message.objects.count()} сообщений за {elapsed:.1f} с."
+        ))
@@ -0,0 +1,264 @@
+import bisect
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+_enabled = None
+
+
+def is_enabled():
+    """
+    Включен ли сбор метрик (CHAT_METRICS_ENABLED). При выключенном сборе метрики не изменяются
+    """
+    global _enabled
+    if _enabled is None:
+        _enabled = getattr(settings, 'CHAT_METRICS_ENABLED', False)
+    return _enabled
+
+
+@receiver(setting_changed)
+def reset_enabled(setting, **kwargs):
+    global _enabled
+    if setting == 'CHAT_METRICS_ENABLED':
+        _enabled = None
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not is_enabled():
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        if not is_enabled():
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        if not is_enabled():
+            return
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not is_enabled():
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Счетчики по корзинам (последняя — +Inf), сумма и количество
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        """
+        Контекстный менеджер для замера длительности блока кода (в секундах)
+        """
+        return _Timer(self, labels)
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class _Timer:
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter() if is_enabled() else None
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.started is not None:
+            self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Метрики в текстовом формате Prometheus
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+
+registry = Registry()
+
+# WebSocket
+WS_CONNECTIONS = registry.register(Counter(
+    'chat_ws_connections_total', 'Попытки подключения к WebSocket', ['result']))
+WS_DISCONNECTIONS = registry.register(Counter(
+    'chat_ws_disconnections_total', 'Закрытые WebSocket-подключения'))
+WS_ACTIVE_CONNECTIONS = registry.register(Gauge(
+    'chat_ws_active_connections', 'Открытые WebSocket-подключения'))
+WS_AUTH = registry.register(Counter(
+    'chat_ws_auth_total', 'Аутентификация WebSocket-подключений по JWT', ['result']))
+WS_MESSAGES_RECEIVED = registry.register(Counter(
+    'chat_ws_messages_received_total', 'Сообщения, полученные от клиентов'))
+WS_MESSAGES_LIMITED = registry.register(Counter(
+    'chat_ws_messages_limited_total', 'Сообщения, отклоненные ограничениями размера и частоты', ['reason']))
+WS_MESSAGES_BROADCAST = registry.register(Counter(
+    'chat_ws_messages_broadcast_total', 'Сообщения, разосланные в группы каналов'))
+WS_TYPING_RECEIVED = registry.register(Counter(
+    'chat_ws_typing_received_total', 'События набора текста, полученные от клиентов'))
+WS_TYPING_BROADCAST = registry.register(Counter(
+    'chat_ws_typing_broadcast_total', 'Объединенные уведомления о наборе текста, разосланные в группы каналов'))
+WS_FRAMES_SENT = registry.register(Counter(
+    'chat_ws_frames_sent_total', 'Кадры с сообщениями, отправленные клиентам'))
+MESSAGE_SAVE_SECONDS = registry.register(Histogram(
+    'chat_message_save_seconds', 'Время от постановки сообщения в очередь до его записи в базу данных'))
+GROUP_SEND_SECONDS = registry.register(Histogram(
+    'chat_group_send_seconds', 'Длительность group_send'))
+WRITE_BATCH_SIZE = registry.register(Histogram(
+    'chat_write_batch_size', 'Число сообщений в одном пакете записи', buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)))
+
+# Пул запросов к базе данных для WebSocket
+DB_EXECUTOR_QUEUE_DEPTH = registry.register(Gauge(
+    'chat_db_executor_queue_depth', 'Запросы к базе данных, ожидающие свободного потока'))
+DB_EXECUTOR_WAIT_SECONDS = registry.register(Histogram(
+    'chat_db_executor_wait_seconds', 'Время ожидания свободного потока для запроса к базе данных'))
+DB_EXECUTOR_REJECTED = registry.register(Counter(
+    'chat_db_executor_rejected_total', 'Запросы к базе данных, отклоненные из-за заполненной очереди'))
+
+# REST
+HTTP_REQUEST_SECONDS = registry.register(Histogram(
+    'chat_http_request_seconds', 'Длительность обработки HTTP-запроса', ['view', 'method', 'status']))
+HTTP_DB_QUERIES = registry.register(Histogram(
+    'chat_http_db_queries', 'Число SQL-запросов на один HTTP-запрос', ['view'], buckets=QUERY_COUNT_BUCKETS))
+
+
+class MetricsMiddleware:
+    """
+    Замер длительности и числа SQL-запросов для каждого представления
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not is_enabled():
+            return self.get_response(request)
+
+        queries = [0]
+
+        def count_queries(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count_queries):
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(elapsed, view=view, method=request.method, status=response.status_code)
+        HTTP_DB_QUERIES.observe(queries[0], view=view)
+        return response
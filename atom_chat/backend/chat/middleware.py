@@ -2,14 +2,17 @@ from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.tokens import UntypedToken
 from channels.auth import BaseMiddleware
-from asgiref.sync import sync_to_async
 from jwt import InvalidTokenError, DecodeError
 
+from .cache import get_user_cache
+from .executor import DatabaseBusy, database_async
+from . import metrics
+
 
 User = get_user_model()
 
 
-@sync_to_async
+@database_async
 def get_user_from_jwt(validated_token):
     """
     Извлекает пользователя из валидного токена
@@ -21,6 +24,22 @@ def get_user_from_jwt(validated_token):
         return AnonymousUser()
 
 
+async def get_user(validated_token):
+    """
+    Возвращает пользователя токена, по возможности без обращения к базе данных
+    """
+    user_cache = get_user_cache()
+    user = user_cache.get(validated_token.get("user_id"))
+    if user is not None:
+        metrics.WS_AUTH.inc(result='cache_hit')
+        return user
+    metrics.WS_AUTH.inc(result='cache_miss')
+    user = await get_user_from_jwt(validated_token)
+    if user.is_authenticated:
+        user_cache.set(user.id, user)
+    return user
+
+
 class JWTAuthMiddleware(BaseMiddleware):
     """
     Для аутентификации пользователя по JWT-токену
@@ -39,11 +58,17 @@ class JWTAuthMiddleware(BaseMiddleware):
             try:
                 # Валидация токена
                 validated_token = UntypedToken(token)
-                user = await get_user_from_jwt(validated_token)
+                user = await get_user(validated_token)
                 scope['user'] = user
             except (InvalidTokenError, DecodeError, KeyError):
+                metrics.WS_AUTH.inc(result='invalid')
+                scope['user'] = AnonymousUser()
+            except DatabaseBusy:
+                # Подключение будет отклонено, клиент повторит попытку позже
+                metrics.WS_AUTH.inc(result='busy')
                 scope['user'] = AnonymousUser()
         else:
+            metrics.WS_AUTH.inc(result='anonymous')
             scope['user'] = AnonymousUser()
 
         return await super().__call__(scope, receive, send)
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.3 on 2026-10-18 15:43
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+# На SQLite изменение поля пересоздает таблицу chat_message, а вместе со старой таблицей
+# удаляются триггеры полнотекстового индекса. Создаем их заново (индекс не меняется: id сохраняются)
+
+
+def restore_search_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    from importlib import import_module
+    search_index = import_module('chat.migrations.0005_message_search_index')
+    for sql in search_index.CREATE_SQL:
+        if 'CREATE TRIGGER' in sql:
+            schema_editor.execute(sql.replace('CREATE TRIGGER', 'CREATE TRIGGER IF NOT EXISTS'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+    ]
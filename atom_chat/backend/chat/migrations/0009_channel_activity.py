@@ -0,0 +1,54 @@
+# Generated by Django 5.1.3 on 2026-10-18 15:59
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Left
+
+
+def fill_channel_activity(apps, schema_editor):
+    Channel = apps.get_model('chat', 'Channel')
+    Message = apps.get_model('chat', 'Message')
+    messages = Message.objects.filter(channel_id=OuterRef('id')).order_by()
+    last = messages.order_by('-id')
+    Channel.objects.update(
+        message_count=Coalesce(Subquery(messages.values('channel_id').annotate(count=Count('id')).values('count')), 0),
+        last_message_id=Subquery(last.values('id')[:1]),
+        last_message_at=Subquery(last.values('timestamp')[:1]),
+        last_message_preview=Coalesce(Subquery(last.annotate(preview=Left('content', 100)).values('preview')[:1]),
+                                      Value('')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_read_marker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='last_message_id',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='last_message_preview',
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='channel',
+            index=models.Index(fields=['last_message_at'], name='chat_channel_last_msg_idx'),
+        ),
+        migrations.RunPython(fill_channel_activity, migrations.RunPython.noop),
+    ]
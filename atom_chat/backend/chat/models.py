@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AbstractUser
 
@@ -16,23 +17,169 @@ class CustomUser(AbstractUser):
 User = get_user_model()
 
 
+class ChannelQuerySet(models.QuerySet):
+
+    def active(self):
+        """
+        Каналы, не помеченные как удаленные
+        """
+        return self.filter(is_deleted=False)
+
+    def touch(self, **fields):
+        """
+        Обновляет поля каналов одним UPDATE и увеличивает их версию
+        """
+        return self.update(version=models.F('version') + 1, updated_at=timezone.now(), **fields)
+
+
 class Channel(models.Model):
     name = models.CharField(max_length=255, unique=True)
     description = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Канал помечается удаленным сразу, строка удаляется после фоновой очистки сообщений
+    is_deleted = models.BooleanField(default=False)
+    # Денормализованные данные о сообщениях канала, обновляются при записи и удалении сообщений
+    message_count = models.PositiveIntegerField(default=0, editable=False)
+    last_message_id = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+    last_message_at = models.DateTimeField(null=True, blank=True, editable=False)
+    last_message_preview = models.CharField(max_length=100, blank=True, editable=False)
+    # Версия и время последнего изменения канала или его сообщений (для условных GET-запросов)
+    version = models.PositiveBigIntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ChannelQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Для сортировки каналов по последней активности
+            models.Index(fields=['last_message_at'], name='chat_channel_last_msg_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    def get_deleted_name(self):
+        """
+        Название удаленного канала: исходное название сразу освобождается для нового канала
+        """
+        suffix = f'#deleted-{self.id}'
+        return self.name[:self._meta.get_field('name').max_length - len(suffix)] + suffix
+
 
 class Message(models.Model):
     channel = models.ForeignKey(Channel, related_name="messages", on_delete=models.CASCADE)
     user = models.ForeignKey(User, related_name="messages", on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Время создания можно передать явно (генерация тестовых данных, импорт истории)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Для курсорной пагинации истории канала
+            models.Index(fields=['channel', 'timestamp', 'id'], name='chat_msg_channel_ts_id_idx'),
+        ]
 
     def __str__(self):
         return f"Message by {self.user.username} in {self.channel.name}"
+
+
+class ChannelPurge(models.Model):
+    """
+    Фоновое удаление сообщений удаленного канала пакетами
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Ожидает'),
+        (STATUS_RUNNING, 'Выполняется'),
+        (STATUS_DONE, 'Завершено'),
+        (STATUS_FAILED, 'Ошибка'),
+    ]
+
+    # После завершения очистки канал удаляется, запись о ней остается
+    channel = models.ForeignKey(Channel, related_name="purges", null=True, on_delete=models.SET_NULL)
+    channel_name = models.CharField(max_length=255)
+    requested_by = models.ForeignKey(User, related_name="+", null=True, on_delete=models.SET_NULL)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    # Число сообщений канала на момент начала очистки и число уже удаленных
+    total = models.PositiveIntegerField(default=0)
+    deleted = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-id']
+
+    def __str__(self):
+        return f"Purge of {self.channel_name} ({self.status})"
+
+
+class MessagePurge(models.Model):
+    """
+    Фоновое массовое удаление сообщений модератором по автору, каналам и интервалу времени
+    """
+    STATUS_CHOICES = ChannelPurge.STATUS_CHOICES
+
+    requested_by = models.ForeignKey(User, related_name="+", null=True, on_delete=models.SET_NULL)
+    # Условия удаления; пустое условие не ограничивает выборку.
+    # id каналов хранятся списком: каналы могут быть удалены раньше, чем закончится очистка
+    user = models.ForeignKey(User, related_name="+", null=True, blank=True, on_delete=models.CASCADE)
+    channel_ids = models.JSONField(null=True, blank=True)
+    since = models.DateTimeField(null=True, blank=True)
+    until = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=ChannelPurge.STATUS_PENDING)
+    # Число подходящих сообщений на момент начала очистки и число уже удаленных
+    total = models.PositiveIntegerField(default=0)
+    deleted = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-id']
+
+    def __str__(self):
+        return f"Message purge {self.id} ({self.status})"
+
+    def get_messages(self):
+        """
+        Сообщения, подходящие под условия
+        """
+        messages = Message.objects.all()
+        if self.user_id is not None:
+            messages = messages.filter(user_id=self.user_id)
+        if self.channel_ids is not None:
+            messages = messages.filter(channel_id__in=self.channel_ids)
+        if self.since is not None:
+            messages = messages.filter(timestamp__gte=self.since)
+        if self.until is not None:
+            messages = messages.filter(timestamp__lt=self.until)
+        return messages
+
+
+class ReadMarker(models.Model):
+    """
+    Отметка о прочтении канала пользователем и счетчик непрочитанных сообщений.
+    Счетчик изменяется при записи и удалении сообщений, поэтому для его получения не нужен COUNT(*)
+    """
+    user = models.ForeignKey(User, related_name="read_markers", on_delete=models.CASCADE)
+    channel = models.ForeignKey(Channel, related_name="read_markers", on_delete=models.CASCADE)
+    # id последнего прочитанного сообщения (0 — канал еще не читался)
+    last_read_message_id = models.PositiveBigIntegerField(default=0)
+    # Непрочитанные сообщения других пользователей с id больше last_read_message_id
+    unread_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'channel'], name='chat_read_marker_user_channel_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} read {self.channel_id} up to {self.last_read_message_id}"
@@ -0,0 +1,152 @@
+import base64
+from datetime import datetime, timedelta, timezone
+
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+from .history import entry_key
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(timestamp, message_id):
+    """
+    Курсор истории: время (в микросекундах) и id сообщения, как в порядке истории
+    """
+    micros = (timestamp - EPOCH) // timedelta(microseconds=1)
+    return base64.urlsafe_b64encode(f'{micros}:{message_id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    micros, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+    return EPOCH + timedelta(microseconds=int(micros)), int(message_id)
+
+
+def filter_before(queryset, timestamp, message_id):
+    """
+    Сообщения раньше (timestamp, message_id) в порядке истории
+    """
+    return queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id))
+
+
+def filter_after(queryset, timestamp, message_id):
+    """
+    Сообщения позже (timestamp, message_id) в порядке истории
+    """
+    return queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id))
+
+
+class MessageKeysetPagination(BasePagination):
+    """
+    Курсорная (keyset) пагинация истории сообщений.
+
+    Включается, если в запросе передан хотя бы один из параметров before, after или page_size.
+    Курсор содержит время и id сообщения, страница выбирается по индексу (channel, timestamp, id),
+    поэтому стоимость запроса не зависит от того, насколько далеко страница от начала истории.
+    Вместо курсора можно передать id существующего сообщения.
+    """
+    before_query_param = 'before'
+    after_query_param = 'after'
+    page_size_query_param = 'page_size'
+    page_size = 50
+    max_page_size = 200
+
+    def is_enabled(self, request):
+        params = request.query_params
+        return any(name in params for name in (self.before_query_param, self.after_query_param,
+                                               self.page_size_query_param))
+
+    def paginate_recent(self, recent_messages, channel_id, request):
+        """
+        Возвращает последнюю страницу истории из буфера последних сообщений
+        (уже сериализованные сообщения) или None, если буфер не может ее обслужить
+        """
+        params = request.query_params
+        if not self.is_enabled(request) or self.before_query_param in params or self.after_query_param in params:
+            return None
+
+        page_size = self.get_page_size(request)
+        rows = recent_messages.newest(channel_id, page_size + 1)
+        if rows is None:
+            return None
+
+        self.page_size = page_size
+        page = rows[-page_size:]
+        self.set_cursors([entry_key(entry) for entry in page], has_older=len(rows) > page_size, has_newer=False)
+        return page
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.is_enabled(request):
+            # Без параметров курсора сохраняем прежнее поведение (вся история)
+            return None
+
+        self.page_size = self.get_page_size(request)
+        if self.before_query_param in request.query_params and self.after_query_param in request.query_params:
+            raise ValidationError({"Ошибка": "Нельзя одновременно указывать before и after"})
+        before = self.get_cursor(queryset, request, self.before_query_param)
+        after = self.get_cursor(queryset, request, self.after_query_param)
+
+        # Для выборки лишней строки, чтобы понять, есть ли следующая страница
+        limit = self.page_size + 1
+
+        if after is not None:
+            rows = list(filter_after(queryset, *after).order_by('timestamp', 'id')[:limit])
+            page = rows[:self.page_size]
+            self.set_cursors([(message.timestamp, message.id) for message in page], has_older=True,
+                             has_newer=len(rows) > self.page_size)
+        else:
+            if before is not None:
+                queryset = filter_before(queryset, *before)
+            rows = list(queryset.order_by('-timestamp', '-id')[:limit])
+            page = rows[:self.page_size][::-1]
+            self.set_cursors([(message.timestamp, message.id) for message in page],
+                             has_older=len(rows) > self.page_size, has_newer=before is not None)
+
+        return page
+
+    def set_cursors(self, keys, has_older, has_newer):
+        """
+        Запоминает курсоры соседних страниц по ключам (timestamp, id) сообщений страницы
+        """
+        self.previous = encode_cursor(*keys[0]) if keys and has_older else None
+        self.next = encode_cursor(*keys[-1]) if keys and has_newer else None
+
+    def get_paginated_response(self, data):
+        return Response({
+            'previous': self.previous,
+            'next': self.next,
+            'results': data,
+        })
+
+    def get_page_size(self, request):
+        value = request.query_params.get(self.page_size_query_param)
+        if value is None:
+            return self.page_size
+        try:
+            page_size = int(value)
+        except ValueError:
+            raise ValidationError({"Ошибка": "page_size должен быть целым числом"})
+        if page_size < 1:
+            raise ValidationError({"Ошибка": "page_size должен быть положительным"})
+        return min(page_size, self.max_page_size)
+
+    def get_cursor(self, queryset, request, name):
+        """
+        Возвращает ключ (timestamp, id) из курсора или из id сообщения (поиск по первичному ключу)
+        """
+        value = request.query_params.get(name)
+        if value is None:
+            return None
+        if value.isdigit():
+            # Порядок id не совпадает с порядком времени, поэтому без сообщения его место в истории неизвестно
+            timestamp = queryset.filter(id=int(value)).values_list('timestamp', flat=True).first()
+            if timestamp is None:
+                raise ValidationError({"Ошибка": f"Сообщение {value} не найдено, используйте курсор страницы"})
+            return timestamp, int(value)
+        try:
+            return decode_cursor(value)
+        except (ValueError, OverflowError):
+            raise ValidationError({"Ошибка": f"{name} должен быть курсором страницы или id сообщения"})
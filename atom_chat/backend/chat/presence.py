@@ -0,0 +1,359 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .events import get_group_name
+from .protocol import encode_frames
+from .shared import get_redis, make_key
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'HEARTBEAT_INTERVAL': 30,
+    'TTL': 90,
+    'DEBOUNCE': 1.0,
+}
+
+# Все скрипты выполняются атомарно; время берется у Redis, чтобы часы процессов не влияли на истечение.
+# KEYS: подключения (ZSET подключение -> срок), владельцы (HASH подключение -> id пользователя),
+# пользователи (HASH id -> число подключений), имена (HASH id -> имя пользователя)
+_REDIS_NOW = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+"""
+
+_REDIS_DROP = """
+local function drop(connection)
+    local user_id = redis.call('HGET', KEYS[2], connection)
+    redis.call('ZREM', KEYS[1], connection)
+    redis.call('HDEL', KEYS[2], connection)
+    if not user_id then
+        return nil
+    end
+    if redis.call('HINCRBY', KEYS[3], user_id, -1) > 0 then
+        return nil
+    end
+    local username = redis.call('HGET', KEYS[4], user_id)
+    redis.call('HDEL', KEYS[3], user_id)
+    redis.call('HDEL', KEYS[4], user_id)
+    return {user_id, username}
+end
+"""
+
+JOIN_SCRIPT = _REDIS_NOW + """
+local ttl = tonumber(ARGV[4])
+redis.call('ZADD', KEYS[1], now + ttl, ARGV[1])
+local joined = 0
+if redis.call('HSETNX', KEYS[2], ARGV[1], ARGV[2]) == 1 then
+    if redis.call('HINCRBY', KEYS[3], ARGV[2], 1) == 1 then
+        redis.call('HSET', KEYS[4], ARGV[2], ARGV[3])
+        joined = 1
+    end
+end
+for i = 1, 4 do
+    redis.call('EXPIRE', KEYS[i], math.ceil(ttl) * 2)
+end
+return joined
+"""
+
+HEARTBEAT_SCRIPT = _REDIS_NOW + """
+local ttl = tonumber(ARGV[2])
+redis.call('ZADD', KEYS[1], 'XX', now + ttl, ARGV[1])
+for i = 1, 4 do
+    redis.call('EXPIRE', KEYS[i], math.ceil(ttl) * 2)
+end
+"""
+
+LEAVE_SCRIPT = _REDIS_DROP + """
+return drop(ARGV[1]) or {}
+"""
+
+EXPIRE_SCRIPT = _REDIS_NOW + _REDIS_DROP + """
+local gone = {}
+for _, connection in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now)) do
+    local user = drop(connection)
+    if user then
+        table.insert(gone, user[1])
+        table.insert(gone, user[2])
+    end
+end
+return gone
+"""
+
+
+class ChannelPresence:
+    """
+    Подключения к одному каналу в памяти процесса.
+    Подключения упорядочены по последнему сигналу присутствия, поэтому истекшие всегда в начале
+    """
+
+    def __init__(self):
+        # подключение -> (id пользователя, срок истечения)
+        self.connections = OrderedDict()
+        # id пользователя -> [число подключений, имя пользователя]
+        self.users = {}
+
+    def drop(self, connection):
+        user_id, _ = self.connections.pop(connection)
+        user = self.users[user_id]
+        user[0] -= 1
+        if user[0] > 0:
+            return None
+        del self.users[user_id]
+        return user_id, user[1]
+
+
+class LocalPresenceStore:
+    """
+    Присутствие в памяти процесса (channel layer без Redis)
+    """
+
+    def __init__(self):
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    async def join(self, channel_id, connection, user_id, username, ttl):
+        with self._lock:
+            channel = self._channels.setdefault(channel_id, ChannelPresence())
+            joined = connection not in channel.connections
+            if joined:
+                user = channel.users.setdefault(user_id, [0, username])
+                user[0] += 1
+                joined = user[0] == 1
+            channel.connections[connection] = (user_id, time.monotonic() + ttl)
+            channel.connections.move_to_end(connection)
+            return joined
+
+    async def heartbeat(self, channel_id, connection, ttl):
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if channel is None or connection not in channel.connections:
+                return
+            user_id, _ = channel.connections[connection]
+            channel.connections[connection] = (user_id, time.monotonic() + ttl)
+            channel.connections.move_to_end(connection)
+
+    async def leave(self, channel_id, connection):
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if channel is None or connection not in channel.connections:
+                return None
+            user = channel.drop(connection)
+            if not channel.connections:
+                del self._channels[channel_id]
+            return user
+
+    async def expire(self, channel_id):
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                return []
+            now = time.monotonic()
+            gone = []
+            while channel.connections:
+                connection, (_, expires) = next(iter(channel.connections.items()))
+                if expires > now:
+                    break
+                user = channel.drop(connection)
+                if user is not None:
+                    gone.append(user)
+            if not channel.connections:
+                del self._channels[channel_id]
+            return gone
+
+    async def online(self, channel_id):
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                return []
+            return [(user_id, user[1]) for user_id, user in channel.users.items()]
+
+    async def count(self, channel_id):
+        channel = self._channels.get(channel_id)
+        return len(channel.users) if channel is not None else 0
+
+    def clear(self):
+        with self._lock:
+            self._channels.clear()
+
+
+class RedisPresenceStore:
+    """
+    Присутствие в Redis channel layer, общее для всех процессов
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+
+    def _call(self, script, channel_id, *args):
+        base = make_key(self.layer, 'presence', channel_id)
+        keys = [f'{base}:{name}' for name in ('connections', 'owners', 'users', 'names')]
+        return get_redis(self.layer, base).eval(script, len(keys), *keys, *args)
+
+    @staticmethod
+    def _decode(value):
+        return value.decode() if isinstance(value, bytes) else value
+
+    async def join(self, channel_id, connection, user_id, username, ttl):
+        return bool(await self._call(JOIN_SCRIPT, channel_id, connection, user_id, username, ttl))
+
+    async def heartbeat(self, channel_id, connection, ttl):
+        await self._call(HEARTBEAT_SCRIPT, channel_id, connection, ttl)
+
+    async def leave(self, channel_id, connection):
+        user = await self._call(LEAVE_SCRIPT, channel_id, connection)
+        return (int(user[0]), self._decode(user[1])) if user else None
+
+    async def expire(self, channel_id):
+        gone = await self._call(EXPIRE_SCRIPT, channel_id)
+        return [(int(gone[i]), self._decode(gone[i + 1])) for i in range(0, len(gone), 2)]
+
+    async def online(self, channel_id):
+        base = make_key(self.layer, 'presence', channel_id)
+        names = await get_redis(self.layer, base).hgetall(f'{base}:names')
+        return [(int(user_id), self._decode(username)) for user_id, username in names.items()]
+
+    async def count(self, channel_id):
+        base = make_key(self.layer, 'presence', channel_id)
+        return await get_redis(self.layer, base).hlen(f'{base}:users')
+
+
+_local_store = LocalPresenceStore()
+
+
+class Presence:
+    """
+    Кто подключен к каналам.
+
+    Подключение регистрируется в connect и снимается в disconnect, пока оно открыто,
+    consumer продлевает его сигналом присутствия каждые HEARTBEAT_INTERVAL секунд.
+    Подключения, не продленные за TTL секунд (процесс завершился без disconnect), истекают.
+    Число и список пользователей в сети хранятся готовыми и не требуют перебора подключений.
+
+    Группе канала рассылаются не события каждого подключения, а изменения списка пользователей
+    (пришел/ушел), накопленные процессом за DEBOUNCE секунд. Пользователь, который переподключился
+    за это время, в изменения не попадает.
+    """
+
+    def __init__(self, heartbeat_interval=30, ttl=90, debounce=1.0):
+        self.heartbeat_interval = heartbeat_interval
+        self.ttl = ttl
+        self.debounce = debounce
+        # id канала -> {id пользователя: (изменение, имя пользователя)}
+        self._changes = {}
+        self._flush_tasks = {}
+
+    @classmethod
+    def from_settings(cls):
+        config = {**DEFAULTS, **getattr(settings, 'CHAT_PRESENCE', {})}
+        return cls(
+            heartbeat_interval=config['HEARTBEAT_INTERVAL'],
+            ttl=config['TTL'],
+            debounce=config['DEBOUNCE'],
+        )
+
+    @staticmethod
+    def get_store(layer):
+        if get_redis(layer, make_key(layer, 'presence')) is None:
+            return _local_store
+        return RedisPresenceStore(layer)
+
+    async def join(self, layer, channel_id, connection, user_id, username):
+        store = self.get_store(layer)
+        if await store.join(channel_id, connection, user_id, username, self.ttl):
+            self._changed(layer, channel_id, user_id, username, 'joined')
+
+    async def heartbeat(self, layer, channel_id, connection):
+        store = self.get_store(layer)
+        await store.heartbeat(channel_id, connection, self.ttl)
+        for user_id, username in await store.expire(channel_id):
+            self._changed(layer, channel_id, user_id, username, 'left')
+
+    async def leave(self, layer, channel_id, connection):
+        user = await self.get_store(layer).leave(channel_id, connection)
+        if user is not None:
+            self._changed(layer, channel_id, *user, 'left')
+
+    async def online(self, layer, channel_id):
+        """
+        Пользователи в сети в канале: {'online': число, 'users': [{'id', 'username'}]}
+        """
+        store = self.get_store(layer)
+        gone = await store.expire(channel_id)
+        if gone:
+            for user_id, username in gone:
+                self._record(channel_id, user_id, username, 'left')
+            # Вызов может прийти из временного цикла событий (представление), поэтому изменения рассылаются сразу:
+            # других подключений к каналу, которые сообщили бы об ушедших, может не быть
+            await self.flush(layer, channel_id)
+        users = sorted(await store.online(channel_id), key=lambda user: user[1])
+        return {'online': len(users), 'users': [{'id': user_id, 'username': username} for user_id, username in users]}
+
+    async def count(self, layer, channel_id):
+        return await self.get_store(layer).count(channel_id)
+
+    def _record(self, channel_id, user_id, username, change):
+        changes = self._changes.setdefault(channel_id, {})
+        previous = changes.pop(user_id, None)
+        if previous is None or previous[0] == change:
+            changes[user_id] = (change, username)
+        # Противоположное изменение за время задержки отменяет предыдущее
+
+    def _changed(self, layer, channel_id, user_id, username, change):
+        self._record(channel_id, user_id, username, change)
+        loop = asyncio.get_running_loop()
+        task = self._flush_tasks.get(channel_id)
+        # Задача привязана к циклу событий, в котором была создана
+        if task is None or task.done() or task.get_loop() is not loop:
+            self._flush_tasks[channel_id] = loop.create_task(self._flush_later(layer, channel_id))
+
+    async def _flush_later(self, layer, channel_id):
+        await asyncio.sleep(self.debounce)
+        try:
+            await self.flush(layer, channel_id)
+        except Exception:
+            logger.exception("Не удалось разослать изменения присутствия в канале %s", channel_id)
+
+    async def flush(self, layer, channel_id):
+        """
+        Рассылает группе канала накопленные изменения списка пользователей в сети
+        """
+        changes = self._changes.pop(channel_id, None)
+        if not changes:
+            return
+        diff = {'joined': [], 'left': []}
+        for user_id, (change, username) in changes.items():
+            diff[change].append({'id': user_id, 'username': username})
+        count = await self.count(layer, channel_id)
+        await layer.group_send(get_group_name(channel_id), {
+            'type': 'presence',
+            **encode_frames({'type': 'presence', **diff, 'online': count}),
+        })
+
+
+_presence = None
+
+
+def get_presence():
+    """
+    Возвращает учет присутствия текущего процесса
+    """
+    global _presence
+    if _presence is None:
+        _presence = Presence.from_settings()
+    return _presence
+
+
+@receiver(setting_changed)
+def reset_presence(setting, **kwargs):
+    global _presence
+    if setting == 'CHAT_PRESENCE':
+        _presence = None
+        _local_store.clear()
@@ -0,0 +1,90 @@
+import json
+
+try:
+    # Более быстрый кодировщик JSON используется, если он установлен
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # Бинарный протокол MessagePack доступен, если установлен msgpack (зависимость channels_redis)
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Подпротоколы WebSocket (заголовок Sec-WebSocket-Protocol). Без подпротокола используется JSON
+SUBPROTOCOL_JSON = 'chat.json'
+SUBPROTOCOL_MSGPACK = 'chat.msgpack'
+
+# Типы кадров от клиента (поле type). Кадр без типа — сообщение
+CLIENT_MESSAGE = 'message'
+CLIENT_TYPING = 'typing'
+
+
+def select_subprotocol(requested):
+    """
+    Выбирает подпротокол из предложенных клиентом (в порядке предпочтения клиента)
+    или None, если клиент не предложил поддерживаемый подпротокол
+    """
+    for subprotocol in requested:
+        if subprotocol == SUBPROTOCOL_JSON or (subprotocol == SUBPROTOCOL_MSGPACK and msgpack is not None):
+            return subprotocol
+    return None
+
+
+def encode_frame(payload):
+    """
+    Кодирует данные в текстовый кадр WebSocket
+    """
+    if orjson is not None:
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+
+
+def decode_frame(text_data):
+    """
+    Декодирует текстовый кадр WebSocket
+    """
+    if orjson is not None:
+        return orjson.loads(text_data)
+    return json.loads(text_data)
+
+
+def encode_binary_frame(payload):
+    """
+    Кодирует данные в бинарный кадр WebSocket (MessagePack)
+    """
+    return msgpack.packb(payload, use_bin_type=True)
+
+
+def decode_binary_frame(bytes_data):
+    """
+    Декодирует бинарный кадр WebSocket (MessagePack). Без msgpack бинарные кадры не принимаются (ValueError)
+    """
+    if msgpack is None:
+        raise ValueError("Бинарные кадры не поддерживаются: msgpack не установлен")
+    return msgpack.unpackb(bytes_data, raw=False)
+
+
+def encode_frames(payload):
+    """
+    Кодирует событие для рассылки один раз в каждом формате: подключения группы пересылают
+    готовый кадр своего формата без повторного кодирования
+    """
+    frames = {'frame': encode_frame(payload)}
+    if msgpack is not None:
+        frames['binary_frame'] = encode_binary_frame(payload)
+    return frames
+
+
+def message_payload(entry):
+    """
+    Сообщение из буфера последних сообщений в формате кадра WebSocket
+    """
+    return {
+        'id': entry['id'],
+        'username': entry['user'],
+        'message': entry['content'],
+        'timestamp': entry['timestamp'],
+    }
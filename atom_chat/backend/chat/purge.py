@@ -0,0 +1,183 @@
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .events import notify_messages_deleted
+from .models import Channel, ChannelPurge, Message, MessagePurge
+from . import activity, unread
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BACKGROUND': True,
+    'BATCH_SIZE': 1000,
+    'PAUSE': 0.05,
+}
+
+
+class ChannelPurger:
+    """
+    Удаление сообщений пакетами ограниченного размера: очистка удаленных каналов (run)
+    и массовое удаление сообщений модераторами (run_message_purge).
+
+    Каждый пакет удаляется в отдельной короткой транзакции, между пакетами делается пауза,
+    поэтому очистка большого канала не блокирует базу данных для записи новых сообщений.
+    В фоновом режиме очистки выполняются по очереди в отдельном потоке процесса.
+    """
+
+    def __init__(self, background=True, batch_size=1000, pause=0.05):
+        self.background = background
+        self.batch_size = batch_size
+        self.pause = pause
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        config = {**DEFAULTS, **getattr(settings, 'CHAT_CHANNEL_PURGE', {})}
+        return cls(background=config['BACKGROUND'], batch_size=config['BATCH_SIZE'], pause=config['PAUSE'])
+
+    def schedule(self, purge_id, run=None):
+        """
+        Запускает очистку после фиксации текущей транзакции.
+        run — метод очистки (по умолчанию run, очистка удаленного канала)
+        """
+        transaction.on_commit(lambda: self.submit(purge_id, run))
+
+    def submit(self, purge_id, run=None):
+        run = run or self.run
+        if not self.background:
+            run(purge_id)
+            return
+        self._queue.put((run, purge_id))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._work, name='chat-channel-purge', daemon=True)
+                self._thread.start()
+
+    def _work(self):
+        while True:
+            run, purge_id = self._queue.get()
+            close_old_connections()
+            try:
+                run(purge_id)
+            except Exception:
+                logger.exception("Очистка %s завершилась ошибкой", purge_id)
+            finally:
+                self._queue.task_done()
+            if self._queue.empty():
+                connection.close()
+
+    def run(self, purge_id):
+        """
+        Удаляет сообщения канала пакетами, затем сам канал
+        """
+        purge = ChannelPurge.objects.filter(id=purge_id).first()
+        if purge is None or purge.status == ChannelPurge.STATUS_DONE:
+            return
+        channel_id = purge.channel_id
+        messages = Message.objects.filter(channel_id=channel_id)
+
+        ChannelPurge.objects.filter(id=purge_id).update(
+            status=ChannelPurge.STATUS_RUNNING, total=purge.deleted + messages.count(), updated_at=timezone.now())
+        try:
+            # Отметки о прочтении и счетчики удаляются вместе с каналом, их не пересчитываем
+            for rows in self.delete_in_batches(messages, update_counters=False):
+                ChannelPurge.objects.filter(id=purge_id).update(deleted=F('deleted') + len(rows),
+                                                                updated_at=timezone.now())
+
+            with transaction.atomic():
+                Channel.objects.filter(id=channel_id).delete()
+                ChannelPurge.objects.filter(id=purge_id).update(
+                    status=ChannelPurge.STATUS_DONE, updated_at=timezone.now(), finished_at=timezone.now())
+        except Exception as error:
+            ChannelPurge.objects.filter(id=purge_id).update(
+                status=ChannelPurge.STATUS_FAILED, error=str(error), updated_at=timezone.now())
+            raise
+
+    def delete_in_batches(self, messages, update_counters=True):
+        """
+        Удаляет сообщения выборки пакетами по batch_size, каждый пакет — одним запросом DELETE
+        в отдельной транзакции. Для каждого пакета возвращает список (id, channel_id) удаленных сообщений
+        """
+        while True:
+            rows = list(messages.order_by('id').values_list('id', 'channel_id')[:self.batch_size])
+            if not rows:
+                return
+            ids = [message_id for message_id, _ in rows]
+            with transaction.atomic():
+                if update_counters:
+                    unread.messages_deleted(ids)
+                    activity.messages_deleted(ids)
+                Message.objects.filter(id__in=ids).delete()
+            yield rows
+            if self.pause:
+                time.sleep(self.pause)
+
+    def run_message_purge(self, purge_id):
+        """
+        Удаляет сообщения по условиям массового удаления пакетами. После каждого пакета подключенные
+        клиенты получают одно событие на каждый затронутый пакетом канал
+        """
+        purge = MessagePurge.objects.filter(id=purge_id).first()
+        if purge is None or purge.status == ChannelPurge.STATUS_DONE:
+            return
+        messages = purge.get_messages()
+
+        MessagePurge.objects.filter(id=purge_id).update(
+            status=ChannelPurge.STATUS_RUNNING, total=purge.deleted + messages.count(), updated_at=timezone.now())
+        try:
+            for rows in self.delete_in_batches(messages):
+                MessagePurge.objects.filter(id=purge_id).update(deleted=F('deleted') + len(rows),
+                                                                updated_at=timezone.now())
+                deleted = defaultdict(list)
+                for message_id, channel_id in rows:
+                    deleted[channel_id].append(message_id)
+                for channel_id, message_ids in deleted.items():
+                    notify_messages_deleted(channel_id, message_ids)
+
+            MessagePurge.objects.filter(id=purge_id).update(
+                status=ChannelPurge.STATUS_DONE, updated_at=timezone.now(), finished_at=timezone.now())
+        except Exception as error:
+            MessagePurge.objects.filter(id=purge_id).update(
+                status=ChannelPurge.STATUS_FAILED, error=str(error), updated_at=timezone.now())
+            raise
+
+    def resume(self):
+        """
+        Повторно запускает незавершенные очистки каналов и массовые удаления сообщений
+        (например, после перезапуска процесса). Возвращает их id: (очистки каналов, удаления сообщений)
+        """
+        resumed = []
+        for model, run in ((ChannelPurge, self.run), (MessagePurge, self.run_message_purge)):
+            purge_ids = list(model.objects.exclude(status=ChannelPurge.STATUS_DONE)
+                             .order_by('id').values_list('id', flat=True))
+            for purge_id in purge_ids:
+                try:
+                    run(purge_id)
+                except Exception:
+                    logger.exception("Очистка %s завершилась ошибкой", purge_id)
+            resumed.append(purge_ids)
+        return tuple(resumed)
+
+
+_channel_purger = None
+
+
+def get_channel_purger():
+    """
+    Возвращает исполнитель очисток каналов текущего процесса
+    """
+    global _channel_purger
+    if _channel_purger is None:
+        _channel_purger = ChannelPurger.from_settings()
+    return _channel_purger
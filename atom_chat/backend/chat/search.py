@@ -0,0 +1,107 @@
+import base64
+import re
+
+from django.db import connection
+
+from .models import Message
+
+
+# Максимальное число слов в поисковом запросе
+MAX_TERMS = 16
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def build_match_query(text):
+    """
+    Преобразует пользовательский запрос в запрос FTS5: каждое слово берется в кавычки,
+    поэтому операторы FTS5 во вводе пользователя не интерпретируются
+    """
+    terms = re.findall(r'\w+', text)[:MAX_TERMS]
+    return ' '.join(f'"{term}"' for term in terms)
+
+
+def encode_cursor(rank, message_id):
+    return base64.urlsafe_b64encode(f'{rank!r}:{message_id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        rank, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+        return float(rank), int(message_id)
+    except ValueError:
+        raise InvalidCursor(cursor)
+
+
+def search_messages(text, channel_id=None, cursor=None, limit=20):
+    """
+    Ищет сообщения по тексту.
+
+    Возвращает (сообщения, курсор следующей страницы). Результаты упорядочены по релевантности (bm25),
+    страницы выбираются по ключу (ранг, id), курсор передается в следующий запрос как есть.
+    На SQLite используется индекс FTS5, на других СУБД — поиск подстроки без ранжирования.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    if connection.vendor == 'sqlite':
+        rows = _search_fts(text, channel_id, after, limit + 1)
+    else:
+        rows = _search_contains(text, channel_id, after, limit + 1)
+
+    next_cursor = encode_cursor(*rows[limit - 1]) if len(rows) > limit else None
+    rows = rows[:limit]
+
+    messages = Message.objects.select_related('user', 'channel').in_bulk([message_id for _, message_id in rows])
+    # Сообщение могло быть удалено между запросами
+    return [messages[message_id] for _, message_id in rows if message_id in messages], next_cursor
+
+
+def _search_fts(text, channel_id, after, limit):
+    match = build_match_query(text)
+    if not match:
+        return []
+
+    sql = [
+        "SELECT bm25(chat_message_fts) AS rank, m.id",
+        "FROM chat_message_fts JOIN chat_message m ON m.id = chat_message_fts.rowid",
+        "JOIN chat_channel c ON c.id = m.channel_id",
+        "WHERE chat_message_fts MATCH %s AND c.is_deleted = %s",
+    ]
+    params = [match, False]
+    if channel_id is not None:
+        sql.append("AND m.channel_id = %s")
+        params.append(channel_id)
+    if after is not None:
+        sql.append("AND (bm25(chat_message_fts) > %s OR (bm25(chat_message_fts) = %s AND m.id > %s))")
+        params.extend([after[0], after[0], after[1]])
+    sql.append("ORDER BY rank, m.id LIMIT %s")
+    params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(' '.join(sql), params)
+        return cursor.fetchall()
+
+
+def _search_contains(text, channel_id, after, limit):
+    if not text.strip():
+        return []
+    queryset = Message.objects.filter(content__icontains=text.strip(), channel__is_deleted=False)
+    if channel_id is not None:
+        queryset = queryset.filter(channel_id=channel_id)
+    if after is not None:
+        queryset = queryset.filter(id__lt=after[1])
+    # Без ранжирования: новые сообщения первыми, ранг одинаковый
+    return [(0.0, message_id) for message_id in queryset.order_by('-id').values_list('id', flat=True)[:limit]]
+
+
+def rebuild_search_index():
+    """
+    Перестраивает полнотекстовый индекс по всем сообщениям одной операцией
+    """
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+        cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('optimize')")
+    return True
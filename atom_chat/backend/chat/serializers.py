@@ -1,7 +1,8 @@
 from django.contrib.auth import get_user_model
+from django.db import models
 from rest_framework import serializers
 
-from .models import Channel, Message
+from .models import Channel, ChannelPurge, Message, MessagePurge, ReadMarker
 
 
 User = get_user_model()
@@ -46,12 +47,116 @@ class UserManageSerializerForModerator(serializers.ModelSerializer):
 class ChannelSerializer(serializers.ModelSerializer):
     class Meta:
         model = Channel
-        fields = ['id', 'name', 'description', 'created_at']
+        fields = ['id', 'name', 'description', 'created_at', 'message_count', 'last_message_id', 'last_message_at',
+                  'last_message_preview']
+        read_only_fields = ['message_count', 'last_message_id', 'last_message_at', 'last_message_preview']
+
+
+class ChannelPurgeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ChannelPurge
+        fields = ['id', 'channel_id', 'channel_name', 'status', 'total', 'deleted', 'error', 'created_at',
+                  'updated_at', 'finished_at']
+
+
+class MessagePurgeSerializer(serializers.ModelSerializer):
+    user = serializers.SlugRelatedField(slug_field='username', read_only=True)
+
+    class Meta:
+        model = MessagePurge
+        fields = ['id', 'user', 'channel_ids', 'since', 'until', 'status', 'total', 'deleted', 'error', 'created_at',
+                  'updated_at', 'finished_at']
+
+
+class ReadMarkerSerializer(serializers.ModelSerializer):
+    channel_name = serializers.CharField(source='channel.name', read_only=True)
+    last_read_id = serializers.IntegerField(source='last_read_message_id', read_only=True)
+    unread = serializers.IntegerField(source='unread_count', read_only=True)
+
+    class Meta:
+        model = ReadMarker
+        fields = ['channel', 'channel_name', 'last_read_id', 'unread']
+
+
+class ReadMarkerRequestSerializer(serializers.Serializer):
+    # По умолчанию — до последнего сообщения канала
+    last_read_id = serializers.IntegerField(min_value=0, required=False, allow_null=True)
+
+
+class UnreadCountSerializer(serializers.ModelSerializer):
+    """
+    Канал из unread.unread_counts: поля как у ReadMarkerSerializer
+    """
+    channel = serializers.IntegerField(source='id', read_only=True)
+    channel_name = serializers.CharField(source='name', read_only=True)
+    last_read_id = serializers.IntegerField(read_only=True)
+    unread = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Channel
+        fields = ['channel', 'channel_name', 'last_read_id', 'unread']
 
 
 class MessageSerializer(serializers.ModelSerializer):
-    user = serializers.StringRelatedField()
+    # Имя автора берется из select_related('user') без отдельного запроса на каждую строку
+    user = serializers.CharField(source='user.username', read_only=True)
 
     class Meta:
         model = Message
         fields = ['id', 'user', 'content', 'timestamp']
+
+
+class MessageSearchSerializer(MessageSerializer):
+    channel = serializers.CharField(source='channel.name', read_only=True)
+
+    class Meta(MessageSerializer.Meta):
+        fields = ['id', 'channel', 'user', 'content', 'timestamp']
+
+
+class MessagePurgeRequestSerializer(serializers.Serializer):
+    """
+    Условия массового удаления сообщений: автор, каналы (id или названия) и интервал времени
+    """
+    user = serializers.SlugRelatedField(slug_field='username', queryset=User.objects.all(), required=False)
+    channels = serializers.ListField(child=serializers.CharField(), required=False, allow_empty=False)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+
+    def validate_channels(self, value):
+        ids = {int(item) for item in value if item.isdigit()}
+        names = {item for item in value if not item.isdigit()}
+        channels = list(Channel.objects.active().filter(models.Q(id__in=ids) | models.Q(name__in=names)))
+        found = {str(channel.id) for channel in channels} | {channel.name for channel in channels}
+        missing = [item for item in value if item not in found]
+        if missing:
+            raise serializers.ValidationError(f"Каналы не найдены: {', '.join(missing)}")
+        return channels
+
+    def validate(self, attrs):
+        if 'user' not in attrs and 'channels' not in attrs:
+            raise serializers.ValidationError("Необходимо указать пользователя и/или каналы")
+        if 'since' in attrs and 'until' in attrs and attrs['since'] >= attrs['until']:
+            raise serializers.ValidationError("since должен быть раньше until")
+        return attrs
+
+    def create(self, validated_data):
+        channels = validated_data.pop('channels', None)
+        if channels is not None:
+            validated_data['channel_ids'] = sorted(channel.id for channel in channels)
+        return MessagePurge.objects.create(**validated_data)
+
+
+class MessageExportSerializer(serializers.Serializer):
+    """
+    Параметры выгрузки истории канала: формат, сжатие, интервал времени и id, после которого продолжить выгрузку
+    """
+    output = serializers.ChoiceField(choices=['ndjson', 'csv'], default='ndjson')
+    compress = serializers.ChoiceField(choices=['gzip'], required=False)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    after = serializers.IntegerField(min_value=0, default=0)
+
+    def validate(self, attrs):
+        if 'since' in attrs and 'until' in attrs and attrs['since'] >= attrs['until']:
+            raise serializers.ValidationError("since должен быть раньше until")
+        return attrs
@@ -0,0 +1,22 @@
+# Общее для всех процессов состояние (лимиты, присутствие) хранится в Redis channel layer (channels_redis).
+# Для других channel layer (в памяти) используется хранилище текущего процесса
+
+
+def get_redis(layer, key):
+    """
+    Возвращает соединение Redis channel layer для ключа (с учетом шардирования channels_redis)
+    или None, если channel layer не использует Redis
+    """
+    # HybridChannelLayer хранит общее состояние во внешнем channel layer
+    layer = getattr(layer, 'remote', layer)
+    if not hasattr(layer, 'consistent_hash') or not hasattr(layer, 'connection'):
+        return None
+    return layer.connection(layer.consistent_hash(key))
+
+
+def make_key(layer, *parts):
+    """
+    Ключ Redis с префиксом channel layer
+    """
+    prefix = getattr(getattr(layer, 'remote', layer), 'prefix', 'asgi')
+    return ':'.join([prefix, 'chat', *map(str, parts)])
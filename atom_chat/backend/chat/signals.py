@@ -0,0 +1,43 @@
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import Signal, receiver
+
+from .cache import get_user_cache
+from .events import notify_users_blocked
+from .models import Message
+from . import activity, unread
+
+
+# Изменены флаги is_blocked/is_moderator пользователей.
+# Аргументы: user_ids — список id пользователей, changes — словарь новых значений флагов
+user_flags_changed = Signal()
+
+
+@receiver(user_flags_changed)
+def invalidate_cached_users(sender, user_ids, **kwargs):
+    """
+    Сбрасывает кэш аутентифицированных пользователей
+    """
+    get_user_cache().invalidate(*user_ids)
+
+
+@receiver(user_flags_changed)
+def push_block_changes(sender, user_ids, changes, **kwargs):
+    """
+    Передает блокировку открытым WebSocket-подключениям пользователей (после фиксации изменения)
+    """
+    if 'is_blocked' in changes:
+        user_ids = list(user_ids)
+        blocked = bool(changes['is_blocked'])
+        transaction.on_commit(lambda: notify_users_blocked(user_ids, blocked))
+
+
+@receiver(post_save, sender=Message)
+def count_saved_message(sender, instance, created, raw=False, **kwargs):
+    """
+    Обновляет счетчики при создании одного сообщения через save().
+    Сообщения из WebSocket пишутся через bulk_create (без сигналов), счетчики для них обновляет буфер записи
+    """
+    if created and not raw:
+        unread.messages_created([instance])
+        activity.messages_created([instance])
@@ -1,13 +1,51 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock
+
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db.backends.utils import CursorWrapper
+from django.db import IntegrityError, connection
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+import msgpack
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 
-from .models import Channel, Message
+from .models import Channel, Message, ReadMarker
+from .serializers import MessageSerializer
+from .buffer import MessageWriteBuffer
+from .cache import UserCache, get_user_cache
+from .events import get_group_name, notify_channel_deleted
+from .executor import DatabaseBusy, DatabaseExecutor
+from .export import aiter_message_batches, arender
+from .history import RecentMessages, get_recent_messages
+from .importer import MessageImporter
+from .layers import INBOX_CAPACITY, HybridChannelLayer, SharedMemoryChannelLayer
+from .presence import get_presence
+from .typing_indicators import LocalTypingStore
+from . import metrics
+from .middleware import JWTAuthMiddleware
+from . import routing
 
 
 User = get_user_model()
 
 
+# Потоки пула запросов к базе данных используют свои соединения и не видят транзакцию TestCase
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                   CHAT_DB_EXECUTOR={'MAX_WORKERS': 0})
 class ChatAPITestCase(APITestCase):
 
     def setUp(self):
@@ -82,9 +120,367 @@ class ChatAPITestCase(APITestCase):
         self.client.force_authenticate(user=self.moderator)
 
         response = self.client.delete(f"/api/channels/delete-by-id/{channel.id}/")
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
         self.assertIn("Уведомление", response.data)
 
+    @override_settings(CHAT_CHANNEL_PURGE={'BACKGROUND': False, 'BATCH_SIZE': 2, 'PAUSE': 0})
+    def test_channel_delete_purges_messages_in_batches(self):
+        """
+        Тестирование фонового удаления сообщений удаленного канала пакетами.
+        """
+        channel = Channel.objects.create(name="Big_Channel")
+        Message.objects.bulk_create([Message(channel=channel, user=self.user, content=f"Message {i}")
+                                     for i in range(5)])
+        self.client.force_authenticate(user=self.moderator)
+
+        with mock.patch('chat.purge._channel_purger', None):
+            # Очистка запускается после фиксации транзакции
+            with self.captureOnCommitCallbacks() as callbacks:
+                response = self.client.delete(f"/api/channels/delete-by-name/{channel.name}/")
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            purge_id = response.data["purge"]["id"]
+
+            # До очистки канал уже скрыт, но сообщения еще на месте
+            self.assertTrue(Channel.objects.get(id=channel.id).is_deleted)
+            self.assertNotIn(channel.name, [c["name"] for c in self.client.get("/api/channels/").data])
+            response = self.client.get(f"/api/channels/{channel.id}/history/")
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            self.assertEqual(Message.objects.filter(channel=channel).count(), 5)
+            # Название удаленного канала сразу свободно
+            response = self.client.post("/api/channels/create/", {"name": channel.name})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+            for callback in callbacks:
+                callback()
+
+        self.assertFalse(Channel.objects.filter(id=channel.id).exists())
+        self.assertFalse(Message.objects.filter(channel_id=channel.id).exists())
+
+        response = self.client.get(f"/api/channels/purges/{purge_id}/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["channel_name"], "Big_Channel")
+        self.assertEqual(response.data["status"], "done")
+        self.assertEqual(response.data["total"], 5)
+        self.assertEqual(response.data["deleted"], 5)
+
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get("/api/channels/purges/")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(CHAT_CHANNEL_PURGE={'BACKGROUND': False, 'BATCH_SIZE': 2, 'PAUSE': 0})
+    def test_message_purge(self):
+        """
+        Тестирование массового удаления сообщений модератором.
+        """
+        first = Channel.objects.create(name="First")
+        second = Channel.objects.create(name="Second")
+        kept = Channel.objects.create(name="Kept")
+        spam = [Message.objects.create(channel=channel, user=self.user_2, content="Spam")
+                for channel in (first, first, first, second, second, kept)]
+        other = Message.objects.create(channel=first, user=self.user, content="Not spam")
+        old = Message.objects.create(channel=first, user=self.user_2, content="Old")
+        Message.objects.filter(id=old.id).update(timestamp=spam[0].timestamp - timedelta(days=1))
+
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post("/api/messages/purge/", {"user": "user2"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=self.moderator)
+        response = self.client.post("/api/messages/purge/", {}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with mock.patch('chat.purge._channel_purger', None), \
+                mock.patch('chat.purge.notify_messages_deleted') as notify:
+            # Удаление запускается в фоне после фиксации транзакции
+            with self.captureOnCommitCallbacks() as callbacks:
+                response = self.client.post("/api/messages/purge/", {
+                    "user": "user2",
+                    "channels": [str(first.id), "Second"],
+                    "since": (spam[0].timestamp - timedelta(hours=1)).isoformat(),
+                }, format="json")
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            self.assertEqual(response.data["purge"]["status"], "pending")
+            self.assertEqual(Message.objects.count(), 8)
+            for callback in callbacks:
+                callback()
+
+        response = self.client.get(f"/api/messages/purges/{response.data['purge']['id']}/")
+        self.assertEqual(response.data["status"], "done")
+        self.assertEqual((response.data["total"], response.data["deleted"]), (5, 5))
+        self.assertEqual(response.data["channel_ids"], sorted([first.id, second.id]))
+
+        # После каждого пакета — одно событие на каждый канал пакета, а не на каждое сообщение
+        self.assertEqual([(call.args[0], sorted(call.args[1])) for call in notify.call_args_list], [
+            (first.id, [m.id for m in spam[:2]]), (first.id, [spam[2].id]), (second.id, [spam[3].id]),
+            (second.id, [spam[4].id])])
+        self.assertEqual(sorted(Message.objects.values_list('id', flat=True)), [spam[5].id, other.id, old.id])
+
+    def test_unread_counts(self):
+        """
+        Тестирование отметок о прочтении и счетчиков непрочитанных сообщений.
+        """
+        channel = Channel.objects.create(name="Unread")
+        other = Channel.objects.create(name="Other")
+        first = Message.objects.create(channel=channel, user=self.user_2, content="Before marker")
+
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(f"/api/channels/{channel.name}/read/", {}, format="json")
+        self.assertEqual(response.data, {"channel": channel.id, "channel_name": "Unread",
+                                         "last_read_id": first.id, "unread": 0})
+        self.client.post(f"/api/channels/{other.id}/read/", {}, format="json")
+
+        # Сообщения записываются так же, как из ChatConsumer (через буфер записи)
+        saved = MessageWriteBuffer._write([Message(channel=channel, user=self.user_2, content="1"),
+                                           Message(channel=channel, user=self.user, content="Own"),
+                                           Message(channel=channel, user=self.user_2, content="2"),
+                                           Message(channel=other, user=self.user_2, content="3")])
+        self.client.force_authenticate(user=self.moderator)
+        self.client.delete(f"/api/channels/{channel.id}/history/{saved[0].id}/delete/")
+        self.client.force_authenticate(user=self.user)
+
+        # Канал без отметки (пользователь в него не подключался): непрочитанными считаются все его сообщения
+        unmarked = Channel.objects.create(name="Unmarked")
+        MessageWriteBuffer._write([Message(channel=unmarked, user=self.user_2, content="4")])
+
+        # Читаются только счетчики, сообщения не подсчитываются
+        with self.assertNumQueries(1) as queries:
+            response = self.client.get("/api/channels/unread/")
+        self.assertNotIn("chat_message", queries.captured_queries[0]["sql"])
+        self.assertEqual([(item["channel"], item["last_read_id"], item["unread"]) for item in response.data],
+                         [(channel.id, first.id, 1), (other.id, 0, 1), (unmarked.id, 0, 1)])
+
+        # Отметка до первого сообщения: непрочитанным остается только чужое сообщение после нее
+        response = self.client.post(f"/api/channels/{channel.id}/read/", {"last_read_id": str(saved[1].id)},
+                                    format="json")
+        self.assertEqual(response.data["unread"], 1)
+        for invalid in (True, -1, "first"):
+            response = self.client.post(f"/api/channels/{channel.id}/read/", {"last_read_id": invalid}, format="json")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"/api/channels/{channel.id}/read/", {"last_read_id": first.id},
+                                    format="json")
+        self.assertEqual(response.data["last_read_id"], saved[1].id)
+        response = self.client.post(f"/api/channels/{channel.id}/read/", {}, format="json")
+        self.assertEqual(response.data["unread"], 0)
+
+    def test_channel_list_activity(self):
+        """
+        Тестирование денормализованных данных о сообщениях в списке каналов.
+        """
+        quiet = Channel.objects.create(name="Quiet")
+        busy = Channel.objects.create(name="Busy")
+        Channel.objects.create(name="Empty")
+        Message.objects.create(channel=quiet, user=self.user, content="Old")
+        saved = MessageWriteBuffer._write([Message(channel=busy, user=self.user, content="First"),
+                                           Message(channel=busy, user=self.user_2, content="x" * 300)])
+
+        self.client.force_authenticate(user=self.user)
+        # Проверка версии списка и выборка каналов
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/channels/", {"ordering": "activity"})
+        self.assertEqual([c["name"] for c in response.data], ["Busy", "Quiet", "Empty"])
+        self.assertEqual(response.data[0]["message_count"], 2)
+        self.assertEqual(response.data[0]["last_message_id"], saved[1].id)
+        self.assertEqual(response.data[0]["last_message_preview"], "x" * 100)
+        self.assertIsNone(response.data[2]["last_message_at"])
+
+        # После удаления последнего сообщения последним становится предыдущее
+        self.client.force_authenticate(user=self.moderator)
+        self.client.delete(f"/api/channels/{busy.id}/history/{saved[1].id}/delete/")
+        busy.refresh_from_db()
+        self.assertEqual((busy.message_count, busy.last_message_id, busy.last_message_preview),
+                         (1, saved[0].id, "First"))
+
+        response = self.client.get("/api/channels/", {"ordering": "unknown"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_conditional_get(self):
+        """
+        Тестирование ответов 304 для списка каналов и истории канала.
+        """
+        channel = Channel.objects.create(name="Conditional")
+        Message.objects.create(channel=channel, user=self.user, content="First")
+        self.client.force_authenticate(user=self.user)
+
+        list_etag = self.client.get("/api/channels/")["ETag"]
+        # Проверяется только версия списка каналов
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/channels/", HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        history = f"/api/channels/{channel.id}/history/"
+        # Канал изменен в текущую секунду: Last-Modified не отправляется
+        self.assertNotIn("Last-Modified", self.client.get(history, {"page_size": 10}))
+        Channel.objects.filter(id=channel.id).update(updated_at=timezone.now() - timedelta(seconds=10))
+        response = self.client.get(history, {"page_size": 10})
+        etag, last_modified = response["ETag"], response["Last-Modified"]
+        # Таблица сообщений не читается: достаточно строки канала
+        with self.assertNumQueries(1):
+            response = self.client.get(history, {"page_size": 10}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(history, {"page_size": 10}, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        # Другая страница — другой ETag
+        response = self.client.get(history, {"page_size": 5}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Новое сообщение меняет версию канала и списка каналов
+        MessageWriteBuffer._write([Message(channel=channel, user=self.user_2, content="Second")])
+        response = self.client.get(history, {"page_size": 10}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m["content"] for m in response.data["results"]], ["First", "Second"])
+        response = self.client.get("/api/channels/", HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(CHAT_EXPORT={'BATCH_SIZE': 2})
+    def test_message_export(self):
+        """
+        Тестирование потоковой выгрузки истории канала.
+        """
+        channel = Channel.objects.create(name="Export")
+        messages = [Message.objects.create(channel=channel, user=self.user, content=f'Line {i}, "quoted"')
+                    for i in range(5)]
+        Message.objects.create(channel=Channel.objects.create(name="Other"), user=self.user, content="Other")
+        Message.objects.filter(id=messages[0].id).update(timestamp=messages[0].timestamp - timedelta(days=1))
+
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(self.client.get(f"/api/channels/{channel.id}/export/").status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=self.moderator)
+        response = self.client.get(f"/api/channels/{channel.id}/export/")
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row["id"] for row in rows], [m.id for m in messages])
+        self.assertEqual(rows[1]["message"], 'Line 1, "quoted"')
+        self.assertEqual(rows[1]["username"], "admin")
+
+        # Продолжение выгрузки после полученного id и фильтр по времени
+        response = self.client.get("/api/channels/Export/export/", {
+            "output": "csv", "after": messages[2].id, "compress": "gzip"})
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        content = gzip.decompress(b"".join(response.streaming_content)).decode()
+        rows = list(csv.DictReader(io.StringIO(content)))
+        self.assertEqual([int(row["id"]) for row in rows], [m.id for m in messages[3:]])
+        self.assertEqual(rows[0]["message"], 'Line 3, "quoted"')
+
+        response = self.client.get(f"/api/channels/{channel.id}/export/", {
+            "since": (messages[1].timestamp - timedelta(hours=1)).isoformat()})
+        self.assertEqual(len(b"".join(response.streaming_content).splitlines()), 4)
+
+        response = self.client.get(f"/api/channels/{channel.id}/export/", {"output": "xml"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(CHAT_EXPORT={'BATCH_SIZE': 2})
+    async def test_message_export_under_asgi(self):
+        """
+        Тестирование выгрузки под ASGI: ответ передается асинхронным итератором.
+        """
+        channel = await Channel.objects.acreate(name="Export")
+        messages = [await Message.objects.acreate(channel=channel, user=self.user, content=f"Line {i}")
+                    for i in range(5)]
+
+        response = await AsyncClient().get(f"/api/channels/{channel.id}/export/", {"compress": "gzip"},
+                                           headers={"Authorization": f"Bearer {AccessToken.for_user(self.moderator)}"})
+        self.assertTrue(response.is_async)
+        content = b"".join([chunk async for chunk in response.streaming_content])
+        rows = [json.loads(line) for line in gzip.decompress(content).splitlines()]
+        self.assertEqual([row["id"] for row in rows], [m.id for m in messages])
+
+    @override_settings(CHAT_EXPORT={'BATCH_SIZE': 2, 'BUSY_RETRY_DELAY': 0.01, 'BUSY_RETRY_MAX_DELAY': 0.02,
+                                    'BUSY_TIMEOUT': 0.1})
+    async def test_message_export_when_database_is_busy(self):
+        """
+        Тестирование выгрузки при перегрузке пула запросов: пакет ждет, а прерванная выгрузка завершается ошибкой.
+        """
+        channel = await Channel.objects.acreate(name="Export")
+        messages = [await Message.objects.acreate(channel=channel, user=self.user, content=f"Line {i}")
+                    for i in range(5)]
+        busy = DatabaseBusy("busy")
+        original = DatabaseExecutor.run
+        calls = []
+
+        async def busy_twice(executor, *args):
+            calls.append(args)
+            if len(calls) <= 2:
+                raise busy
+            return await original(executor, *args)
+
+        # Пул занят недолго: выгрузка дожидается его и остается полной
+        with mock.patch.object(DatabaseExecutor, 'run', autospec=True, side_effect=busy_twice):
+            content = b"".join([chunk async for chunk in arender(aiter_message_batches(channel.id))])
+        self.assertEqual([json.loads(line)["id"] for line in content.splitlines()], [m.id for m in messages])
+
+        # Пул занят дольше BUSY_TIMEOUT после первого пакета: поток завершается записью об ошибке и исключением
+        calls.clear()
+
+        async def busy_after_first(executor, *args):
+            calls.append(args)
+            if len(calls) > 1:
+                raise busy
+            return await original(executor, *args)
+
+        chunks = []
+        with mock.patch.object(DatabaseExecutor, 'run', autospec=True, side_effect=busy_after_first), \
+                self.assertLogs('chat.export', 'ERROR'), self.assertRaises(DatabaseBusy):
+            async for chunk in arender(aiter_message_batches(channel.id), compress=True):
+                chunks.append(chunk)
+        rows = [json.loads(line) for line in gzip.decompress(b"".join(chunks)).splitlines()]
+        self.assertEqual([row.get("id") for row in rows[:-1]], [m.id for m in messages[:2]])
+        self.assertEqual(rows[-1]["last_id"], messages[1].id)
+        self.assertIn("error", rows[-1])
+
+    @override_settings(CHAT_IMPORT={'BATCH_SIZE': 2, 'MAX_ERRORS': 100})
+    def test_message_import(self):
+        """
+        Тестирование массового импорта сообщений из NDJSON.
+        """
+        channel = Channel.objects.create(name="Imported")
+        ReadMarker.objects.create(user=self.user, channel=channel)
+        rows = [
+            {"channel": "Imported", "username": "user2", "message": "First", "timestamp": "2020-01-01T10:00:00Z"},
+            {"username": "admin", "message": "Second", "timestamp": "2020-01-01T10:01:00"},
+            {"channel": "Imported", "username": "ghost", "message": "Unknown", "timestamp": "2020-01-01T10:02:00Z"},
+            {"channel": "Missing", "username": "user2", "message": "No channel", "timestamp": "2020-01-01T10:03:00Z"},
+            {"channel": "Imported", "username": "user2", "message": "Third", "timestamp": "yesterday"},
+            {"channel": "Imported", "username": "user2", "message": "Fourth", "timestamp": "2020-01-01T10:04:00Z"},
+        ]
+        body = "\n".join(json.dumps(row) for row in rows) + "\nnot json\n"
+
+        self.client.force_authenticate(user=self.moderator)
+        response = self.client.post("/api/messages/import/?channel=Imported", body.encode(),
+                                    content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["imported"], 3)
+        self.assertEqual(response.data["rejected"], 4)
+        self.assertEqual(response.data["reasons"], {"unknown_user": 1, "unknown_channel": 1,
+                                                    "invalid_timestamp": 1, "invalid_json": 1})
+        self.assertEqual(response.data["errors"][0], {"line": 3, "reason": "unknown_user"})
+
+        imported = list(Message.objects.filter(channel=channel).order_by("id").values_list("content", "timestamp"))
+        self.assertEqual([content for content, _ in imported], ["First", "Second", "Fourth"])
+        self.assertEqual(imported[0][1].isoformat(), "2020-01-01T10:00:00+00:00")
+        # Счетчики обновляются вместе с записью пакетов
+        channel.refresh_from_db()
+        self.assertEqual((channel.message_count, channel.last_message_preview), (3, "Fourth"))
+        self.assertEqual(ReadMarker.objects.get(user=self.user, channel=channel).unread_count, 2)
+
+        # Импорт более старой истории не заменяет последнее сообщение канала
+        older = [{"username": "user2", "message": "Older", "timestamp": "2019-01-01T10:00:00Z"},
+                 {"username": "user2", "message": "Oldest", "timestamp": "2018-01-01T10:00:00Z"}]
+        self.client.post("/api/messages/import/?channel=Imported", "\n".join(json.dumps(row) for row in older).encode(),
+                         content_type="application/x-ndjson")
+        channel.refresh_from_db()
+        self.assertEqual((channel.message_count, channel.last_message_preview), (5, "Fourth"))
+
+        # Команда читает файл и создает отсутствующие каналы
+        with tempfile.NamedTemporaryFile("w", suffix=".ndjson") as source:
+            source.write(json.dumps(rows[3]) + "\n")
+            source.flush()
+            output = io.StringIO()
+            call_command("import_messages", source.name, "--create-channels", stdout=output)
+        self.assertIn("Импортировано 1 сообщений", output.getvalue())
+        self.assertEqual(Channel.objects.get(name="Missing").message_count, 1)
+
     def test_get_users_list(self):
         """
         Тестирование просмотра списка пользователей модератором.
@@ -113,6 +509,260 @@ class ChatAPITestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), 2)
 
+    def test_message_history_cursor_pagination(self):
+        """
+        Тестирование курсорной пагинации истории сообщений.
+        """
+        channel = Channel.objects.create(name="Paginated_Channel")
+        messages = [Message.objects.create(channel=channel, user=self.user, content=f"Message {i}")
+                    for i in range(5)]
+
+        self.client.force_authenticate(user=self.user)
+
+        # Последняя страница истории
+        response = self.client.get(f"/api/channels/{channel.id}/history/", {"page_size": 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m["id"] for m in response.data["results"]], [messages[3].id, messages[4].id])
+        self.assertIsNone(response.data["next"])
+
+        # Более старые сообщения
+        response = self.client.get(f"/api/channels/{channel.id}/history/",
+                                   {"before": response.data["previous"], "page_size": 2})
+        self.assertEqual([m["id"] for m in response.data["results"]], [messages[1].id, messages[2].id])
+        self.assertEqual(response.data["results"][0]["user"], self.user.username)
+
+        # Более новые сообщения (вместо курсора можно передать id сообщения)
+        response = self.client.get(f"/api/channels/{channel.id}/history/",
+                                   {"after": messages[0].id, "page_size": 3})
+        self.assertEqual([m["id"] for m in response.data["results"]],
+                         [messages[1].id, messages[2].id, messages[3].id])
+        response = self.client.get(f"/api/channels/{channel.id}/history/",
+                                   {"after": response.data["next"], "page_size": 3})
+        self.assertEqual([m["id"] for m in response.data["results"]], [messages[4].id])
+        self.assertIsNone(response.data["next"])
+
+        # Курсор не зависит от сообщения, а id удаленного сообщения не определяет место в истории
+        cursor = self.client.get(f"/api/channels/{channel.id}/history/",
+                                 {"before": messages[3].id, "page_size": 1}).data["previous"]
+        deleted_id = messages[2].id
+        messages[2].delete()
+        response = self.client.get(f"/api/channels/{channel.id}/history/", {"before": cursor, "page_size": 2})
+        self.assertEqual([m["id"] for m in response.data["results"]], [messages[0].id, messages[1].id])
+        for invalid in (deleted_id, "bad"):
+            response = self.client.get(f"/api/channels/{channel.id}/history/", {"before": invalid})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_message_history_orders_by_time(self):
+        """
+        Тестирование одинакового порядка истории в базе данных и в буфере, когда id не следуют времени.
+        """
+        channel = Channel.objects.create(name="Imported_Order")
+        now = timezone.now()
+        # Сначала записаны новые сообщения, затем импортирована более старая история
+        offsets = [1, 3, 5, 0, 2, 4]
+        messages = [Message.objects.create(channel=channel, user=self.user, content=f"At {offset}",
+                                           timestamp=now - timedelta(minutes=10 - offset)) for offset in offsets]
+        in_time = sorted(messages, key=lambda message: message.timestamp)
+        self.client.force_authenticate(user=self.user)
+        history = f"/api/channels/{channel.id}/history/"
+
+        def walk():
+            response = self.client.get(history, {"page_size": 2})
+            pages = [response.data["results"]]
+            while response.data["previous"] is not None:
+                response = self.client.get(history, {"before": response.data["previous"], "page_size": 2})
+                pages.insert(0, response.data["results"])
+            return [m["id"] for page in pages for m in page]
+
+        self.assertEqual(walk(), [message.id for message in in_time])
+
+        recent_messages = get_recent_messages()
+        recent_messages.acquire(channel.id)
+        try:
+            entries = MessageSerializer(reversed(messages), many=True).data
+            recent_messages.seed(channel.id, [dict(entry) for entry in entries])
+            # Последняя страница из буфера совпадает со страницей из базы данных
+            self.assertEqual(walk(), [message.id for message in in_time])
+            self.assertEqual(recent_messages.after(channel.id, in_time[3].id),
+                             [dict(entry) for entry in MessageSerializer(in_time[4:], many=True).data])
+        finally:
+            recent_messages.release(channel.id)
+
+    def test_user_cache_eviction(self):
+        """
+        Тестирование вытеснения и устаревания записей кэша пользователей.
+        """
+        user_cache = UserCache(max_size=2, ttl=60)
+        user_cache.set(self.user.id, self.user)
+        user_cache.set(self.user_2.id, self.user_2)
+        # Обращение делает пользователя недавно использованным
+        self.assertEqual(user_cache.get(str(self.user.id)), self.user)
+        user_cache.set(self.moderator.id, self.moderator)
+        self.assertIsNone(user_cache.get(self.user_2.id))
+        self.assertEqual(user_cache.get(self.user.id), self.user)
+
+        expired_cache = UserCache(ttl=0)
+        expired_cache.set(self.user.id, self.user)
+        self.assertIsNone(expired_cache.get(self.user.id))
+
+    def test_user_block_invalidates_cache(self):
+        """
+        Тестирование сброса кэша пользователя после блокировки модератором.
+        """
+        get_user_cache().set(self.user_2.id, self.user_2)
+        self.client.force_authenticate(user=self.moderator)
+
+        response = self.client.patch(f"/api/moderator/users/{self.user_2.id}/", {"is_blocked": True})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(get_user_cache().get(self.user_2.id))
+
+    async def test_write_buffer_batches_messages(self):
+        """
+        Тестирование пакетной записи сообщений.
+        """
+        channel = await Channel.objects.acreate(name="Buffer_Channel")
+        write_buffer = MessageWriteBuffer(max_batch_size=3, flush_interval=60)
+
+        # Пакет записывается, как только набирается MAX_BATCH_SIZE сообщений
+        futures = [await write_buffer.enqueue(Message(channel=channel, user=self.user, content=f"Message {i}"))
+                   for i in range(3)]
+        saved = await asyncio.gather(*futures)
+        self.assertTrue(all(message.id for message in saved))
+        self.assertEqual(await Message.objects.filter(channel=channel).acount(), 3)
+
+        # Остаток записывается при остановке
+        future = await write_buffer.enqueue(Message(channel=channel, user=self.user, content="Last message"))
+        await write_buffer.close()
+        self.assertEqual(future.result().content, "Last message")
+        self.assertEqual(await Message.objects.filter(channel=channel).acount(), 4)
+
+    async def test_write_buffer_retries_failed_batch_by_row(self):
+        """
+        Тестирование записи пакета по одному сообщению, если пакет не записался целиком.
+        """
+        channel = await Channel.objects.acreate(name="Buffer_Channel")
+        write_buffer = MessageWriteBuffer(max_batch_size=3, flush_interval=60)
+        messages = [Message(channel=channel, user=self.user, content="First"),
+                    Message(channel=channel, user=self.user, content=None),
+                    Message(channel=channel, user=self.user, content="Third")]
+        futures = [await write_buffer.enqueue(message) for message in messages]
+        first, broken, third = await asyncio.gather(*futures, return_exceptions=True)
+
+        self.assertEqual((first.content, third.content), ("First", "Third"))
+        self.assertIsInstance(broken, IntegrityError)
+        self.assertEqual(await Message.objects.filter(channel=channel).acount(), 2)
+
+    @override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+    def test_message_search(self):
+        """
+        Тестирование полнотекстового поиска по сообщениям.
+        """
+        channel = Channel.objects.create(name="Search_Channel")
+        other_channel = Channel.objects.create(name="Other_Search_Channel")
+        best = Message.objects.create(channel=channel, user=self.user, content="Привет привет мир")
+        weaker = Message.objects.create(channel=channel, user=self.user,
+                                        content="Привет, это длинное сообщение о чем-то совсем другом")
+        other = Message.objects.create(channel=other_channel, user=self.user, content="Привет из другого канала")
+        Message.objects.create(channel=channel, user=self.user, content="Без совпадений")
+
+        self.client.force_authenticate(user=self.moderator)
+
+        # Поиск по всем каналам с курсорной пагинацией
+        response = self.client.get("/api/search/", {"q": "привет", "page_size": 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["results"][0]["id"], best.id)
+        self.assertEqual(len(response.data["results"]), 2)
+        response = self.client.get("/api/search/", {"q": "привет", "page_size": 2,
+                                                     "cursor": response.data["next"]})
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertIsNone(response.data["next"])
+
+        # Поиск в одном канале, удаленное сообщение исключается из индекса
+        self.client.delete(f"/api/channels/{channel.id}/history/{weaker.id}/delete/")
+        response = self.client.get(f"/api/channels/{channel.id}/search/", {"q": "привет"})
+        self.assertEqual([m["id"] for m in response.data["results"]], [best.id])
+        self.assertNotIn(other.id, [m["id"] for m in response.data["results"]])
+
+    @override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+    def test_message_history_from_recent_messages(self):
+        """
+        Тестирование выдачи последней страницы истории из буфера последних сообщений.
+        """
+        channel = Channel.objects.create(name="Recent_Channel")
+        messages = [Message.objects.create(channel=channel, user=self.user, content=f"Message {i}")
+                    for i in range(3)]
+        entries = [{"id": m.id, "user": self.user.username, "content": "cached",
+                    "timestamp": m.timestamp.isoformat()} for m in messages]
+
+        recent_messages = get_recent_messages()
+        recent_messages.acquire(channel.id)
+        recent_messages.seed(channel.id, entries)
+        self.client.force_authenticate(user=self.moderator)
+        try:
+            response = self.client.get(f"/api/channels/{channel.id}/history/", {"page_size": 2})
+            self.assertEqual(response.data["results"], entries[1:])
+            response = self.client.get(f"/api/channels/{channel.id}/history/",
+                                       {"before": response.data["previous"], "page_size": 2})
+            self.assertEqual([m["id"] for m in response.data["results"]], [messages[0].id])
+
+            # Удаленное сообщение исключается из буфера
+            self.client.delete(f"/api/channels/{channel.id}/history/{messages[2].id}/delete/")
+            response = self.client.get(f"/api/channels/{channel.id}/history/", {"page_size": 2})
+            self.assertEqual(response.data["results"], entries[:2])
+        finally:
+            recent_messages.release(channel.id)
+
+    def test_metrics_endpoint(self):
+        """
+        Тестирование выдачи метрик в формате Prometheus.
+        """
+        response = self.client.get("/api/metrics/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        metrics.registry.clear()
+        self.client.force_authenticate(user=self.user)
+        with self.settings(CHAT_METRICS_ENABLED=True):
+            self.client.get("/api/channels/")
+            response = self.client.get("/api/metrics/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.content.decode()
+        self.assertIn('chat_http_request_seconds_count{view="channel_list_create",method="GET",status="200"} 1',
+                      body)
+        self.assertIn('chat_http_db_queries_bucket{view="channel_list_create",le="+Inf"} 1', body)
+        metrics.registry.clear()
+
+    def test_create_test_data(self):
+        """
+        Тестирование генерации тестовых данных пакетами.
+        """
+        options = dict(users=20, channels=2, messages=120, batch_size=50, min_length=5, max_length=40, seed=1,
+                       stdout=io.StringIO())
+        call_command('create_test_data', **options)
+        self.client.force_authenticate(user=self.user)
+        history = f"/api/channels/{Channel.objects.get(name='general').id}/history/"
+        history_etag = self.client.get(history, {"page_size": 200})["ETag"]
+        list_etag = self.client.get("/api/channels/")["ETag"]
+        # Повторный запуск не дублирует пользователей и каналы
+        options["stdout"] = io.StringIO()
+        call_command('create_test_data', **options)
+        self.assertIn("Пользователи: обработано 20 строк, записано 0,", options["stdout"].getvalue())
+
+        # Пересчет данных каналов после загрузки меняет их версию
+        response = self.client.get(history, {"page_size": 200}, HTTP_IF_NONE_MATCH=history_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), Message.objects.filter(channel__name="general").count())
+        response = self.client.get("/api/channels/", HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        general = next(channel for channel in response.data if channel["name"] == "general")
+        self.assertEqual(general["message_count"], Message.objects.filter(channel__name="general").count())
+
+        self.assertEqual(User.objects.filter(username__startswith="load_user_").count(), 20)
+        self.assertEqual(Channel.objects.count(), 5)
+        self.assertEqual(Message.objects.count(), 240)
+        lengths = [len(content) for content in Message.objects.values_list('content', flat=True)]
+        self.assertTrue(all(5 <= length <= 40 for length in lengths))
+        self.assertTrue(User.objects.get(username="load_user_0").check_password("loadpassword"))
+
     def tearDown(self):
         """
         Очистка данных после каждого теста.
@@ -120,3 +770,669 @@ class ChatAPITestCase(APITestCase):
         User.objects.all().delete()
         Channel.objects.all().delete()
         Message.objects.all().delete()
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                   CHAT_DB_EXECUTOR={'MAX_WORKERS': 0})
+class ChatConsumerTestCase(TestCase):
+
+    def setUp(self):
+        """
+        Создаем начальные данные
+        """
+        self.user = User.objects.create_user(username="ws_user", email="ws_user@test.com", password="password")
+        self.channel = Channel.objects.create(name="WS_Channel")
+
+    def get_communicator(self, channel_name, user=None, query="", subprotocols=None):
+        """
+        Создает WebSocket-клиент с JWT-токеном пользователя
+        """
+        application = JWTAuthMiddleware(URLRouter(routing.websocket_urlpatterns))
+        headers = []
+        if user is not None:
+            headers.append((b'authorization', f'Bearer {AccessToken.for_user(user)}'.encode()))
+        return WebsocketCommunicator(application, f"/ws/chat/{channel_name}/{query}", headers=headers,
+                                     subprotocols=subprotocols)
+
+    async def test_connect_to_unknown_channel_is_rejected(self):
+        """
+        Тестирование отказа в подключении к несуществующему каналу.
+        """
+        communicator = self.get_communicator("Unknown_Channel", self.user)
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_connect_without_token_is_rejected(self):
+        """
+        Тестирование отказа в подключении без токена.
+        """
+        communicator = self.get_communicator(self.channel.name)
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_send_message_without_lookups(self):
+        """
+        Тестирование отправки сообщения без запросов пользователя и канала.
+        """
+        communicator = self.get_communicator(self.channel.name, self.user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        backlog = await communicator.receive_json_from()
+        self.assertEqual(backlog["type"], "backlog")
+
+        # Запросы могут выполняться через другое подключение, поэтому перехватываем их на уровне курсора
+        with mock.patch.object(CursorWrapper, 'execute', autospec=True,
+                               side_effect=CursorWrapper.execute) as execute:
+            await communicator.send_json_to({"message": "Hello"})
+            response = await communicator.receive_json_from()
+        self.assertEqual(response["message"], "Hello")
+        self.assertEqual(response["username"], self.user.username)
+        # Выполняется только INSERT сообщения
+        statements = [call.args[1] for call in execute.call_args_list]
+        self.assertTrue(any(sql.startswith("INSERT") for sql in statements))
+        self.assertFalse(any(sql.startswith("SELECT") for sql in statements))
+
+        await communicator.disconnect()
+        self.assertTrue(await Message.objects.filter(channel=self.channel, content="Hello").aexists())
+
+    async def test_backlog_on_connect(self):
+        """
+        Тестирование отправки последних сообщений канала при подключении.
+        """
+        await Message.objects.acreate(channel=self.channel, user=self.user, content="Old message")
+
+        first = self.get_communicator(self.channel.name, self.user)
+        await first.connect()
+        backlog = await first.receive_json_from()
+        self.assertEqual([m["message"] for m in backlog["messages"]], ["Old message"])
+
+        await first.send_json_to({"message": "New message"})
+        await first.receive_json_from()
+
+        # Второе подключение получает буфер, дополненный новым сообщением
+        second = self.get_communicator(self.channel.name, self.user)
+        await second.connect()
+        backlog = await second.receive_json_from()
+        self.assertEqual([m["message"] for m in backlog["messages"]], ["Old message", "New message"])
+
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_msgpack_subprotocol(self):
+        """
+        Тестирование бинарного протокола MessagePack рядом с JSON-клиентами.
+        """
+        binary = self.get_communicator(self.channel.name, self.user, subprotocols=["chat.msgpack", "chat.json"])
+        connected, subprotocol = await binary.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, "chat.msgpack")
+        backlog = msgpack.unpackb(await binary.receive_from())
+        self.assertEqual(backlog, {"type": "backlog", "messages": []})
+
+        text = self.get_communicator(self.channel.name, self.user)
+        await text.connect()
+        await text.receive_json_from()
+
+        await binary.send_to(bytes_data=msgpack.packb({"message": "Binary hello"}))
+        frame = await binary.receive_from()
+        self.assertIsInstance(frame, bytes)
+        self.assertEqual(msgpack.unpackb(frame)["message"], "Binary hello")
+        # JSON-клиент получает тот же кадр в текстовом формате
+        self.assertEqual((await text.receive_json_from())["message"], "Binary hello")
+
+        # Без msgpack бинарные кадры отклоняются ошибкой, соединение остается открытым
+        with mock.patch('chat.protocol.msgpack', None):
+            await text.send_to(bytes_data=msgpack.packb({"message": "Binary hello"}))
+            self.assertEqual((await text.receive_json_from())["reason"], "invalid_frame")
+        await text.send_to(text_data="not json")
+        self.assertEqual((await text.receive_json_from())["reason"], "invalid_frame")
+
+        await binary.disconnect()
+        await text.disconnect()
+
+    async def test_channel_delete_closes_connections(self):
+        """
+        Тестирование закрытия подключений к удаленному каналу.
+        """
+        communicator = self.get_communicator(self.channel.name, self.user)
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        await sync_to_async(notify_channel_deleted)(self.channel.id)
+        self.assertEqual(await communicator.receive_json_from(), {"type": "channel_deleted"})
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4404})
+        await communicator.disconnect()
+
+        # К удаленному каналу нельзя подключиться
+        await Channel.objects.filter(id=self.channel.id).aupdate(is_deleted=True)
+        communicator = self.get_communicator(self.channel.name, self.user)
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    @override_settings(CHAT_RATE_LIMIT={'CONNECTION_RATE': 0, 'CONNECTION_BURST': 0, 'USER_RATE': 0.001,
+                                        'USER_BURST': 2, 'MAX_MESSAGE_SIZE': 100, 'POLICY': 'warn'})
+    async def test_rate_limit_warns(self):
+        """
+        Тестирование ограничения частоты и размера сообщений с предупреждением клиента.
+        """
+        communicator = self.get_communicator(self.channel.name, self.user)
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to({"message": "x" * 200})
+        self.assertEqual((await communicator.receive_json_from())["reason"], "size")
+        # Размер считается в байтах: 60 символов кириллицы занимают больше 100 байт
+        await communicator.send_to(text_data=json.dumps({"message": "я" * 45}, ensure_ascii=False))
+        self.assertEqual((await communicator.receive_json_from())["reason"], "size")
+
+        # Корзина пользователя общая для всех его подключений
+        second = self.get_communicator(self.channel.name, self.user)
+        await second.connect()
+        await second.receive_json_from()
+        for sender in (communicator, second):
+            await sender.send_json_to({"message": "Allowed"})
+            await communicator.receive_json_from()
+            await second.receive_json_from()
+        await second.send_json_to({"message": "Limited"})
+        self.assertEqual(await second.receive_json_from(),
+                         {"type": "error", "reason": "user_rate", "error": "Слишком много сообщений"})
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+        await second.disconnect()
+        self.assertEqual(await Message.objects.filter(channel=self.channel).acount(), 2)
+
+    @override_settings(CHAT_RATE_LIMIT={'CONNECTION_RATE': 0.001, 'CONNECTION_BURST': 1, 'USER_RATE': 0,
+                                        'USER_BURST': 0, 'MAX_MESSAGE_SIZE': 4096, 'POLICY': 'close'})
+    async def test_rate_limit_closes_connection(self):
+        """
+        Тестирование закрытия соединения при превышении частоты сообщений.
+        """
+        communicator = self.get_communicator(self.channel.name, self.user)
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to({"message": "Allowed"})
+        await communicator.receive_json_from()
+        await communicator.send_json_to({"message": "Limited"})
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4429})
+        await communicator.disconnect()
+
+    @override_settings(CHAT_PRESENCE={'HEARTBEAT_INTERVAL': 0.05, 'TTL': 0.3, 'DEBOUNCE': 0.1})
+    async def test_presence(self):
+        """
+        Тестирование списка пользователей в сети, истечения подключений и объединения изменений.
+        """
+        other = await User.objects.acreate(username="other_user", email="other_user@test.com")
+        communicator = self.get_communicator(self.channel.name, self.user)
+        await communicator.connect()
+        await communicator.receive_json_from()
+        # Подключение процесса, который завершится без disconnect
+        presence = get_presence()
+        layer = get_channel_layer()
+        await presence.join(layer, self.channel.id, "dead-connection", other.id, other.username)
+
+        joined = await communicator.receive_json_from(timeout=1)
+        self.assertEqual(joined, {"type": "presence", "left": [], "online": 2, "joined": [
+            {"id": self.user.id, "username": "ws_user"}, {"id": other.id, "username": "other_user"}]})
+        self.assertEqual((await presence.online(layer, self.channel.id))["online"], 2)
+
+        # Непродленное подключение истекает
+        left = await communicator.receive_json_from(timeout=1)
+        self.assertEqual(left, {"type": "presence", "joined": [], "left": [{"id": other.id, "username": "other_user"}],
+                                "online": 1})
+
+        # Подключение и отключение за время задержки не рассылаются
+        second = self.get_communicator(self.channel.name, other)
+        await second.connect()
+        await second.receive_json_from()
+        await second.disconnect()
+        self.assertTrue(await communicator.receive_nothing(timeout=0.3))
+        self.assertEqual(await presence.online(layer, self.channel.id),
+                         {"online": 1, "users": [{"id": self.user.id, "username": "ws_user"}]})
+        await communicator.disconnect()
+
+    @override_settings(CHAT_PRESENCE={'HEARTBEAT_INTERVAL': 30, 'TTL': 0.1, 'DEBOUNCE': 60})
+    async def test_presence_online_reports_expired(self):
+        """
+        Тестирование рассылки истекших подключений при запросе списка без живых подключений к каналу.
+        """
+        presence = get_presence()
+        layer = get_channel_layer()
+        listener = await layer.new_channel()
+        await layer.group_add(get_group_name(self.channel.id), listener)
+        await presence.join(layer, self.channel.id, "dead-connection", self.user.id, self.user.username)
+        await presence.flush(layer, self.channel.id)
+        await layer.receive(listener)
+        await asyncio.sleep(0.2)
+
+        self.assertEqual(await presence.online(layer, self.channel.id), {"online": 0, "users": []})
+        event = await asyncio.wait_for(layer.receive(listener), 1)
+        self.assertEqual(event["type"], "presence")
+        self.assertEqual(json.loads(event["frame"])["left"], [{"id": self.user.id, "username": "ws_user"}])
+
+    @override_settings(CHAT_TYPING={'INTERVAL': 0.5}, CHAT_PRESENCE={'DEBOUNCE': 60})
+    async def test_typing_is_coalesced(self):
+        """
+        Тестирование объединения уведомлений о наборе текста без записи в базу данных.
+        """
+        other = await User.objects.acreate(username="other_user", email="other_user@test.com")
+        typist = self.get_communicator(self.channel.name, self.user)
+        reader = self.get_communicator(self.channel.name, other)
+        for communicator in (typist, reader):
+            await communicator.connect()
+            await communicator.receive_json_from()
+
+        for _ in range(5):
+            await typist.send_json_to({"type": "typing"})
+        self.assertEqual(await reader.receive_json_from(),
+                         {"type": "typing", "users": [{"id": self.user.id, "username": "ws_user"}]})
+        self.assertTrue(await reader.receive_nothing(timeout=0.1))
+        # Отправитель не получает уведомление о себе
+        self.assertTrue(await typist.receive_nothing(timeout=0.1))
+
+        # События за интервал объединяются в один кадр
+        await typist.send_json_to({"type": "typing"})
+        await reader.send_json_to({"type": "typing"})
+        frame = await typist.receive_json_from(timeout=1)
+        self.assertEqual({user["username"] for user in frame["users"]}, {"ws_user", "other_user"})
+        self.assertEqual(await reader.receive_json_from(timeout=1), frame)
+
+        await typist.send_json_to({"type": "unknown"})
+        self.assertEqual((await typist.receive_json_from())["reason"], "unknown_type")
+
+        await typist.disconnect()
+        await reader.disconnect()
+        self.assertFalse(await Message.objects.filter(channel=self.channel).aexists())
+
+    async def test_invalid_message_field_is_rejected(self):
+        """
+        Тестирование отказа в кадрах сообщений без текста или с текстом не строкой.
+        """
+        communicator = self.get_communicator(self.channel.name, self.user)
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        for frame in ({}, {"type": "message"}, {"message": None}, {"message": {"text": "x"}}, {"message": 5},
+                      {"message": ""}, {"message": "   "}):
+            await communicator.send_json_to(frame)
+            self.assertEqual((await communicator.receive_json_from())["reason"], "invalid_frame")
+
+        # Соединение остается открытым
+        await communicator.send_json_to({"message": "Valid"})
+        self.assertEqual((await communicator.receive_json_from())["message"], "Valid")
+        await communicator.disconnect()
+        self.assertEqual(await Message.objects.filter(channel=self.channel).acount(), 1)
+
+    async def test_typing_windows_are_pruned(self):
+        """
+        Тестирование удаления закончившихся окон рассылки уведомлений о наборе текста.
+        """
+        store = LocalTypingStore()
+        self.assertEqual(await store.claim(1, {10: "first"}, 0.05), ({10: "first"}, 0))
+        users, wait = await store.claim(1, {11: "second"}, 0.05)
+        self.assertIsNone(users)
+        self.assertGreater(wait, 0)
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(await store.claim(2, {}, 0.05), ({}, 0))
+        self.assertEqual(set(store._sent_at), {2})
+        # Пользователь, не попавший в занятое окно, рассылается в следующем
+        self.assertEqual(await store.claim(1, {}, 0.05), ({11: "second"}, 0))
+
+    def set_blocked(self, blocked):
+        """
+        Блокирует или разблокирует пользователя через API суперпользователя (с выполнением on_commit)
+        """
+        admin = User.objects.create_superuser(username=f"root_{blocked}", email="root@test.com", password="password")
+        client = APIClient()
+        client.force_authenticate(user=admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.patch(f"/api/admin/users/{self.user.id}/", {"is_blocked": blocked}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(CHAT_PRESENCE={'DEBOUNCE': 60})
+    async def test_block_closes_connections(self):
+        """
+        Тестирование закрытия подключений пользователя при блокировке.
+        """
+        communicators = [self.get_communicator(self.channel.name, self.user) for _ in range(2)]
+        for communicator in communicators:
+            await communicator.connect()
+            await communicator.receive_json_from()
+
+        await sync_to_async(self.set_blocked)(True)
+        for communicator in communicators:
+            self.assertEqual(await communicator.receive_json_from(), {"type": "blocked"})
+            self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4403})
+            await communicator.disconnect()
+
+        # Новые подключения заблокированного пользователя не принимаются
+        communicator = self.get_communicator(self.channel.name, self.user)
+        connected, code = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4403)
+
+    @override_settings(CHAT_PRESENCE={'DEBOUNCE': 60})
+    async def test_blocked_user_from_stale_cache_is_rejected(self):
+        """
+        Тестирование отказа в подключении, если пользователь в кэше еще не заблокирован.
+        """
+        communicator = self.get_communicator(self.channel.name, self.user)
+        await communicator.connect()
+        await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        # Блокировка в другом процессе: кэш пользователей этого процесса не сброшен
+        await User.objects.filter(id=self.user.id).aupdate(is_blocked=True)
+        communicator = self.get_communicator(self.channel.name, self.user)
+        connected, code = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4403)
+
+    @override_settings(CHAT_BLOCKED_USERS={'ACTION': 'mute'}, CHAT_PRESENCE={'DEBOUNCE': 60})
+    async def test_block_mutes_connections(self):
+        """
+        Тестирование запрета отправки сообщений заблокированным пользователем без запросов к базе данных.
+        """
+        communicator = self.get_communicator(self.channel.name, self.user)
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        await sync_to_async(self.set_blocked)(True)
+        self.assertEqual(await communicator.receive_json_from(), {"type": "blocked"})
+        with mock.patch.object(CursorWrapper, 'execute', autospec=True,
+                               side_effect=CursorWrapper.execute) as execute:
+            await communicator.send_json_to({"message": "Muted"})
+            error = await communicator.receive_json_from()
+        self.assertEqual(error["reason"], "blocked")
+        execute.assert_not_called()
+
+        await sync_to_async(self.set_blocked)(False)
+        self.assertEqual(await communicator.receive_json_from(), {"type": "unblocked"})
+        await communicator.send_json_to({"message": "Allowed"})
+        self.assertEqual((await communicator.receive_json_from())["message"], "Allowed")
+        await communicator.disconnect()
+        self.assertEqual(await Message.objects.filter(channel=self.channel).acount(), 1)
+
+    @override_settings(CHAT_REPLAY={'BATCH_SIZE': 2, 'MAX_MESSAGES': 3})
+    async def test_replay_from_last_seen_id(self):
+        """
+        Тестирование догрузки пропущенных сообщений при переподключении.
+        """
+        messages = [await Message.objects.acreate(channel=self.channel, user=self.user, content=f"Message {i}")
+                    for i in range(5)]
+
+        communicator = self.get_communicator(self.channel.name, self.user, f"?last_seen_id={messages[0].id}")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        first = await communicator.receive_json_from()
+        second = await communicator.receive_json_from()
+        self.assertEqual(first["type"], "replay")
+        self.assertEqual([m["id"] for m in first["messages"] + second["messages"]],
+                         [m.id for m in messages[1:4]])
+
+        # Пропуск больше MAX_MESSAGES: остаток загружается через REST
+        done = await communicator.receive_json_from()
+        self.assertEqual(done, {"type": "replay_done", "last_id": messages[3].id, "truncated": True})
+
+        await communicator.send_json_to({"message": "Live message"})
+        live = await communicator.receive_json_from()
+        self.assertEqual(live["message"], "Live message")
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+        # Последнее полученное сообщение удалено: клиент получает последние сообщения заново
+        deleted_id = messages[0].id
+        await messages[0].adelete()
+        communicator = self.get_communicator(self.channel.name, self.user, f"?last_seen_id={deleted_id}")
+        await communicator.connect()
+        backlog = await communicator.receive_json_from()
+        self.assertEqual(backlog["type"], "backlog")
+        self.assertEqual(backlog["messages"][-1]["message"], "Live message")
+        await communicator.disconnect()
+
+
+    async def test_connect_creates_read_marker(self):
+        """
+        Тестирование создания отметки о прочтении при первом подключении к каналу.
+        """
+        other = await User.objects.acreate(username="other_user", email="other_user@test.com")
+        await sync_to_async(MessageWriteBuffer._write)([Message(channel=self.channel, user=other, content="Before")])
+
+        communicator = self.get_communicator(self.channel.name, self.user)
+        await communicator.connect()
+        await communicator.receive_json_from()
+        marker = await ReadMarker.objects.aget(user=self.user, channel=self.channel)
+        self.assertEqual((marker.last_read_message_id, marker.unread_count), (0, 1))
+
+        # Собственные сообщения не увеличивают счетчик, повторное подключение не меняет отметку
+        await communicator.send_json_to({"message": "Own"})
+        await communicator.receive_json_from()
+        await communicator.disconnect()
+        second = self.get_communicator(self.channel.name, self.user)
+        await second.connect()
+        await second.receive_json_from()
+        await second.disconnect()
+        marker = await ReadMarker.objects.aget(user=self.user, channel=self.channel)
+        self.assertEqual(marker.unread_count, 1)
+
+    async def test_import_invalidates_recent_messages(self):
+        """
+        Тестирование сброса буфера последних сообщений после импорта в обход событий группы.
+        """
+        communicator = self.get_communicator(self.channel.name, self.user)
+        await communicator.connect()
+        await communicator.receive_json_from()
+        await communicator.send_json_to({"message": "Live"})
+        await communicator.receive_json_from()
+        self.assertEqual(len(get_recent_messages().newest(self.channel.id, 10)), 1)
+
+        rows = [json.dumps({"channel": self.channel.name, "username": "ws_user", "message": f"Imported {i}",
+                            "timestamp": f"2020-01-01T10:0{i}:00Z"}) for i in range(5)]
+
+        def run_import():
+            with self.captureOnCommitCallbacks(execute=True):
+                MessageImporter().run(rows)
+
+        with mock.patch.object(RecentMessages, 'invalidate', autospec=True,
+                               side_effect=RecentMessages.invalidate) as invalidate:
+            await sync_to_async(run_import)()
+            # Событие группы не пересылается клиенту, буфер сбрасывается и подключениями (в других процессах)
+            self.assertTrue(await communicator.receive_nothing())
+        self.assertEqual([call.args[1] for call in invalidate.call_args_list], [self.channel.id] * 2)
+        self.assertIsNone(get_recent_messages().newest(self.channel.id, 10))
+
+        # Новое подключение заново заполняет буфер из базы данных
+        second = self.get_communicator(self.channel.name, self.user)
+        await second.connect()
+        backlog = await second.receive_json_from()
+        self.assertEqual(len(backlog["messages"]), 6)
+        self.assertEqual(len(get_recent_messages().newest(self.channel.id, 10)), 6)
+
+        await communicator.disconnect()
+        await second.disconnect()
+
+@override_settings(CHAT_DB_EXECUTOR={'MAX_WORKERS': 0})
+class HybridChannelLayerTestCase(TestCase):
+
+    def get_layer(self):
+        """
+        Channel layer отдельного процесса; SharedMemoryChannelLayer заменяет общий Redis
+        """
+        return HybridChannelLayer(remote={'BACKEND': 'chat.layers.SharedMemoryChannelLayer',
+                                          'CONFIG': {'name': 'hybrid-test'}})
+
+    async def test_group_send_publishes_once_per_process(self):
+        """
+        Тестирование доставки сообщения группы подключениям своего и другого процесса.
+        """
+        first, second = self.get_layer(), self.get_layer()
+        local = [await first.new_channel() for _ in range(3)]
+        remote = [await second.new_channel() for _ in range(2)]
+        for layer, channels in ((first, local), (second, remote)):
+            for channel in channels:
+                await layer.group_add("chat_1", channel)
+
+        with mock.patch.object(SharedMemoryChannelLayer, 'send', autospec=True,
+                               side_effect=SharedMemoryChannelLayer.send) as send:
+            await first.group_send("chat_1", {"type": "chat.message", "text": "Hello"})
+        # Во внешний channel layer уходит по одной копии на процесс, а не на подключение
+        self.assertEqual(sorted(call.args[1] for call in send.call_args_list), sorted([first.inbox, second.inbox]))
+        for layer, channels in ((first, local), (second, remote)):
+            for channel in channels:
+                message = await asyncio.wait_for(layer.receive(channel), 1)
+                self.assertEqual(message, {"type": "chat.message", "text": "Hello"})
+
+        # Отправка подключению другого процесса
+        await second.send(local[0], {"type": "direct"})
+        self.assertEqual(await asyncio.wait_for(first.receive(local[0]), 1), {"type": "direct"})
+
+        # После отключения всех подключений процесс не получает сообщения группы
+        for channel in local:
+            await first.group_discard("chat_1", channel)
+        await second.group_send("chat_1", {"type": "chat.message", "text": "Bye"})
+        self.assertEqual((await asyncio.wait_for(second.receive(remote[0]), 1))["text"], "Bye")
+        self.assertNotIn(first.inbox, first.remote.groups.get("chat_1", {}))
+
+        await first.flush()
+        await first.close()
+        await second.close()
+
+    async def test_process_inbox_is_not_limited_by_channel_capacity(self):
+        """
+        Тестирование всплеска сообщений группы больше емкости канала по умолчанию.
+        """
+        first = HybridChannelLayer(remote={'BACKEND': 'chat.layers.SharedMemoryChannelLayer',
+                                           'CONFIG': {'name': 'hybrid-capacity'}}, capacity=1000)
+        second = HybridChannelLayer(remote={'BACKEND': 'chat.layers.SharedMemoryChannelLayer',
+                                            'CONFIG': {'name': 'hybrid-capacity'}})
+        self.assertEqual(first.remote.get_capacity(first.inbox), INBOX_CAPACITY)
+        channel = await first.new_channel()
+        await first.group_add("chat_1", channel)
+
+        # Процесс занят и не читает свою очередь, пока идет всплеск
+        first._reader.cancel()
+        await asyncio.sleep(0)
+        for i in range(300):
+            await second.group_send("chat_1", {"type": "chat.message", "number": i})
+        for i in range(300):
+            self.assertEqual((await asyncio.wait_for(first.receive(channel), 1))["number"], i)
+
+        await first.flush()
+        await first.close()
+        await second.close()
+
+    async def test_group_membership_is_refreshed(self):
+        """
+        Тестирование продления членства очереди процесса в группе для долгих подключений.
+        """
+        remote = {'BACKEND': 'chat.layers.SharedMemoryChannelLayer',
+                  'CONFIG': {'name': 'hybrid-expiry', 'group_expiry': 1}}
+        first = HybridChannelLayer(remote=remote, group_expiry=1)
+        second = HybridChannelLayer(remote=remote, group_expiry=1)
+        self.assertEqual(first.group_refresh_interval, 0.5)
+        channel = await first.new_channel()
+        await first.group_add("user_1", channel)
+
+        # Подключение остается в группе дольше group_expiry без повторного group_add
+        await asyncio.sleep(1.6)
+        await second.group_send("user_1", {"type": "user.blocked"})
+        self.assertEqual(await asyncio.wait_for(first.receive(channel), 1), {"type": "user.blocked"})
+
+        await first.flush()
+        await first.close()
+        await second.close()
+
+    @override_settings(CHANNEL_LAYERS={'default': {
+        'BACKEND': 'chat.layers.HybridChannelLayer',
+        'CONFIG': {'remote': {'BACKEND': 'chat.layers.SharedMemoryChannelLayer', 'CONFIG': {'name': 'hybrid-ws'}}},
+    }})
+    async def test_consumer(self):
+        """
+        Тестирование рассылки сообщений WebSocket через HybridChannelLayer.
+        """
+        user = await User.objects.acreate(username="hybrid_user", email="hybrid_user@test.com")
+        channel = await Channel.objects.acreate(name="Hybrid_Channel")
+        application = JWTAuthMiddleware(URLRouter(routing.websocket_urlpatterns))
+        headers = [(b'authorization', f'Bearer {AccessToken.for_user(user)}'.encode())]
+        communicators = [WebsocketCommunicator(application, f"/ws/chat/{channel.name}/", headers=headers)
+                         for _ in range(2)]
+        for communicator in communicators:
+            self.assertTrue((await communicator.connect())[0])
+            await communicator.receive_json_from()
+
+        await communicators[0].send_json_to({"message": "Hybrid hello"})
+        for communicator in communicators:
+            self.assertEqual((await communicator.receive_json_from())["message"], "Hybrid hello")
+            await communicator.disconnect()
+
+
+class DatabaseExecutorTestCase(TransactionTestCase):
+
+    async def test_rejects_when_queue_is_full(self):
+        """
+        Тестирование отказа без ожидания при заполненной очереди запросов.
+        """
+        executor = DatabaseExecutor(max_workers=1, max_queue=1)
+        started, release = threading.Event(), threading.Event()
+
+        def blocking():
+            started.set()
+            release.wait(5)
+            return User.objects.count()
+
+        running = asyncio.ensure_future(executor.run(blocking))
+        await asyncio.to_thread(started.wait, 5)
+        queued = asyncio.ensure_future(executor.run(User.objects.count))
+        await asyncio.sleep(0)
+        with self.assertRaises(DatabaseBusy):
+            await executor.run(User.objects.count)
+
+        release.set()
+        self.assertEqual(await running, 0)
+        self.assertEqual(await queued, 0)
+        self.assertEqual(executor.queued, 0)
+        executor.shutdown()
+
+    async def test_cancelled_calls_leave_queue(self):
+        """
+        Тестирование освобождения очереди при отмене ожидающих запросов.
+        """
+        executor = DatabaseExecutor(max_workers=1, max_queue=3)
+        started, release = threading.Event(), threading.Event()
+
+        def blocking():
+            started.set()
+            release.wait(5)
+
+        running = asyncio.ensure_future(executor.run(blocking))
+        await asyncio.to_thread(started.wait, 5)
+        waiters = [asyncio.ensure_future(executor.run(User.objects.count)) for _ in range(3)]
+        await asyncio.sleep(0)
+        self.assertEqual(executor.queued, 3)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        self.assertEqual(executor.queued, 0)
+
+        release.set()
+        await running
+        self.assertEqual(await executor.run(User.objects.count), 0)
+        executor.shutdown()
+
+    async def test_keeps_connection_between_calls(self):
+        """
+        Тестирование повторного использования соединения потока между запросами.
+        """
+        executor = DatabaseExecutor(max_workers=1, max_queue=10)
+
+        def connection_id():
+            User.objects.exists()
+            return id(connection.connection)
+
+        first = await executor.run(connection_id)
+        self.assertEqual(await executor.run(connection_id), first)
+        await executor.run(lambda: connection.close())
+        executor.shutdown()
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .events import get_group_name
+from .protocol import encode_frames
+from .shared import get_redis, make_key
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'INTERVAL': 2.0,
+}
+
+
+# Рассылка в канал разрешена процессу, который первым занял окно канала (SET NX PX) на INTERVAL.
+# Остальные процессы добавляют своих пользователей в общий список и повторяют попытку, когда окно закончится.
+# KEYS: окно канала, пользователи (HASH id -> имя пользователя); ARGV: INTERVAL в мс, затем пары id, имя
+CLAIM_SCRIPT = """
+local interval = tonumber(ARGV[1])
+for i = 2, #ARGV, 2 do
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+if #ARGV > 1 then
+    redis.call('PEXPIRE', KEYS[2], interval * 2)
+end
+if redis.call('SET', KEYS[1], 1, 'NX', 'PX', interval) then
+    local users = redis.call('HGETALL', KEYS[2])
+    redis.call('DEL', KEYS[2])
+    return {0, users}
+end
+return {redis.call('PTTL', KEYS[1]), {}}
+"""
+
+
+class LocalTypingStore:
+    """
+    Окна рассылки в памяти процесса (channel layer без Redis)
+    """
+
+    def __init__(self):
+        # id канала -> {id пользователя: имя пользователя}
+        self._pending = {}
+        # id канала -> время последней рассылки
+        self._sent_at = {}
+
+    async def claim(self, channel_id, users, interval):
+        """
+        Добавляет пользователей в список канала. Если окно канала свободно, занимает его и возвращает
+        (всех пользователей списка, 0), иначе (None, секунды до конца окна)
+        """
+        self._pending.setdefault(channel_id, {}).update(users)
+        now = time.monotonic()
+        wait = self._sent_at.get(channel_id, float('-inf')) + interval - now
+        if wait > 0:
+            return None, wait
+        # Закончившиеся окна других каналов больше не нужны
+        for expired in [key for key, sent_at in self._sent_at.items() if sent_at + interval <= now]:
+            del self._sent_at[expired]
+        self._sent_at[channel_id] = now
+        return self._pending.pop(channel_id), 0
+
+    def clear(self):
+        self._pending.clear()
+        self._sent_at.clear()
+
+
+class RedisTypingStore:
+    """
+    Окна рассылки в Redis channel layer, общие для всех процессов
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+
+    async def claim(self, channel_id, users, interval):
+        base = make_key(self.layer, 'typing', channel_id)
+        args = [item for user_id, username in users.items() for item in (user_id, username)]
+        wait, claimed = await get_redis(self.layer, base).eval(
+            CLAIM_SCRIPT, 2, f'{base}:window', f'{base}:users', max(int(interval * 1000), 1), *args)
+        if wait:
+            return None, max(wait, 1) / 1000
+        return {int(claimed[i]): self._decode(claimed[i + 1]) for i in range(0, len(claimed), 2)}, 0
+
+    @staticmethod
+    def _decode(value):
+        return value.decode() if isinstance(value, bytes) else value
+
+
+_local_store = LocalTypingStore()
+
+
+class TypingIndicators:
+    """
+    Уведомления «печатает» без записи в базу данных.
+
+    События набора текста копятся по каналам: группа канала получает не больше одного кадра
+    за INTERVAL секунд со всеми пользователями, печатавшими за это время, сколько бы событий
+    ни отправили их клиенты. Первое событие после паузы рассылается сразу. С channels_redis окно
+    канала общее для всех процессов: пользователи из разных процессов попадают в один кадр.
+    """
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        # id канала -> {id пользователя: имя пользователя}, еще не переданные в окно канала
+        self._typing = {}
+        self._flush_tasks = {}
+
+    @classmethod
+    def from_settings(cls):
+        config = {**DEFAULTS, **getattr(settings, 'CHAT_TYPING', {})}
+        return cls(interval=config['INTERVAL'])
+
+    @staticmethod
+    def get_store(layer):
+        if get_redis(layer, make_key(layer, 'typing')) is None:
+            return _local_store
+        return RedisTypingStore(layer)
+
+    def typing(self, layer, channel_id, user_id, username):
+        """
+        Отмечает, что пользователь печатает в канале
+        """
+        metrics.WS_TYPING_RECEIVED.inc()
+        self._typing.setdefault(channel_id, {})[user_id] = username
+
+        loop = asyncio.get_running_loop()
+        task = self._flush_tasks.get(channel_id)
+        # Задача привязана к циклу событий, в котором была создана
+        if task is None or task.done() or task.get_loop() is not loop:
+            self._flush_tasks[channel_id] = loop.create_task(self._flush_later(layer, channel_id))
+
+    async def _flush_later(self, layer, channel_id):
+        store = self.get_store(layer)
+        try:
+            while True:
+                users, wait = await store.claim(channel_id, self._typing.pop(channel_id, {}), self.interval)
+                if users is not None:
+                    break
+                # Окно занято: пользователи уже в списке канала, их разошлет занявший следующее окно
+                await asyncio.sleep(wait)
+            if not users:
+                return
+            await layer.group_send(get_group_name(channel_id), {
+                'type': 'typing',
+                'user_ids': list(users),
+                **encode_frames({
+                    'type': 'typing',
+                    'users': [{'id': user_id, 'username': username} for user_id, username in users.items()],
+                }),
+            })
+        except Exception:
+            logger.exception("Не удалось разослать уведомление о наборе текста в канале %s", channel_id)
+            return
+        finally:
+            if self._flush_tasks.get(channel_id) is asyncio.current_task():
+                del self._flush_tasks[channel_id]
+                # События, пришедшие во время рассылки, попадут в следующее окно
+                if self._typing.get(channel_id):
+                    self._flush_tasks[channel_id] = asyncio.get_running_loop().create_task(
+                        self._flush_later(layer, channel_id))
+        metrics.WS_TYPING_BROADCAST.inc()
+
+
+_typing_indicators = None
+
+
+def get_typing_indicators():
+    """
+    Возвращает уведомления о наборе текста текущего процесса
+    """
+    global _typing_indicators
+    if _typing_indicators is None:
+        _typing_indicators = TypingIndicators.from_settings()
+    return _typing_indicators
+
+
+@receiver(setting_changed)
+def reset_typing_indicators(setting, **kwargs):
+    global _typing_indicators
+    if setting == 'CHAT_TYPING':
+        _typing_indicators = None
+        _local_store.clear()
@@ -0,0 +1,104 @@
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Case, Count, F, FilteredRelation, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .models import Channel, Message, ReadMarker
+
+
+def _unread_messages(messages):
+    """
+    Подзапрос: число сообщений выборки, непрочитанных владельцем отметки (по строке ReadMarker)
+    """
+    return Coalesce(Subquery(
+        messages.filter(channel_id=OuterRef('channel_id'), id__gt=OuterRef('last_read_message_id'))
+        .exclude(user_id=OuterRef('user_id'))
+        .order_by().values('channel_id').annotate(count=Count('id')).values('count')
+    ), 0)
+
+
+def messages_created(messages):
+    """
+    Увеличивает счетчики непрочитанных после записи сообщений (вызывается в транзакции записи).
+    Новые сообщения новее любой отметки о прочтении, поэтому на канал достаточно одного UPDATE:
+    каждому читателю прибавляется число сообщений канала, кроме его собственных
+    """
+    authors = defaultdict(Counter)
+    for message in messages:
+        authors[message.channel_id][message.user_id] += 1
+
+    for channel_id, counts in authors.items():
+        total = sum(counts.values())
+        ReadMarker.objects.filter(channel_id=channel_id).update(unread_count=F('unread_count') + Case(
+            *[When(user_id=user_id, then=Value(total - count)) for user_id, count in counts.items()],
+            default=Value(total),
+        ))
+
+
+def messages_deleted(message_ids):
+    """
+    Уменьшает счетчики непрочитанных перед удалением сообщений (вызывается в транзакции удаления)
+    """
+    messages = Message.objects.filter(id__in=message_ids)
+    ReadMarker.objects.filter(channel_id__in=messages.values('channel_id')).update(
+        unread_count=Greatest(F('unread_count') - _unread_messages(messages), 0))
+
+
+def create_marker(user_id, channel_id, unread_count):
+    """
+    Создает отметку о прочтении без прочитанных сообщений, если ее еще нет (при первом подключении к каналу).
+    До первого подключения пользователь не писал в канал, поэтому непрочитанные — все сообщения канала (message_count)
+    """
+    ReadMarker.objects.bulk_create([ReadMarker(user_id=user_id, channel_id=channel_id, unread_count=unread_count)],
+                                   ignore_conflicts=True)
+
+
+def mark_read(user_id, channel_id, message_id=None):
+    """
+    Переносит отметку о прочтении вперед до message_id (по умолчанию — до последнего сообщения канала)
+    и пересчитывает счетчик по сообщениям после отметки
+    """
+    with transaction.atomic():
+        marker, created = ReadMarker.objects.get_or_create(user_id=user_id, channel_id=channel_id)
+        # Блокировка строки: параллельная запись сообщения изменит счетчик уже после пересчета
+        marker = ReadMarker.objects.select_for_update().get(id=marker.id)
+
+        newest = (Message.objects.filter(channel_id=channel_id).order_by('-id')
+                  .values_list('id', flat=True).first()) or 0
+        last_read = newest if message_id is None else min(message_id, newest)
+        if not created and last_read <= marker.last_read_message_id:
+            # Отметка не сдвигается назад
+            return marker
+
+        marker.last_read_message_id = max(last_read, marker.last_read_message_id)
+        marker.unread_count = 0 if marker.last_read_message_id == newest else (
+            Message.objects.filter(channel_id=channel_id, id__gt=marker.last_read_message_id)
+            .exclude(user_id=user_id).count())
+        marker.save(update_fields=['last_read_message_id', 'unread_count', 'updated_at'])
+        return marker
+
+
+def unread_counts(user_id):
+    """
+    Активные каналы с отметкой о прочтении пользователя (last_read_id) и числом непрочитанных (unread), один запрос
+    без подсчета сообщений. В канал без отметки пользователь еще не подключался (отметка создается при подключении),
+    поэтому все его сообщения (Channel.message_count) написаны другими пользователями
+    """
+    return (Channel.objects.active()
+            .annotate(marker=FilteredRelation('read_markers', condition=Q(read_markers__user_id=user_id)))
+            .annotate(last_read_id=Coalesce(F('marker__last_read_message_id'), 0),
+                      unread=Coalesce(F('marker__unread_count'), F('message_count')))
+            .order_by('id'))
+
+
+def rebuild_unread_counts(channel_ids=None):
+    """
+    Пересчитывает счетчики непрочитанных одним запросом (после массовой загрузки сообщений).
+    UPDATE не изменяет поле auto_now, поэтому время изменения отметок задается явно
+    """
+    markers = ReadMarker.objects.all()
+    if channel_ids is not None:
+        markers = markers.filter(channel_id__in=channel_ids)
+    return markers.update(unread_count=_unread_messages(Message.objects.all()), updated_at=timezone.now())
@@ -3,7 +3,9 @@ from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 from .views import (UserRegistrationView, UserListView, UserDetailView, UserDetailViewModerator,
                     ChannelListView, ChannelListCreateView, ChannelUpdateView, ChannelDeleteView,
-                    MessageHistoryView, DeleteMessageView)
+                    ChannelPurgeListView, ChannelPurgeDetailView, ReadMarkerView, UnreadCountsView,
+                    OnlineUsersView, MessageHistoryView, DeleteMessageView, MessagePurgeView, MessagePurgeListView,
+                    MessagePurgeDetailView, MessageSearchView, MessageExportView, MessageImportView, MetricsView)
 
 
 urlpatterns = [
@@ -26,7 +28,28 @@ urlpatterns = [
     # Удаление канала (по id или имени)
     path('channels/delete-by-id/<int:id>/', ChannelDeleteView.as_view(), name='channel_delete_by_id'),
     path('channels/delete-by-name/<str:name>/', ChannelDeleteView.as_view(), name='channel_delete_by_name'),
+    # Ход фонового удаления сообщений удаленных каналов
+    path('channels/purges/', ChannelPurgeListView.as_view(), name='channel_purge_list'),
+    path('channels/purges/<int:pk>/', ChannelPurgeDetailView.as_view(), name='channel_purge_detail'),
+    # Отметки о прочтении и счетчики непрочитанных сообщений
+    path('channels/unread/', UnreadCountsView.as_view(), name='unread_counts'),
+    path('channels/<str:channel_identifier>/read/', ReadMarkerView.as_view(), name='mark_read'),
+    # Пользователи в сети
+    path('channels/<str:channel_identifier>/online/', OnlineUsersView.as_view(), name='online_users'),
     path('channels/<str:channel_identifier>/history/', MessageHistoryView.as_view(), name='message_history'),
     path('channels/<str:channel_identifier>/history/<int:message_id>/delete/', DeleteMessageView.as_view(),
          name='delete_message'),
+    # Потоковая выгрузка истории канала
+    path('channels/<str:channel_identifier>/export/', MessageExportView.as_view(), name='message_export'),
+    # Массовый импорт сообщений (NDJSON)
+    path('messages/import/', MessageImportView.as_view(), name='message_import'),
+    # Массовое удаление сообщений модератором
+    path('messages/purge/', MessagePurgeView.as_view(), name='message_purge'),
+    path('messages/purges/', MessagePurgeListView.as_view(), name='message_purge_list'),
+    path('messages/purges/<int:pk>/', MessagePurgeDetailView.as_view(), name='message_purge_detail'),
+    # Поиск по сообщениям (во всех каналах или в одном канале)
+    path('search/', MessageSearchView.as_view(), name='message_search'),
+    path('channels/<str:channel_identifier>/search/', MessageSearchView.as_view(), name='channel_message_search'),
+    # Метрики для Prometheus
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
@@ -1,16 +1,41 @@
+import gzip
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.contrib.auth import get_user_model
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.db import transaction
+from django.db.models import Count, F, Max, Q, Sum
 from django.shortcuts import get_object_or_404
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.permissions import AllowAny, IsAuthenticated
-from rest_framework.generics import ListAPIView, RetrieveUpdateAPIView, CreateAPIView, UpdateAPIView
+from rest_framework.generics import (ListAPIView, RetrieveAPIView, RetrieveUpdateAPIView, CreateAPIView,
+                                     UpdateAPIView)
 
 from .serializers import (UserRegistrationSerializer, UserListSerializer, UserManageSerializer,
-                          UserManageSerializerForModerator, ChannelSerializer, MessageSerializer)
+                          UserManageSerializerForModerator, ChannelSerializer, MessageSerializer,
+                          MessageSearchSerializer, ChannelPurgeSerializer, MessagePurgeSerializer,
+                          MessagePurgeRequestSerializer, ReadMarkerSerializer, ReadMarkerRequestSerializer,
+                          UnreadCountSerializer, MessageExportSerializer)
 from .permissions import IsModeratorOrSuperUser, IsModerator, IsSuperUser
-from .models import Channel, Message
+from .pagination import MessageKeysetPagination
+from .conditional import ConditionalGetMixin
+from .models import Channel, ChannelPurge, Message, MessagePurge
+from .signals import user_flags_changed
+from .events import notify_messages_deleted, notify_channel_deleted
+from .importer import MessageImporter, NDJSONParser
+from .export import CONTENT_TYPES, aiter_message_batches, arender, iter_message_batches, render
+from .history import get_recent_messages
+from .presence import get_presence
+from .purge import get_channel_purger
+from .search import search_messages, InvalidCursor
+from .unread import mark_read, unread_counts
+from . import activity, unread
+from . import metrics
 
 
 User = get_user_model()
@@ -45,7 +70,8 @@ class UserDetailView(RetrieveUpdateAPIView):
         return UserManageSerializer
 
     def perform_update(self, serializer):
-        serializer.save()
+        user = serializer.save()
+        user_flags_changed.send(sender=self.__class__, user_ids=[user.id], changes=serializer.validated_data)
 
 
 class UserDetailViewModerator(RetrieveUpdateAPIView):
@@ -62,12 +88,36 @@ class UserDetailViewModerator(RetrieveUpdateAPIView):
             raise PermissionDenied("Модераторы не могут изменять данные других модераторов или администраторов")
 
         serializer.save()
+        user_flags_changed.send(sender=self.__class__, user_ids=[user.id], changes=serializer.validated_data)
 
 
-class ChannelListView(ListAPIView):
+class ChannelListView(ConditionalGetMixin, ListAPIView):
     permission_classes = [IsAuthenticated]
-    queryset = Channel.objects.all()
     serializer_class = ChannelSerializer
+    # ?ordering=activity — сначала каналы с самыми новыми сообщениями (по индексу last_message_at)
+    orderings = {
+        'activity': [F('last_message_at').desc(nulls_last=True), '-id'],
+        'name': ['name'],
+    }
+
+    def get_queryset(self):
+        queryset = Channel.objects.active()
+        ordering = self.request.query_params.get('ordering')
+        if ordering is None:
+            return queryset
+        if ordering not in self.orderings:
+            raise ValidationError({"Ошибка": f"ordering должен быть одним из: {', '.join(self.orderings)}"})
+        return queryset.order_by(*self.orderings[ordering])
+
+    def list(self, request, *args, **kwargs):
+        # Версия списка: число каналов, сумма их версий и время последнего изменения
+        # (один агрегирующий запрос к таблице каналов)
+        state = Channel.objects.aggregate(count=Count('id', filter=Q(is_deleted=False)), version=Sum('version'),
+                                          updated_at=Max('updated_at'))
+        updated_at = state['updated_at']
+        version = f"{state['count']}:{state['version']}:{updated_at.isoformat() if updated_at else ''}"
+        return self.conditional_response(request, version, updated_at,
+                                         lambda: super(ChannelListView, self).list(request, *args, **kwargs).data)
 
 
 class ChannelListCreateView(CreateAPIView):
@@ -85,7 +135,7 @@ class ChannelListCreateView(CreateAPIView):
 
 class ChannelUpdateView(UpdateAPIView):
     permission_classes = [IsModeratorOrSuperUser]
-    queryset = Channel.objects.all()
+    queryset = Channel.objects.active()
     serializer_class = ChannelSerializer
 
     def patch(self, request, *args, **kwargs):
@@ -97,10 +147,11 @@ class ChannelUpdateView(UpdateAPIView):
         # Если описание не указано, сохраняем текущее
         description = request.data.get('description', channel.description)
 
-        # Обновляем объект и сохраняем изменения
+        # Обновляем объект и сохраняем изменения.
+        # Денормализованные поля сообщений не перезаписываем устаревшими значениями
         channel.name = name
         channel.description = description
-        channel.save()
+        Channel.objects.filter(id=channel.id).touch(name=name, description=description)
 
         # Возвращаем обновленные данные
         serializer = self.get_serializer(channel)
@@ -115,33 +166,157 @@ class ChannelDeleteView(APIView):
         channel_name = kwargs.get('name', None)
 
         if channel_id:
-            channel = get_object_or_404(Channel, id=channel_id)
+            channel = get_object_or_404(Channel.objects.active(), id=channel_id)
         elif channel_name:
-            channel = get_object_or_404(Channel, name=channel_name)
+            channel = get_object_or_404(Channel.objects.active(), name=channel_name)
         else:
             return Response(
                 {"Ошибка": "Необходимо указать id или name канала"},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        channel.delete()
+        # Канал сразу помечается удаленным и переименовывается, сообщения удаляются пакетами в фоне
+        with transaction.atomic():
+            Channel.objects.filter(id=channel.id).touch(is_deleted=True, name=channel.get_deleted_name())
+            purge = ChannelPurge.objects.create(channel=channel, channel_name=channel.name,
+                                                requested_by=request.user)
+            get_channel_purger().schedule(purge.id)
+        notify_channel_deleted(channel.id)
         return Response(
-            {"Уведомление": f"Канал '{channel.name}' успешно удален"},
-            status=status.HTTP_200_OK
+            {"Уведомление": f"Канал '{channel.name}' удален, сообщения канала удаляются в фоне",
+             "purge": ChannelPurgeSerializer(purge).data},
+            status=status.HTTP_202_ACCEPTED
         )
 
 
-class MessageHistoryView(ListAPIView):
+class ChannelPurgeListView(ListAPIView):
+    """
+    Ход фонового удаления сообщений удаленных каналов
+    """
+    permission_classes = [IsModeratorOrSuperUser]
+    queryset = ChannelPurge.objects.all()
+    serializer_class = ChannelPurgeSerializer
+
+
+class ChannelPurgeDetailView(RetrieveAPIView):
+    permission_classes = [IsModeratorOrSuperUser]
+    queryset = ChannelPurge.objects.all()
+    serializer_class = ChannelPurgeSerializer
+
+
+class MessageHistoryView(ConditionalGetMixin, ListAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = MessageSerializer
+    pagination_class = MessageKeysetPagination
 
-    def get_queryset(self):
+    def get_channel(self):
         channel_identifier = self.kwargs['channel_identifier']
         if channel_identifier.isdigit():
-            channel = get_object_or_404(Channel, id=int(channel_identifier))
+            return get_object_or_404(Channel.objects.active(), id=int(channel_identifier))
+        return get_object_or_404(Channel.objects.active(), name=channel_identifier)
+
+    def get_queryset(self):
+        return Message.objects.filter(channel=self.channel).select_related('user')
+
+    def list(self, request, *args, **kwargs):
+        self.channel = self.get_channel()
+        # Версия канала меняется при каждой записи и удалении его сообщений
+        channel = self.channel
+        version = f'{channel.id}:{channel.version}:{channel.updated_at.isoformat()}'
+        return self.conditional_response(request, version, channel.updated_at, lambda: self.get_page(request).data)
+
+    def get_page(self, request):
+        # Последняя страница истории отдается из буфера последних сообщений без запроса к Message
+        page = self.paginator.paginate_recent(get_recent_messages(), self.channel.id, request)
+        if page is not None:
+            return self.paginator.get_paginated_response(page)
+        return super().list(request)
+
+
+class ReadMarkerView(APIView):
+    """
+    Отметка о прочтении канала до сообщения last_read_id (по умолчанию — до последнего сообщения)
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, channel_identifier):
+        if channel_identifier.isdigit():
+            channel = get_object_or_404(Channel.objects.active(), id=int(channel_identifier))
         else:
-            channel = get_object_or_404(Channel, name=channel_identifier)
-        return Message.objects.filter(channel=channel)
+            channel = get_object_or_404(Channel.objects.active(), name=channel_identifier)
+
+        serializer = ReadMarkerRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        marker = mark_read(request.user.id, channel.id, serializer.validated_data.get('last_read_id'))
+        marker.channel = channel
+        return Response(ReadMarkerSerializer(marker).data, status=status.HTTP_200_OK)
+
+
+class UnreadCountsView(ListAPIView):
+    """
+    Счетчики непрочитанных сообщений во всех каналах, в том числе еще не отмеченных (один запрос к базе данных)
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = UnreadCountSerializer
+
+    def get_queryset(self):
+        return unread_counts(self.request.user.id)
+
+
+class OnlineUsersView(APIView):
+    """
+    Пользователи, подключенные к каналу через WebSocket
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, channel_identifier):
+        if channel_identifier.isdigit():
+            channel = get_object_or_404(Channel.objects.active(), id=int(channel_identifier))
+        else:
+            channel = get_object_or_404(Channel.objects.active(), name=channel_identifier)
+        online = async_to_sync(get_presence().online)(get_channel_layer(), channel.id)
+        return Response(online, status=status.HTTP_200_OK)
+
+
+class MessageSearchView(APIView):
+    """
+    Полнотекстовый поиск по сообщениям во всех каналах или в одном канале
+    """
+    permission_classes = [IsAuthenticated]
+    page_size = 20
+    max_page_size = 100
+
+    def get(self, request, channel_identifier=None):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({"Ошибка": "Необходимо указать строку поиска q"}, status=status.HTTP_400_BAD_REQUEST)
+
+        channel_id = None
+        if channel_identifier is not None:
+            if channel_identifier.isdigit():
+                channel_id = get_object_or_404(Channel.objects.active(), id=int(channel_identifier)).id
+            else:
+                channel_id = get_object_or_404(Channel.objects.active(), name=channel_identifier).id
+
+        try:
+            page_size = min(int(request.query_params.get('page_size', self.page_size)), self.max_page_size)
+        except ValueError:
+            return Response({"Ошибка": "page_size должен быть целым числом"}, status=status.HTTP_400_BAD_REQUEST)
+        if page_size < 1:
+            return Response({"Ошибка": "page_size должен быть положительным"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            messages, next_cursor = search_messages(query, channel_id=channel_id,
+                                                    cursor=request.query_params.get('cursor'), limit=page_size)
+        except InvalidCursor:
+            return Response({"Ошибка": "Некорректный курсор"}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'next': next_cursor,
+            'results': MessageSearchSerializer(messages, many=True).data,
+        })
+
 
 class DeleteMessageView(APIView):
     permission_classes = [IsAuthenticated]
@@ -149,9 +324,9 @@ class DeleteMessageView(APIView):
     def delete(self, request, channel_identifier, message_id):
         try:
             if channel_identifier.isdigit():
-                channel = Channel.objects.get(id=int(channel_identifier))
+                channel = Channel.objects.active().get(id=int(channel_identifier))
             else:
-                channel = Channel.objects.get(name=channel_identifier)
+                channel = Channel.objects.active().get(name=channel_identifier)
         except Channel.DoesNotExist:
             return Response({"Ошибка": "Канал не найден"}, status=status.HTTP_404_NOT_FOUND)
 
@@ -161,5 +336,119 @@ class DeleteMessageView(APIView):
             raise PermissionDenied("У вас нет прав на удаление этого сообщения")
 
         # Удаляем сообщение
-        message.delete()
+        with transaction.atomic():
+            unread.messages_deleted([message.id])
+            activity.messages_deleted([message.id])
+            message.delete()
+        notify_messages_deleted(channel.id, [message_id])
         return Response({"Уведомление": "Сообщение успешно удалено"}, status=status.HTTP_204_NO_CONTENT)
+
+
+class MessagePurgeView(APIView):
+    """
+    Массовое удаление сообщений модератором по автору, каналам и интервалу времени.
+    Сообщения удаляются пакетами в фоне, ответ содержит запись о ходе удаления
+    """
+    permission_classes = [IsModeratorOrSuperUser]
+
+    def post(self, request):
+        serializer = MessagePurgeRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        purger = get_channel_purger()
+        with transaction.atomic():
+            purge = serializer.save(requested_by=request.user)
+            purger.schedule(purge.id, purger.run_message_purge)
+        return Response(
+            {"Уведомление": "Сообщения удаляются в фоне",
+             "purge": MessagePurgeSerializer(purge).data},
+            status=status.HTTP_202_ACCEPTED
+        )
+
+
+class MessagePurgeListView(ListAPIView):
+    """
+    Ход фонового массового удаления сообщений
+    """
+    permission_classes = [IsModeratorOrSuperUser]
+    queryset = MessagePurge.objects.all()
+    serializer_class = MessagePurgeSerializer
+
+
+class MessagePurgeDetailView(RetrieveAPIView):
+    permission_classes = [IsModeratorOrSuperUser]
+    queryset = MessagePurge.objects.all()
+    serializer_class = MessagePurgeSerializer
+
+
+class MessageExportView(APIView):
+    """
+    Потоковая выгрузка истории канала в NDJSON или CSV (в порядке возрастания id).
+    Прерванную выгрузку можно продолжить с параметром after=<id последнего полученного сообщения>
+    """
+    permission_classes = [IsModeratorOrSuperUser]
+
+    def get(self, request, channel_identifier):
+        if channel_identifier.isdigit():
+            channel = get_object_or_404(Channel.objects.active(), id=int(channel_identifier))
+        else:
+            channel = get_object_or_404(Channel.objects.active(), name=channel_identifier)
+        serializer = MessageExportSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+
+        output, compress = params['output'], params.get('compress') == 'gzip'
+        filters = {'after': params['after'], 'since': params.get('since'), 'until': params.get('until')}
+        if isinstance(request._request, ASGIRequest):
+            # Под ASGI синхронный итератор был бы прочитан в память целиком до отправки ответа
+            content = arender(aiter_message_batches(channel.id, **filters), output, compress, params['after'])
+        else:
+            content = render(iter_message_batches(channel.id, **filters), output, compress, params['after'])
+        filename = f'channel-{channel.id}-after-{params["after"]}.{output}'
+        content_type = CONTENT_TYPES[output]
+        if compress:
+            filename += '.gz'
+            content_type = 'application/gzip'
+
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+
+class MessageImportView(APIView):
+    """
+    Массовый импорт сообщений из NDJSON (тело запроса читается потоком, построчно).
+    Параметры: channel — канал для строк без поля channel, create_channels=1 — создавать отсутствующие каналы
+    """
+    permission_classes = [IsModeratorOrSuperUser]
+    parser_classes = [NDJSONParser]
+
+    def post(self, request):
+        stream = request.data
+        if not hasattr(stream, 'readline'):
+            return Response({"Ошибка": "Ожидается тело запроса в формате NDJSON"}, status=status.HTTP_400_BAD_REQUEST)
+        if request.headers.get('Content-Encoding') == 'gzip':
+            stream = gzip.GzipFile(fileobj=stream)
+
+        importer = MessageImporter.from_settings(
+            channel=request.query_params.get('channel'),
+            create_channels=request.query_params.get('create_channels') in ('1', 'true'),
+        )
+        try:
+            report = importer.run(stream)
+        except (OSError, EOFError):
+            # Поврежденный поток gzip; уже записанные пакеты остаются в базе данных
+            return Response({"Ошибка": "Не удалось распаковать тело запроса"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(report.as_dict(), status=status.HTTP_200_OK)
+
+
+class MetricsView(APIView):
+    """
+    Метрики в текстовом формате Prometheus (доступны, если включен CHAT_METRICS_ENABLED)
+    """
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    def get(self, request):
+        if not metrics.is_enabled():
+            raise Http404
+        return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')